@@ -4,7 +4,8 @@ from django.contrib import admin
 
 from .models import (
     BankMovement, Comment, Customer, Expense, Invoice, Item, Order, OrderItem,
-    PQueue, Timetable, CashFlowIO, StatusShift, ExpenseCategory, )
+    PQueue, Timetable, CashFlowIO, StatusShift, StockMovement,
+    ExpenseCategory, )
 
 from django.utils.translation import gettext_lazy as _
 
@@ -85,8 +86,8 @@ class PQueueAdmin(admin.ModelAdmin):
 class InvoiceAdmin(admin.ModelAdmin):
     """Beautify the invoice admin view."""
 
-    list_display = ('invoice_no', 'reference', 'issued_on', 'amount',
-                    'pay_method', )
+    list_display = ('invoice_no', 'fiscal_year', 'reference', 'issued_on',
+                    'amount', 'pay_method', )
 
 
 class IssuerByName(admin.SimpleListFilter):
@@ -182,5 +183,15 @@ class TimetableAdmin(admin.ModelAdmin):
     list_filter = ('user', )
 
 
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    """Beautify the StockMovement admin view."""
+
+    date_hierarchy = 'created'
+    list_display = ('created', 'item', 'qty', 'reason', 'order_item', )
+    list_filter = ('reason', )
+    raw_id_fields = ('item', 'order_item', )
+
+
 admin.site.register(Comment)
 admin.site.register(ExpenseCategory)
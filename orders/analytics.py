@@ -0,0 +1,130 @@
+"""Measure how long the orders take to go through the kanban stages.
+
+Each status shift lasts until its date_out or, for the entries recorded
+without one, until the next shift of the same order starts. Lead time runs
+from the order's first shift to its delivery (status 7) and cycle time from
+the start of production (status 3) to the delivery.
+"""
+
+from collections import defaultdict
+from datetime import date
+
+from django.db.models import F, Window
+from django.db.models.functions import Coalesce, Lead, TruncMonth
+
+from . import settings
+from .forecast import add_months
+from .models import OrderItem, StatusShift
+
+PERCENTILES = (50, 75, 90)
+
+
+def shift_durations(orders=None, months=None):
+    """Get the status shifts of the last months orders with their duration.
+
+    The end of the shifts missing date_out is taken from the following
+    shift of the order with a window function, so a single query returns
+    the rows (order, status, date_in, month, duration) ordered by order. The
+    duration of the shifts still open is None.
+    """
+    months = months or settings.LEAD_TIME_HISTORY
+    start = add_months(date.today().replace(day=1), -months)
+    shifts = StatusShift.objects.filter(order__inbox_date__date__gte=start)
+    if orders is not None:
+        shifts = shifts.filter(order__in=orders)
+    next_in = Window(
+        expression=Lead('date_in'), partition_by=[F('order')],
+        order_by=[F('date_in').asc(), F('pk').asc()])
+    shifts = shifts.annotate(
+        date_end=Coalesce('date_out', next_in), month=TruncMonth('date_in'))
+    shifts = shifts.order_by('order', 'date_in', 'pk').values(
+        'order', 'status', 'date_in', 'date_end', 'month')
+
+    rows = list(shifts)
+    for row in rows:
+        end = row.pop('date_end')
+        row['duration'] = end - row['date_in'] if end else None
+    return rows
+
+
+def percentile(values, point):
+    """Interpolate the percentile (0-100) of the sorted values."""
+    if not values:
+        return None
+    rank = (len(values) - 1) * point / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def lead_times(by='month', orders=None, months=None):
+    """Get the percentiles of the time spent per status, lead & cycle time.
+
+    by groups the figures per month ('month', the month a shift starts or
+    the order is delivered) or per item type ('type', an order counts once
+    for each type it contains). Returns a list of dicts (group, status,
+    count & a pNN timedelta per PERCENTILES) where status is a status code,
+    'lead' or 'cycle'. Takes one query, two when grouping by type.
+    """
+    if by not in ('month', 'type'):
+        raise ValueError('Lead times are grouped by month or type.')
+
+    rows = shift_durations(orders, months)
+    if by == 'type':
+        types = defaultdict(set)
+        items = OrderItem.objects.filter(
+            reference__in={row['order'] for row in rows})
+        for order, item_type in items.order_by().values_list(
+                'reference', 'element__item_type').distinct():
+            types[order].add(item_type)
+
+    def groups(row):
+        if by == 'month':
+            return (row['month'].date(), )
+        return types.get(row['order'], ())
+
+    samples = defaultdict(list)
+    first_in = defaultdict(dict)
+    for row in rows:
+        # Invoiced shifts are closed on opening
+        if row['duration'] is not None and row['status'] != '9':
+            for group in groups(row):
+                samples[group, row['status']].append(row['duration'])
+        first_in[row['order']].setdefault('start', row)
+        first_in[row['order']].setdefault(row['status'], row)
+
+    # Lead & cycle times end on the first delivery of the order
+    for order, entries in first_in.items():
+        delivered = entries.get('7')
+        if not delivered:
+            continue
+        ends = [('lead', entries['start'])]
+        if '3' in entries:
+            ends.append(('cycle', entries['3']))
+        for name, begin in ends:
+            for group in groups(delivered):
+                samples[group, name].append(
+                    delivered['date_in'] - begin['date_in'])
+
+    report = list()
+    for (group, status), values in sorted(
+            samples.items(), key=lambda s: (str(s[0][0]), s[0][1])):
+        values.sort()
+        entry = {'group': group, 'status': status, 'count': len(values)}
+        for point in PERCENTILES:
+            entry['p{}'.format(point)] = percentile(values, point)
+        report.append(entry)
+    return report
+
+
+def status_tracker(order, statuses=('1', '2', '3', '6', '7', '9')):
+    """Get the last shift of the order on each of the statuses.
+
+    Returns a list of the shifts (None for the statuses the order hasn't
+    been in) in the statuses order, from a single query.
+    """
+    last = dict()
+    for shift in StatusShift.objects.filter(
+            order=order, status__in=statuses).order_by('pk'):
+        last[shift.status] = shift
+    return [last.get(s) for s in statuses]
@@ -0,0 +1,94 @@
+"""Forecast the demand of the items to suggest what to produce.
+
+Sales are seasonal (they spike before the local festivities), so the monthly
+series of the whole catalog give a seasonal index per calendar month that
+scales the recent sales level of each item.
+"""
+
+from collections import defaultdict
+from datetime import date
+from math import ceil
+
+from django.db import models
+from django.db.models.functions import TruncMonth
+
+from . import settings
+from .models import Item, OrderItem
+
+
+def add_months(day, months):
+    """Get the first day of the month that is months away from day."""
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def monthly_sales(items=None, months=None):
+    """Get the monthly invoiced sales of the items.
+
+    Returns the first month of the series and a dict of item pk to the qty
+    sold on each of the last months (oldest first, current month excluded),
+    from a single grouped query.
+    """
+    months = months or settings.FORECAST_HISTORY
+    end = date.today().replace(day=1)
+    start = add_months(end, -months)
+    sales = OrderItem.objects.filter(
+        reference__status='9', reference__delivery__gte=start,
+        reference__delivery__lt=end)
+    sales = sales.exclude(reference__customer__name__iexact='trapuzarrak')
+    if items is not None:
+        sales = sales.filter(element__in=items)
+    sales = sales.annotate(month=TruncMonth('reference__delivery'))
+    sales = sales.order_by().values('element', 'month').annotate(
+        total=models.Sum('qty'))
+
+    series = defaultdict(lambda: [0] * months)
+    for row in sales:
+        month = (row['month'].year - start.year) * 12 + (
+            row['month'].month - start.month)
+        series[row['element']][month] += row['total']
+    return start, series
+
+
+def seasonal_index(start, series):
+    """Get the weight of each calendar month on the sales of the catalog.
+
+    Returns a list of 12 factors (january first) averaging 1, all of them 1
+    when there are no sales.
+    """
+    totals = [0] * 12
+    for sold in series.values():
+        for month, qty in enumerate(sold):
+            totals[(start.month - 1 + month) % 12] += qty
+    mean = sum(totals) / 12
+    return [total / mean if mean else 1 for total in totals]
+
+
+def reorder_suggestions(items=None):
+    """Suggest the qty to produce of each item (and size).
+
+    The level of an item is its average monthly sales over the last year.
+    Scaled by the seasonal index of the next FORECAST_HORIZON months it gives
+    the expected demand, and what stock doesn't cover is suggested. Foreign
+    items are not produced. Returns a list of dicts (item, forecast &
+    suggested qty) sorted by suggested qty, in two queries.
+    """
+    if items is None:
+        items = Item.objects.all()
+    items = items.exclude(name='Predeterminado').filter(foreing=False)
+    start, series = monthly_sales(items)
+    index = seasonal_index(start, series)
+    season = sum(index[(date.today().month - 1 + month) % 12]
+                 for month in range(settings.FORECAST_HORIZON))
+
+    suggestions = list()
+    for item in items.filter(pk__in=list(series)):
+        forecast = sum(series[item.pk][-12:]) / 12 * season
+        suggested = ceil(round(forecast - item.stocked, 6))
+        if suggested > 0:
+            suggestions.append({
+                'item': item,
+                'forecast': round(forecast, 1),
+                'suggested': suggested, })
+    return sorted(suggestions, key=lambda s: (
+        -s['suggested'], s['item'].name, s['item'].size))
@@ -0,0 +1,53 @@
+"""Time the pages that render a label per item row."""
+
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+
+from orders.utils import item_label
+from orders.views import CommonContexts
+
+
+class Command(BaseCommand):
+    """Render the stock manager & production queue lists several times.
+
+    Each page is timed with the label memo emptied before every render (as
+    every label used to be rendered) and with the memo already warm.
+    """
+
+    help = 'Time the stock manager & production queue renders.'
+
+    PAGES = (
+        ('stock manager', 'includes/stock_tabs.html',
+         CommonContexts.stock_tabs),
+        ('production queue', 'includes/pqueue_list.html',
+         CommonContexts.pqueue),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Renders averaged per page (default 5).')
+
+    def handle(self, *args, **options):
+        repeat = max(options['repeat'], 1)
+        for name, template, context in self.PAGES:
+            cold = self.measure(template, context, repeat, clear=True)
+            warm = self.measure(template, context, repeat, clear=False)
+            self.stdout.write('{}: {:.1f}ms cold, {:.1f}ms memoized'.format(
+                name, cold * 1000, warm * 1000))
+
+    @staticmethod
+    def measure(template, context, repeat, clear):
+        """Average the seconds to build the context & render the template."""
+        item_label.cache_clear()
+        render_to_string(template, context())  # warm the template loader
+        elapsed = 0
+        for _ in range(repeat):
+            if clear:
+                item_label.cache_clear()
+            start = perf_counter()
+            render_to_string(template, context())
+            elapsed += perf_counter() - start
+        return elapsed / repeat
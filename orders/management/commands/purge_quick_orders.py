@@ -0,0 +1,33 @@
+"""Delete the express orders abandoned before invoicing them."""
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from orders import settings
+from orders.services import purge_quick_orders
+
+
+class Command(BaseCommand):
+    """Purge the abandoned express orders giving their stock back.
+
+    Order.save() used to do it on every write, so it's meant to be scheduled
+    instead (say, hourly from cron).
+    """
+
+    help = 'Delete the express orders abandoned before invoicing them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, default=settings.QUICK_ORDER_TIMEOUT,
+            help='Minutes since the express orders were opened.')
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.QUICK_PURGE_BATCH,
+            help='Orders deleted per transaction.')
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(minutes=options['older_than'])
+        purged = purge_quick_orders(before, options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            '{} express order(s) purged.'.format(purged)))
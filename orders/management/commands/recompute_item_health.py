@@ -0,0 +1,54 @@
+"""Refresh the sales figures & the health of the items."""
+
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from orders.models import Item
+from orders.services import recompute_item_health
+
+
+class Command(BaseCommand):
+    """Recompute total_sales, year_sales & health for the whole catalog.
+
+    With --benchmark, the former per item save() refresh is timed as well
+    (and rolled back) to compare both.
+    """
+
+    help = 'Recompute the sales figures & the health of the items.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--benchmark', action='store_true',
+            help='Also time the per item save() refresh for comparison.')
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            with transaction.atomic():
+                elapsed, queries = self.measure(
+                    lambda: [i.save() for i in Item.objects.all()])
+                self.stdout.write(
+                    'Item.save() loop: {:.3f}s, {} queries'.format(
+                        elapsed, queries))
+                transaction.set_rollback(True)
+
+        updated = list()
+        elapsed, queries = self.measure(
+            lambda: updated.append(recompute_item_health()))
+        if options['benchmark']:
+            self.stdout.write(
+                'recompute_item_health(): {:.3f}s, {} queries'.format(
+                    elapsed, queries))
+        self.stdout.write(self.style.SUCCESS(
+            '{} item(s) updated.'.format(updated[0])))
+
+    @staticmethod
+    def measure(func):
+        """Time the function and count the queries it performs."""
+        with CaptureQueriesContext(connection) as ctx:
+            start = perf_counter()
+            func()
+            elapsed = perf_counter() - start
+        return elapsed, len(ctx.captured_queries)
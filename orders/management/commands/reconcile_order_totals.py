@@ -0,0 +1,38 @@
+"""Rebuild the cached amounts of the orders."""
+
+from django.core.management.base import BaseCommand
+
+from orders.models import Order
+
+
+class Command(BaseCommand):
+    """Report the orders whose cached amounts drifted and rebuild them.
+
+    Cached amounts are kept current by OrderItem & CashFlowIO writes, but bulk
+    operations (like deleting from the admin view) skip those hooks.
+    """
+
+    help = 'Rebuild the cached total & paid amounts of the orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report the drift without rebuilding the amounts.')
+
+    def handle(self, *args, **options):
+        drift = Order.objects.with_drift().order_by('pk')
+        for order in drift:
+            self.stdout.write(
+                'Order {}: total {} (cached {}), paid {} (cached {})'.format(
+                    order.pk, order.real_total, order.cached_total,
+                    order.real_paid, order.cached_paid))
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('No drift found.'))
+        elif options['dry_run']:
+            self.stdout.write('{} order(s) drifted.'.format(len(drift)))
+        else:
+            Order.objects.filter(
+                pk__in=[o.pk for o in drift]).update_totals()
+            self.stdout.write(self.style.SUCCESS(
+                '{} order(s) rebuilt.'.format(len(drift))))
@@ -0,0 +1,39 @@
+"""Verify the stock of the items against their movements."""
+
+from django.core.management.base import BaseCommand
+
+from orders.models import Item
+
+
+class Command(BaseCommand):
+    """Report the items whose stock doesn't match the movements ledger.
+
+    Stock is kept by StockMovement.objects.move(), but bulk operations (like
+    editing from the admin list) skip the ledger. Unless --dry-run is given,
+    the stock of those items is rebuilt from their movements.
+    """
+
+    help = 'Verify the stock of the items against their movements.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report the drift without rebuilding the stock.')
+
+    def handle(self, *args, **options):
+        drift = Item.objects.stock_drift().order_by('pk')
+        for item in drift:
+            self.stdout.write('Item {}: stocked {} (ledger {})'.format(
+                item.pk, item.stocked, item.ledger_stock))
+
+        if not drift:
+            self.stdout.write(self.style.SUCCESS('Stock matches the ledger.'))
+        elif options['dry_run']:
+            self.stdout.write('{} item(s) drifted.'.format(len(drift)))
+        else:
+            for item in drift:
+                Item.objects.filter(pk=item.pk).update(
+                    stocked=item.ledger_stock)
+            Item.objects.refresh_health(drift)
+            self.stdout.write(self.style.SUCCESS(
+                '{} item(s) rebuilt.'.format(len(drift))))
@@ -1,12 +1,152 @@
 """Define custom managers fro the models."""
 
-from datetime import date
+from datetime import date, timedelta
 
-from django.db import models
+from django.apps import apps
+from django.db import models, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 
 # First, Order managers
-class LiveOrders(models.Manager):
+DECIMAL = models.DecimalField(max_digits=12, decimal_places=2)
+
+
+def items_total():
+    """Sum up the items' prices of the outer order (before discount)."""
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    items = OrderItem.objects.filter(reference=models.OuterRef('pk'))
+    items = items.order_by().values('reference')
+    items = items.annotate(total=models.Sum(
+        models.F('qty') * models.F('price'), output_field=DECIMAL))
+    return Coalesce(
+        models.Subquery(items.values('total'), output_field=DECIMAL),
+        models.Value(0), output_field=DECIMAL)
+
+
+def paid_total():
+    """Sum up the inbound cashflows of the outer order."""
+    CashFlowIO = apps.get_model('orders', 'CashFlowIO')
+    paid = CashFlowIO.objects.filter(order=models.OuterRef('pk'))
+    paid = paid.order_by().values('order')
+    paid = paid.annotate(total=models.Sum('amount'))
+    return Coalesce(
+        models.Subquery(paid.values('total'), output_field=DECIMAL),
+        models.Value(0), output_field=DECIMAL)
+
+
+def items_count(*args, **kwargs):
+    """Count the items of the outer order that match the given filters."""
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    items = OrderItem.objects.filter(
+        *args, reference=models.OuterRef('pk'), **kwargs)
+    items = items.order_by().values('reference')
+    items = items.annotate(count=models.Count('pk'))
+    return Coalesce(
+        models.Subquery(items.values('count'),
+                        output_field=models.IntegerField()),
+        models.Value(0))
+
+
+class OrderQuerySet(models.QuerySet):
+    """Add some shortcuts to order querysets."""
+
+    def with_financials(self):
+        """Annotate the amounts of the orders in a single query.
+
+        Adds the pre-discount total, the discount amount, the already paid
+        amount and the pending amount as correlated subqueries, so items and
+        cashflows don't multiply each other's rows. Order properties read these
+        values (when present) instead of the cached columns.
+        """
+        pre_discount, already_paid = items_total(), paid_total()
+        discount_amount = models.ExpressionWrapper(
+            pre_discount * models.F('discount') / 100, output_field=DECIMAL)
+
+        return self.annotate(
+            fin_total_pre_discount=pre_discount,
+            fin_discount_amount=discount_amount,
+            fin_already_paid=already_paid,
+            fin_pending=models.ExpressionWrapper(
+                pre_discount - discount_amount - already_paid,
+                output_field=DECIMAL),
+        )
+
+    def with_kanban_data(self):
+        """Annotate the data kanban cards show in a single query.
+
+        Joins the customer and adds the number of items, the missing times of
+        the trackeable items and whether the order has comments, so rendering
+        a card performs no further queries.
+        """
+        zero = timedelta(0)
+        trackeable = models.Q(stock=False) & models.Q(element__foreing=False)
+        Comment = apps.get_model('orders', 'Comment')
+        comments = Comment.objects.filter(reference=models.OuterRef('pk'))
+        return self.select_related('customer').annotate(
+            items_count=items_count(),
+            missing_crop=items_count(trackeable, crop=zero),
+            missing_sewing=items_count(trackeable, sewing=zero),
+            missing_iron=items_count(trackeable, iron=zero),
+            commented=models.Exists(comments),
+        )
+
+    def with_drift(self):
+        """Get the orders whose cached amounts don't match the real ones."""
+        orders = self.annotate(
+            real_total=items_total(), real_paid=paid_total())
+        return orders.exclude(
+            cached_total=models.F('real_total'),
+            cached_paid=models.F('real_paid'))
+
+    def update_totals(self):
+        """Rebuild the cached amounts of the orders in a single UPDATE.
+
+        Amounts show up in the kanban cards, so their version is bumped too.
+        """
+        return self.update(
+            cached_total=items_total(), cached_paid=paid_total(),
+            kanban_version=models.F('kanban_version') + 1)
+
+    def bump_version(self):
+        """Invalidate the cached kanban cards of the orders."""
+        return self.update(kanban_version=models.F('kanban_version') + 1)
+
+    def release_items(self):
+        """Delete the items of the orders giving back the stock they took.
+
+        Follows OrderItem.delete(): items in stock, foreign ones and the ones
+        of express orders return their qty. Qtys are summed per item in one
+        grouped query and given back at once, the items are deleted in bulk
+        and the time stats of their elements rebuilt, all in a transaction
+        and in a constant number of queries. Returns the elements affected.
+        """
+        OrderItem = apps.get_model('orders', 'OrderItem')
+        StockMovement = apps.get_model('orders', 'StockMovement')
+        ItemTimeStats = apps.get_model('orders', 'ItemTimeStats')
+        items = OrderItem.objects.filter(
+            reference__in=self.order_by().values('pk')).order_by()
+
+        with transaction.atomic(using=self.db):
+            elements = set(items.values_list('element', flat=True))
+            if not elements:
+                return elements
+            returned = items.filter(
+                models.Q(stock=True) | models.Q(element__foreing=True) |
+                models.Q(reference__ref_name='Quick'))
+            StockMovement.objects.give_back(dict(
+                returned.values_list('element').annotate(models.Sum('qty'))),
+                'D')
+            items.delete()
+            ItemTimeStats.objects.rebuild(items=elements)
+        return elements
+
+
+class OrderManager(models.Manager.from_queryset(OrderQuerySet)):
+    """Get all the orders (default manager)."""
+
+
+class LiveOrders(OrderManager):
     """Get the active orders (all)."""
 
     def get_queryset(self):
@@ -18,7 +158,7 @@ class LiveOrders(models.Manager):
         return live_orders.exclude(customer__name__iexact='express')
 
 
-class OutdatedOrders(models.Manager):
+class OutdatedOrders(OrderManager):
     """Get the overdue orders."""
 
     def get_queryset(self):
@@ -28,7 +168,7 @@ class OutdatedOrders(models.Manager):
         return orders.exclude(status__in=[7, 8, 9])
 
 
-class ObsoleteOrders(models.Manager):
+class ObsoleteOrders(OrderManager):
     """Get the express orders that don't have invoice."""
 
     def get_queryset(self):
@@ -38,6 +178,303 @@ class ObsoleteOrders(models.Manager):
         return orders.filter(invoice__isnull=True)
 
 
+class ItemTimeStatsManager(models.Manager):
+    """Keep the tracked times of the items current."""
+
+    PHASES = ('crop', 'sewing', 'iron', )
+
+    def tracked(self, items=None):
+        """Aggregate the tracked times of the items from their order items.
+
+        For each phase, sum the times and the quantities of the order items
+        that tracked it (the ones with times other than 0).
+        """
+        OrderItem = apps.get_model('orders', 'OrderItem')
+        zero = timedelta(0)
+        aggregates = dict()
+        for phase in self.PHASES:
+            tracked = ~models.Q(**{phase: zero})
+            aggregates[phase + '_total'] = Coalesce(
+                models.Sum(phase, filter=tracked), models.Value(zero))
+            aggregates[phase + '_qty'] = Coalesce(
+                models.Sum('qty', filter=tracked), models.Value(0))
+
+        rows = OrderItem.objects.order_by()
+        if items is not None:
+            rows = rows.filter(element__in=items)
+        return rows.values('element').annotate(**aggregates)
+
+    def rebuild(self, items=None):
+        """Rebuild the stats of the items (all by default) from scratch."""
+        stats = [self.model(item_id=row.pop('element'), **row)
+                 for row in self.tracked(items)]
+        if items is None:
+            self.all().delete()
+        else:
+            self.filter(item__in=items).delete()
+        self.bulk_create(stats)
+
+    def track(self, item, removed=None, added=None):
+        """Apply the times of an order item that was removed and/or added.
+
+        Both are dicts with qty, crop, sewing & iron. Stats are updated in
+        place with a single UPDATE; missing ones are rebuilt.
+        """
+        deltas = dict()
+        for phase in self.PHASES:
+            deltas.update({phase + '_total': timedelta(0), phase + '_qty': 0})
+        for sign, values in ((-1, removed), (1, added)):
+            for phase in self.PHASES:
+                if values and values[phase]:
+                    deltas[phase + '_total'] += sign * values[phase]
+                    deltas[phase + '_qty'] += sign * values['qty']
+        deltas = {f: d for f, d in deltas.items() if d}
+        if not deltas:
+            return
+
+        updated = self.filter(item=item).update(
+            **{f: models.F(f) + d for f, d in deltas.items()})
+        if not updated:
+            self.rebuild(items=[item])
+
+
+class ItemQuerySet(models.QuerySet):
+    """Add bulk operations to the item querysets."""
+
+    def recompute_health(self):
+        """Refresh the sales figures & the health of the items.
+
+        Mirrors Item.save() reading the sales of every item in a single
+        grouped query and writing only the items whose figures changed with a
+        bulk update. Returns the number of items updated.
+        """
+        OrderItem = apps.get_model('orders', 'OrderItem')
+        sold = models.Q(order_item__reference__status='9') & ~models.Q(
+            order_item__reference__customer__name__iexact='trapuzarrak')
+        last_year = date.today() - timedelta(days=365)
+        regular = OrderItem.objects.filter(element=models.OuterRef('pk'))
+        regular = regular.exclude(reference__ref_name='Quick')
+
+        items = self.order_by().annotate(
+            sales_all=models.Sum('order_item__qty', filter=sold & models.Q(
+                order_item__reference__delivery__gte=date(2018, 1, 1))),
+            sales_year=models.Sum('order_item__qty', filter=sold & models.Q(
+                order_item__reference__delivery__gte=last_year)),
+            regular=models.Exists(regular))
+
+        health_field = self.model._meta.get_field('health')
+        changed = list()
+        for item in items:
+            total_sales = item.sales_all or 0
+            year_sales = item.sales_year or 0
+            health = round(health_field.to_python(self.model.get_health(
+                year_sales, item.stocked, item.regular)), 2)
+            if (item.total_sales, item.year_sales, item.health) != (
+                    total_sales, year_sales, health):
+                item.total_sales, item.year_sales = total_sales, year_sales
+                item.health = health
+                changed.append(item)
+
+        self.model.objects.bulk_update(
+            changed, ['total_sales', 'year_sales', 'health'], batch_size=500)
+        return len(changed)
+
+    def with_ledger(self):
+        """Annotate the stock the items should have after their movements."""
+        StockMovement = apps.get_model('orders', 'StockMovement')
+        ledger = StockMovement.objects.filter(item=models.OuterRef('pk'))
+        ledger = ledger.order_by().values('item').annotate(
+            total=models.Sum('qty')).values('total')
+        return self.annotate(ledger_stock=Coalesce(
+            models.Subquery(ledger, output_field=models.IntegerField()),
+            models.Value(0)))
+
+    def stock_drift(self):
+        """Get the items whose stock doesn't match their movements."""
+        return self.with_ledger().exclude(stocked=models.F('ledger_stock'))
+
+
+class ItemManager(models.Manager.from_queryset(ItemQuerySet)):
+    """Get all the items (default manager)."""
+
+    def refresh_health(self, items):
+        """Recompute the health of the items once the transaction commits.
+
+        Items (or pks) scheduled within the same transaction are gathered in
+        the set of its single on commit callback. Rolled back transactions
+        discard the callback along with its set, so their items don't leak
+        into the next one. Outside transactions they are refreshed right
+        away.
+        """
+        connection = transaction.get_connection(self.db)
+        pks = {getattr(item, 'pk', item) for item in items}
+        refresh = getattr(connection, 'item_health_refresh', None)
+        queued = [func for _, func in connection.run_on_commit]
+        if refresh in queued:
+            refresh.pending.update(pks)
+            return
+
+        def refresh():
+            if refresh.pending:
+                self.filter(pk__in=list(refresh.pending)).recompute_health()
+
+        refresh.pending = pks
+        connection.item_health_refresh = refresh
+        transaction.on_commit(refresh, using=self.db)
+
+
+class StockMovementManager(models.Manager):
+    """Write the stock movements along with the stock of their items."""
+
+    def move(self, item, qty, reason, order_item=None):
+        """Add qty (negative to take) to the stock of the item & record it.
+
+        The stock is updated with an F() expression and the movement is
+        written in the same transaction, so concurrent movements don't lose
+        updates. The item health is refreshed on commit. Taking more than the
+        stock available writes nothing and returns None, otherwise returns the
+        movement.
+        """
+        Item = apps.get_model('orders', 'Item')
+        items = Item.objects.filter(pk=getattr(item, 'pk', item))
+        if qty < 0:
+            items = items.filter(stocked__gte=-qty)
+
+        with transaction.atomic(using=self.db):
+            if not items.update(stocked=models.F('stocked') + qty):
+                return None
+            movement = self.create(
+                item_id=getattr(item, 'pk', item), qty=qty, reason=reason,
+                order_item=order_item)
+
+        if isinstance(item, Item):
+            item.refresh_from_db(fields=['stocked'])
+        Item.objects.refresh_health([item])
+        return movement
+
+    def give_back(self, deltas, reason):
+        """Return the qtys to the stock of the items & record them at once.
+
+        deltas maps item pks to the (positive) qty returned. All the stocks
+        are written with a single UPDATE and the movements with a single
+        INSERT, whatever the number of items. Returns the movements.
+        """
+        Item = apps.get_model('orders', 'Item')
+        deltas = {pk: qty for pk, qty in deltas.items() if qty}
+        if any(qty < 0 for qty in deltas.values()):
+            raise ValueError('Only positive qtys can be given back.')
+        if not deltas:
+            return list()
+
+        stocked = models.Case(
+            *[models.When(pk=pk, then=models.F('stocked') + qty)
+              for pk, qty in deltas.items()],
+            output_field=models.IntegerField())
+        with transaction.atomic(using=self.db):
+            Item.objects.filter(pk__in=deltas).update(stocked=stocked)
+            movements = self.bulk_create([
+                self.model(item_id=pk, qty=qty, reason=reason)
+                for pk, qty in deltas.items()])
+
+        Item.objects.refresh_health(deltas)
+        return movements
+
+
+class InvoiceCounterManager(models.Manager):
+    """Hand out the invoice numbers."""
+
+    def allocate(self, fiscal_year):
+        """Take the next invoice number of the fiscal year.
+
+        The counter row is locked (SELECT ... FOR UPDATE) until the calling
+        transaction ends, so concurrent invoices get consecutive numbers and a
+        rolled back invoice gives its number back. Call it within the
+        transaction that writes the invoice.
+        """
+        with transaction.atomic(using=self.db):
+            self.get_or_create(fiscal_year=fiscal_year)
+            counter = self.select_for_update().get(fiscal_year=fiscal_year)
+            counter.last_no += 1
+            counter.save(update_fields=['last_no'])
+        return counter.last_no
+
+
+class StatusShiftManager(models.Manager):
+    """Open & close the status shifts of the orders."""
+
+    def shift(self, order):
+        """Close the open shift of the order and open one for its status.
+
+        That's an UPDATE of the open shift (found by the order's pointer) and
+        the INSERT of the new one, so no shift is looked up. Invoiced orders
+        (status 9) get their shift closed at once. Return the new shift.
+        """
+        now = timezone.now()
+        with transaction.atomic(using=self.db):
+            if order.current_shift_id:
+                open_shift = self.filter(pk=order.current_shift_id)
+            else:
+                open_shift = self.filter(order=order)
+            open_shift.filter(date_out__isnull=True).update(date_out=now)
+            shift = self.model(
+                order=order, status=order.status, date_in=now,
+                date_out=now if order.status == '9' else None)
+            shift.save(force_save=True)
+        return shift
+
+
+class PQueueQuerySet(models.QuerySet):
+    """Filter the production queue."""
+
+    def active(self):
+        """Return the elements still in the queue (positive scores)."""
+        return self.filter(score__gt=0)
+
+    def live(self):
+        """Return the elements whose orders are neither delivered nor gone."""
+        return self.exclude(item__reference__status__in=[7, 8, 9])
+
+
+class PQueueManager(models.Manager.from_queryset(PQueueQuerySet)):
+    """Keep the active scores of the production queue spaced."""
+
+    def rebalance(self, gap):
+        """Respace the active scores gap apart in a single bulk update."""
+        with transaction.atomic(using=self.db):
+            return self._respace(list(self.active()), gap)
+
+    def reorder(self, queue, pks, gap):
+        """Put the elements of queue in the order of pks in one bulk update.
+
+        pks must list every element of queue exactly once, otherwise
+        ValueError is raised and nothing is written.
+        """
+        with transaction.atomic(using=self.db):
+            elements = queue.select_for_update(of=('self', )).in_bulk()
+            if len(pks) != len(elements) or set(pks) != set(elements):
+                raise ValueError('The ordering doesn\'t match the queue')
+            return self._respace([elements[pk] for pk in pks], gap)
+
+    def _respace(self, elements, gap):
+        """Score the given elements gap apart in the order they come.
+
+        Scores are unique and postgres checks them row by row, so the new
+        scores are taken from a range that doesn't overlap the active ones:
+        below them when there's room, above them otherwise.
+        """
+        if not elements:
+            return 0
+        bounds = self.active().aggregate(
+            low=models.Min('score'), high=models.Max('score'))
+        start = 0
+        if bounds['low'] <= len(elements) * gap:
+            start = bounds['high']
+        for n, element in enumerate(elements, start=1):
+            element.score = start + n * gap
+        self.bulk_update(elements, ['score'])
+        return len(elements)
+
+
 class ActiveItems(models.Manager):
     """Get the active items (excluding tz ones)."""
 
@@ -0,0 +1,47 @@
+# Generated by Django 3.0.8 on 2026-10-17 01:59
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def fill_totals(apps, schema_editor):
+    """Compute the cached amounts for the existing orders."""
+    Order = apps.get_model('orders', 'Order')
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    CashFlowIO = apps.get_model('orders', 'CashFlowIO')
+    decimal = models.DecimalField(max_digits=12, decimal_places=2)
+
+    items = OrderItem.objects.filter(reference=models.OuterRef('pk'))
+    items = items.order_by().values('reference').annotate(total=models.Sum(
+        models.F('qty') * models.F('price'), output_field=decimal))
+    paid = CashFlowIO.objects.filter(order=models.OuterRef('pk'))
+    paid = paid.order_by().values('order').annotate(
+        total=models.Sum('amount'))
+
+    Order.objects.update(
+        cached_total=Coalesce(
+            models.Subquery(items.values('total'), output_field=decimal), 0),
+        cached_paid=Coalesce(
+            models.Subquery(paid.values('total'), output_field=decimal), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0089_auto_20200109_1835'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='cached_paid',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='cached_total',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.RunPython(fill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-17 02:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0090_order_cached_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='kanban_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
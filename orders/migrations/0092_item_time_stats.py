@@ -0,0 +1,48 @@
+# Generated by Django 3.0.8 on 2026-10-17 02:24
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import Coalesce
+
+
+def fill_stats(apps, schema_editor):
+    """Compute the time stats for the existing items."""
+    OrderItem = apps.get_model('orders', 'OrderItem')
+    ItemTimeStats = apps.get_model('orders', 'ItemTimeStats')
+    zero = datetime.timedelta(0)
+
+    aggregates = dict()
+    for phase in ('crop', 'sewing', 'iron', ):
+        tracked = ~models.Q(**{phase: zero})
+        aggregates[phase + '_total'] = Coalesce(
+            models.Sum(phase, filter=tracked), models.Value(zero))
+        aggregates[phase + '_qty'] = Coalesce(
+            models.Sum('qty', filter=tracked), models.Value(0))
+    rows = OrderItem.objects.order_by().values('element')
+    ItemTimeStats.objects.bulk_create([
+        ItemTimeStats(item_id=row.pop('element'), **row)
+        for row in rows.annotate(**aggregates)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0091_order_kanban_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemTimeStats',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='time_stats', serialize=False, to='orders.Item')),
+                ('crop_total', models.DurationField(default=datetime.timedelta(0))),
+                ('crop_qty', models.IntegerField(default=0)),
+                ('sewing_total', models.DurationField(default=datetime.timedelta(0))),
+                ('sewing_qty', models.IntegerField(default=0)),
+                ('iron_total', models.DurationField(default=datetime.timedelta(0))),
+                ('iron_qty', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.0.8 on 2026-10-17 02:48
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def open_ledger(apps, schema_editor):
+    """Record the current stock of the items as their first movement."""
+    Item = apps.get_model('orders', 'Item')
+    StockMovement = apps.get_model('orders', 'StockMovement')
+    StockMovement.objects.bulk_create([
+        StockMovement(item_id=pk, qty=stocked, reason='A')
+        for pk, stocked in Item.objects.filter(
+            stocked__gt=0).values_list('pk', 'stocked')])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0092_item_time_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('qty', models.IntegerField(verbose_name='Cantidad')),
+                ('reason', models.CharField(choices=[('S', 'Venta'), ('D', 'Devolución'), ('P', 'Producción'), ('A', 'Ajuste')], max_length=1, verbose_name='Motivo')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='orders.Item')),
+                ('order_item', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='orders.OrderItem')),
+            ],
+            options={
+                'ordering': ('created', 'pk'),
+            },
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
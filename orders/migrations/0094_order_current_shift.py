@@ -0,0 +1,29 @@
+# Generated by Django 3.0.8 on 2026-10-17 03:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def point_current_shift(apps, schema_editor):
+    """Point every order to its latest status shift."""
+    Order = apps.get_model('orders', 'Order')
+    StatusShift = apps.get_model('orders', 'StatusShift')
+    latest = StatusShift.objects.filter(
+        order=models.OuterRef('pk')).order_by('-pk').values('pk')[:1]
+    Order.objects.update(current_shift=models.Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0093_stock_movements'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='current_shift',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='orders.StatusShift'),
+        ),
+        migrations.RunPython(point_current_shift, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.8 on 2026-10-17 03:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0094_order_current_shift'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', '7'), ('ref_name__iexact', 'quick')), fields=['inbox_date'], name='order_quick_purge_idx'),
+        ),
+    ]
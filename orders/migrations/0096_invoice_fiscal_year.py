@@ -0,0 +1,60 @@
+# Generated by Django 3.0.8 on 2026-10-17 09:12
+
+from django.db import migrations, models
+from django.db.models.functions import ExtractYear
+
+
+def number_per_fiscal_year(apps, schema_editor):
+    """Set the fiscal year of the invoices & resume their numbers from there.
+
+    Issued numbers are kept as they are, so each year goes on from its last.
+    """
+    Invoice = apps.get_model('orders', 'Invoice')
+    InvoiceCounter = apps.get_model('orders', 'InvoiceCounter')
+    Invoice.objects.update(fiscal_year=ExtractYear('issued_on'))
+    last = Invoice.objects.order_by().values('fiscal_year').annotate(
+        last_no=models.Max('invoice_no'))
+    InvoiceCounter.objects.bulk_create([
+        InvoiceCounter(fiscal_year=row['fiscal_year'], last_no=row['last_no'])
+        for row in last])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0095_order_quick_purge_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceCounter',
+            fields=[
+                ('fiscal_year', models.PositiveSmallIntegerField(primary_key=True, serialize=False)),
+                ('last_no', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='invoice',
+            name='fiscal_year',
+            field=models.PositiveSmallIntegerField(editable=False, null=True, verbose_name='Ejercicio'),
+        ),
+        migrations.RunPython(number_per_fiscal_year, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='invoice',
+            name='fiscal_year',
+            field=models.PositiveSmallIntegerField(editable=False, verbose_name='Ejercicio'),
+        ),
+        migrations.AlterField(
+            model_name='invoice',
+            name='invoice_no',
+            field=models.IntegerField(verbose_name='Factura no.'),
+        ),
+        migrations.AlterModelOptions(
+            name='invoice',
+            options={'ordering': ['-fiscal_year', '-invoice_no']},
+        ),
+        migrations.AddConstraint(
+            model_name='invoice',
+            constraint=models.UniqueConstraint(fields=('fiscal_year', 'invoice_no'), name='invoice_no_per_fiscal_year'),
+        ),
+    ]
@@ -4,17 +4,17 @@ Its intended use is for business related to tailor made clothes.
 """
 
 import io
+from collections import Counter, defaultdict
 from datetime import date, timedelta
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
-from django.template.loader import render_to_string
 
 from . import managers, settings
-from .utils import WeekColor, prettify_times
+from .utils import WeekColor, item_label, prettify_times
 from decouple import config
 
 from todoist.api import TodoistAPI
@@ -98,8 +98,13 @@ class Customer(models.Model):
             if c0.exists():
                 self.cp = c0.first().cp
 
+        adding = self._state.adding
         super().save(*args, **kwargs)
 
+        # Kanban cards show the customer name
+        if not adding:
+            Order.objects.filter(customer=self).bump_version()
+
     def email_name(self):
         """Get first name in lower case and properly capitalized."""
         return self.name.lower().split()[0].capitalize()
@@ -167,12 +172,40 @@ class Order(models.Model):
         default=0)
     discount = models.PositiveSmallIntegerField('Descuento %', default=0)
 
+    """Denormalized amounts: the items' sum (before discount) and the paid
+    amount. OrderItem & CashFlowIO keep them current, and
+    `manage.py reconcile_order_totals` rebuilds them."""
+    cached_total = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0, editable=False)
+    cached_paid = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0, editable=False)
+
+    """Bumped whenever the kanban card of the order changes, so rendered cards
+    can be cached under it."""
+    kanban_version = models.PositiveIntegerField(default=0, editable=False)
+    CACHED_FIELDS = ('cached_total', 'cached_paid', 'kanban_version', )
+
+    """The open status shift, so shifting the status doesn't look it up. Only
+    written when the status changes."""
+    current_shift = models.ForeignKey(
+        'StatusShift', blank=True, null=True, on_delete=models.SET_NULL,
+        related_name='+', editable=False)
+
     # Custom managers
-    objects = models.Manager()
+    objects = managers.OrderManager()
     live = managers.LiveOrders()
     outdated = managers.OutdatedOrders()
     obsolete = managers.ObsoleteOrders()
 
+    class Meta:
+        indexes = [
+            # Express orders left behind, see services.purge_quick_orders()
+            models.Index(
+                fields=['inbox_date'], name='order_quick_purge_idx',
+                condition=(models.Q(status='7') &
+                           models.Q(ref_name__iexact='quick'))),
+        ]
+
     def __str__(self):
         """Object's representation."""
         return '%s %s %s' % (self.pk,
@@ -191,55 +224,156 @@ class Order(models.Model):
             raise ValidationError({'discount': _(msg)})
 
     def save(self, *args, **kwargs):
-        """Override save method."""
-        # delete all the express orders that are open but not invoiced
-        deprecated = Order.objects.filter(
-            status='7').filter(ref_name__iexact='quick').exclude(pk=self.pk)
-        if deprecated.exists():
-            for order in deprecated:
-                order.delete()
+        """Override save method.
+
+        Only the fields changed since the order was loaded are written, and
+        the checks run just when the fields they read changed. Saving an
+        unchanged order writes nothing.
+        """
+        adding = self._state.adding or self.pk is None
+        dirty = self.dirty_fields
 
         # ensure invoiced orders are in status 9
-        try:
-            self.invoice
-        except ObjectDoesNotExist:
-            pass
-        else:
-            self.status = '9'
+        check = not adding and 'status' in dirty and self.status != '9'
+        if self.side_effect('invoice_check', check):
+            try:
+                self.invoice
+            except ObjectDoesNotExist:
+                pass
+            else:
+                self.status = '9'
 
         # ensure trapuzarrak is always Confirmed
-        if self.customer and self.customer.name.lower() == 'trapuzarrak':
-            self.confirmed = True
+        check = adding or dirty & {'customer', 'confirmed'}
+        if self.side_effect('customer_check', check):
+            if self.customer and self.customer.name.lower() == 'trapuzarrak':
+                self.confirmed = True
 
         # ensure membership field is a group customer
-        if self.membership and not self.membership.group:
-            self.membership = None
+        check = adding or 'membership' in dirty
+        if self.side_effect('membership_check', check):
+            if self.membership and not self.membership.group:
+                self.membership = None
 
         # Since 2020 statuses 4 & 5 are deprecated so redirect them to status 3
         if self.status in ('4', '5'):
             self.status = '3'
 
-        super().save(*args, **kwargs)
+        # Cached fields are only written by update_totals() & bump_version(),
+        # so stale instances can't overwrite them. The rest are written when
+        # they change.
+        fields = kwargs.get('update_fields')
+        if not adding and fields is None:
+            fields = kwargs['update_fields'] = sorted(self.dirty_fields)
+        if not self.side_effect('write', adding or fields):
+            return
 
-        """After saving, add a new StatusShift (will be created only if status
-        has changed)"""
-        StatusShift.objects.create(order=self, status=self.status)
+        # Status shifts are only written when the status changes
+        shifted = adding or 'status' in fields and self.status_changed
+        if self.side_effect('status_shift', shifted) and not adding:
+            kwargs['update_fields'] = list(fields) + ['current_shift']
+
+        with transaction.atomic():
+            if shifted and not adding:
+                self.current_shift = StatusShift.objects.shift(self)
+
+            super().save(*args, **kwargs)
+
+            if adding:
+                # Cloned orders still point to the shift of the original one
+                self.current_shift = None
+                self.current_shift = StatusShift.objects.shift(self)
+                Order.objects.filter(pk=self.pk).update(
+                    current_shift=self.current_shift)
+        self._loaded = self.tracked_values()
+
+        if not adding:
+            self.bump_version()
+
+    """Times each side effect of save() ran or was skipped, per process, for
+    monitoring (see API/order-save-stats)."""
+    save_stats = Counter()
+
+    @classmethod
+    def side_effect(cls, name, run):
+        """Count the side effect as run or skipped and tell whether to run."""
+        cls.save_stats['{}:{}'.format(name, 'run' if run else 'skipped')] += 1
+        return bool(run)
+
+    @classmethod
+    def tracked_fields(cls):
+        """Get the fields whose changes are tracked to save them."""
+        return [f for f in cls._meta.concrete_fields
+                if not f.primary_key and f.name not in cls.CACHED_FIELDS and
+                f.name != 'current_shift']
+
+    def tracked_values(self):
+        """Get the current value of the tracked fields loaded."""
+        return {f.name: self.__dict__[f.attname]
+                for f in self.tracked_fields() if f.attname in self.__dict__}
+
+    @property
+    def dirty_fields(self):
+        """Get the names of the fields changed since the order was loaded.
+
+        Orders not loaded from the db have all their fields dirty.
+        """
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None:
+            return {f.name for f in self.tracked_fields()}
+        current = self.tracked_values()
+        return {name for name, value in current.items()
+                if name not in loaded or loaded[name] != value}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Keep the values loaded to tell the fields changed on save."""
+        order = super().from_db(db, field_names, values)
+        order._loaded = order.tracked_values()
+        return order
+
+    def refresh_from_db(self, *args, **kwargs):
+        """Keep the values loaded to tell the fields changed on save."""
+        super().refresh_from_db(*args, **kwargs)
+        fields = kwargs.get('fields', args[1] if len(args) > 1 else None)
+        if fields is None:
+            self._loaded = self.tracked_values()
+        elif getattr(self, '_loaded', None) is not None:
+            self._loaded.update({
+                name: value for name, value in self.tracked_values().items()
+                if name in fields})
+
+    @property
+    def status_changed(self):
+        """Tell whether the status differs from the stored one.
+
+        Orders loaded from the db compare with the loaded status, so no query
+        is needed. Otherwise, the status of the open shift is fetched.
+        """
+        loaded = getattr(self, '_loaded', None)
+        if loaded is not None and 'status' in loaded:
+            return loaded['status'] != self.status
+        loaded = StatusShift.objects.filter(
+            pk=self.current_shift_id).values_list(
+                'status', flat=True).first()
+        return loaded != self.status
 
     def delete(self, *args, **kwargs):
         """Override delete method.
 
-        Ensure stock qtys are returned to the store by deleting individual
-        items since CASCADE does not call items.delete()
+        Ensure stock qtys are returned to the store since CASCADE does not
+        call items.delete(). See services.delete_orders() for many orders.
         """
-        for i in self.items.all():
-            i.delete()
-        super().delete(*args, **kwargs)
+        with transaction.atomic():
+            Order.objects.filter(pk=self.pk).release_items()
+            return super().delete(*args, **kwargs)
 
     def kill(self, pay_method='C'):
         """Kill the order.
 
         Kill is the only entry point for invoicing orders. It sets the last
-        state an order should have.
+        state an order should have. The db writes run in a transaction, so
+        the health of the items is refreshed once on commit.
         """
         # Avoid killed orders to be rekilled
         try:
@@ -249,25 +383,29 @@ class Order(models.Model):
         else:
             exit
 
-        # If there are pending payments, kill'em
-        if self.pending:
-            CashFlowIO.objects.create(
-                order=self, amount=self.pending, pay_method=pay_method)
-
-        """
-        Only shifting up to status 7 with kanban_forward updates the
-        delivery date, so update it if we're delayed (like for express orders).
-        """
-        if self.status != '7':
-            self.deliver()  # Creates status shift
-
-        # Set status to 9 (invoiced)
-        self.status = '9'
-        self.save()  # Also creates status shift and closes it
+        with transaction.atomic():
+            # If there are pending payments, kill'em
+            self.refresh_totals()
+            if self.pending:
+                CashFlowIO.objects.create(
+                    order=self, amount=self.pending, pay_method=pay_method)
+
+            """
+            Only shifting up to status 7 with kanban_forward updates the
+            delivery date, so update it if we're delayed (like for express
+            orders).
+            """
+            if self.status != '7':
+                self.deliver()  # Creates status shift
+
+            # Set status to 9 (invoiced)
+            self.status = '9'
+            self.save()  # Also creates status shift and closes it
 
-        # And issue the invoice
-        i = Invoice(reference=self, pay_method=pay_method, amount=self.total)
-        i.save(kill=True)
+            # And issue the invoice
+            i = Invoice(
+                reference=self, pay_method=pay_method, amount=self.total)
+            i.save(kill=True)
 
         # Finally archive the project in todoist
         self.archive()
@@ -299,15 +437,19 @@ class Order(models.Model):
     @property
     def discount_amount(self):
         """Get the amount in € of the discount."""
+        if hasattr(self, 'fin_discount_amount'):
+            return float(self.fin_discount_amount)
         return self.total_pre_discount * self.discount / 100
 
     @property
     def total_pre_discount(self):
-        """Undo the discount in the total."""
-        items = self.items.aggregate(
-            total=models.Sum(models.F('qty') * models.F('price'),
-                             output_field=models.DecimalField()))
-        return float(items['total']) if items['total'] else 0
+        """Undo the discount in the total.
+
+        Orders fetched through `with_financials()` already carry the amount.
+        """
+        if hasattr(self, 'fin_total_pre_discount'):
+            return float(self.fin_total_pre_discount)
+        return float(self.cached_total)
 
     @property
     def total_bt(self):
@@ -322,16 +464,15 @@ class Order(models.Model):
     @property
     def already_paid(self):
         """Collect the total amount paid by the order."""
-        cf = CashFlowIO.inbounds.filter(order=self)
-        prepaid = cf.aggregate(total=models.Sum('amount'))
-        if not prepaid['total']:
-            return 0
-        else:
-            return float(prepaid['total'])
+        if hasattr(self, 'fin_already_paid'):
+            return float(self.fin_already_paid)
+        return float(self.cached_paid)
 
     @property
     def pending(self):
         """Get the pending amount of the order."""
+        if hasattr(self, 'fin_pending'):
+            return round(float(self.fin_pending), 2)
         return round(self.total - self.already_paid, 2)
 
     @property
@@ -358,6 +499,8 @@ class Order(models.Model):
     @property
     def has_no_items(self):
         """Determine if the order has no items."""
+        if hasattr(self, 'items_count'):
+            return not self.items_count
         items = OrderItem.objects.filter(reference=self)
         if not items:
             return True
@@ -366,8 +509,14 @@ class Order(models.Model):
 
     @property
     def has_comments(self):
-        """Determine if the order has comments."""
-        return Comment.objects.filter(reference=self)
+        """Determine if the order has comments.
+
+        Orders fetched through `with_kanban_data()` skip the query when they
+        have none, and the comments can be prefetched for the rest.
+        """
+        if hasattr(self, 'commented') and not self.commented:
+            return Comment.objects.none()
+        return self.comment_set.all()
 
     @property
     def times(self):
@@ -381,6 +530,12 @@ class Order(models.Model):
     @property
     def missing_times(self):
         """Count how many of the trackeable times are still missing."""
+        if hasattr(self, 'missing_crop'):
+            if not self.items_count:
+                return False
+            return (self.missing_crop, self.missing_sewing,
+                    self.missing_iron, )
+
         zero = timedelta(0)
         if not self.items.exists():
             return False
@@ -413,22 +568,50 @@ class Order(models.Model):
             ti=models.Sum('iron'), )
         return time['tc'] + time['ts'] + time['ti']
 
+    def bump_version(self):
+        """Invalidate the cached kanban card of the order."""
+        Order.objects.filter(pk=self.pk).bump_version()
+
+    def update_totals(self):
+        """Rebuild the cached amounts after its items or payments change."""
+        Order.objects.filter(pk=self.pk).update_totals()
+        self.refresh_from_db(fields=self.CACHED_FIELDS)
+
+    def refresh_totals(self):
+        """Reload the cached amounts from the db.
+
+        Items & payments written through other instances of the order only
+        refresh those, so read them before moving money. Amounts annotated
+        by `with_financials()` are dropped as they may be stale too.
+        """
+        for name in ('fin_total_pre_discount', 'fin_discount_amount',
+                     'fin_already_paid', 'fin_pending', ):
+            self.__dict__.pop(name, None)
+        # refresh_from_db() would also drop the cached relations (invoice)
+        self.__dict__.update(Order.objects.filter(pk=self.pk).values(
+            *self.CACHED_FIELDS).get())
+
     def deliver(self):
         """Deliver the order and update the date.
 
         Deliver is the last stage for tz orders. It can't be undone to ensure
-        that items are added to stock once.
+        that items are added to stock once. It runs in a transaction, so the
+        health of the items is refreshed once on commit.
         """
         self.status = '7'
         self.delivery = date.today()
 
-        # Add items to stock
-        if self.tz:
-            for i in self.items.all():
-                i.element.stocked += i.qty
-                i.element.save()
+        with transaction.atomic():
+            # Add items to stock
+            items = self.items.order_by().values('element')
+            items = items.annotate(total=models.Sum('qty'))
+            if self.tz:
+                for i in items:
+                    StockMovement.objects.move(i['element'], i['total'], 'P')
 
-        return self.save()
+            saved = self.save()
+            Item.objects.refresh_health(i['element'] for i in items)
+        return saved
 
     def kanban_forward(self):
         """Shift to the next kanban stage.
@@ -577,6 +760,9 @@ class Item(models.Model):
     health = models.DecimalField(
         max_digits=5, decimal_places=2, default=0, editable=False, )
 
+    # Custom managers
+    objects = managers.ItemManager()
+
     def __str__(self):
         """Object's representation."""
         return '{} {} {}-{} ({}€)'.format(
@@ -610,20 +796,9 @@ class Item(models.Model):
         self.year_sales = self.sales(period=timedelta(days=365))
 
         # Estimate health
-        avg_sales = self.year_sales / 12  # month averaged
-        if avg_sales == 0 and self.stocked == 0:
-            self.health = - 100
-        elif avg_sales == 0 and self.stocked > 0:
-            self.health = - self.stocked
-        else:
-            self.health = self.stocked / avg_sales
-
-        # Add more health to regular orders' items
-        if self.order_item.exclude(reference__ref_name='Quick').exists():
-            self.health += 300
-
-        if self.health > 999.99:
-            self.health = 999
+        regular = self.order_item.exclude(
+            reference__ref_name='Quick').exists()
+        self.health = self.get_health(self.year_sales, self.stocked, regular)
 
         # Uppercase size
         self.size = self.size.upper()
@@ -632,7 +807,63 @@ class Item(models.Model):
         if self.stocked < 0:
             self.stocked = 0
 
-        super().save(*args, **kwargs)
+        # Stock is a projection of the movements, so edits are written as
+        # movements instead of overwriting what others may have moved
+        adding = self._state.adding
+        loaded = getattr(self, '_loaded_stocked', None)
+        stock_delta = self.stocked - loaded if loaded is not None else 0
+        if not adding:
+            fields = kwargs.get('update_fields') or [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key]
+            kwargs['update_fields'] = [f for f in fields if f != 'stocked']
+
+        msg = 'El stock ha cambiado, ya no quedan tantas prendas.'
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+            if adding and self.stocked:
+                StockMovement.objects.create(
+                    item=self, qty=self.stocked, reason='A')
+            elif not adding and stock_delta:
+                if not StockMovement.objects.move(self, stock_delta, 'A'):
+                    raise ValidationError({'stocked': _(msg)})
+        self._loaded_stocked = self.stocked
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Keep the stock loaded to tell the edits made on the instance."""
+        item = super().from_db(db, field_names, values)
+        item._loaded_stocked = item.__dict__.get('stocked')
+        return item
+
+    def refresh_from_db(self, *args, **kwargs):
+        """Keep the stock loaded to tell the edits made on the instance."""
+        super().refresh_from_db(*args, **kwargs)
+        self._loaded_stocked = self.__dict__.get('stocked')
+
+    @staticmethod
+    def get_health(year_sales, stocked, regular):
+        """Estimate the health out of the year sales & the stock.
+
+        Items that appear in regular orders (not only in quick ones) get 300
+        extra points.
+        """
+        avg_sales = year_sales / 12  # month averaged
+        if avg_sales == 0 and stocked == 0:
+            health = - 100
+        elif avg_sales == 0 and stocked > 0:
+            health = - stocked
+        else:
+            health = stocked / avg_sales
+
+        # Add more health to regular orders' items
+        if regular:
+            health += 300
+
+        if health > 999.99:
+            health = 999
+        return health
 
     def sales(self, period='all_time'):
         """Return the sales in the selected period.
@@ -660,64 +891,57 @@ class Item(models.Model):
 
         Siblings are the items that differ in size while sharing type & name.
         This method is applied on CRUD actions throughput the app but on admin
-        view to have some control.
+        view to have some control. Returns the pks of the siblings changed.
+        Foreign items don't track times, so the kanban cards of the orders
+        holding the changed ones are invalidated.
         """
         siblings = Item.objects.filter(
             name=self.name, item_type=self.item_type)
+        changed = siblings.filter(foreing=False).filter(
+            models.Exists(siblings.filter(foreing=True)))
+        changed = list(changed.values_list('pk', flat=True))
 
-        if siblings.filter(foreing=True).exists():
-            for s in siblings:
-                s.foreing = True
-                s.save()
+        if changed:
+            Item.objects.filter(pk__in=changed).update(foreing=True)
+            Order.objects.filter(pk__in=OrderItem.objects.filter(
+                element__in=changed).values('reference')).bump_version()
+            Item.objects.refresh_health(changed)
+        return changed
 
     @property
     def html_string(self):
-        """Render the item string for views."""
-        context = {'type': self.get_item_type_display(),
-                   'name': self.name,
-                   'class': self.get_item_class_display(),
-                   'size': self.size, }
-        return render_to_string('includes/item_string.html', context)
+        """Render the item string for views (memoized by its contents)."""
+        return item_label(self.get_item_type_display(), self.name,
+                          self.get_item_class_display(), self.size)
+
+    @property
+    def avg_times(self):
+        """Average the times to crop, sew & iron the item.
+
+        Read from the item's time stats in a single lookup.
+        """
+        stats = ItemTimeStats.objects.filter(item=self).first()
+        return stats.averages if stats else (timedelta(0), ) * 3
 
     @property
     def avg_crop(self):
         """Average the time to crop the item."""
-        crop = OrderItem.objects.filter(element=self)
-        crop = crop.exclude(crop=timedelta(0))
-        crop = crop.aggregate(
-            total=models.Sum('crop'),
-            qtys=models.Sum('qty'), )
-
-        return crop['total'] / crop['qtys'] if crop['qtys'] else timedelta(0)
+        return self.avg_times[0]
 
     @property
     def avg_sewing(self):
         """Average the time to sew the item."""
-        t0 = timedelta(0)
-        sewing = OrderItem.objects.filter(element=self)
-        sewing = sewing.exclude(sewing=t0)
-        sewing = sewing.aggregate(
-            total=models.Sum('sewing'),
-            qtys=models.Sum('qty'), )
-
-        return sewing['total'] / sewing['qtys'] if sewing['qtys'] else t0
+        return self.avg_times[1]
 
     @property
     def avg_iron(self):
         """Average the time to iron the item."""
-        iron = OrderItem.objects.filter(element=self)
-        iron = iron.exclude(iron=timedelta(0))
-        iron = iron.aggregate(
-            total=models.Sum('iron'),
-            qtys=models.Sum('qty'), )
-
-        return iron['total'] / iron['qtys'] if iron['qtys'] else timedelta(0)
+        return self.avg_times[2]
 
     @property
     def pretty_avg(self):
         """Prettify the average times for views."""
-        avgs = (self.avg_crop, self.avg_sewing, self.avg_iron)
-        return [prettify_times(a.total_seconds()) for a in avgs]
+        return [prettify_times(a.total_seconds()) for a in self.avg_times]
 
     @property
     def production(self):
@@ -763,8 +987,14 @@ class OrderItem(models.Model):
     objects = models.Manager()
     active = managers.ActiveItems()
 
+    TIME_STATS_FIELDS = ('element', 'qty', 'crop', 'sewing', 'iron', )
+
     def save(self, *args, **kwargs):
         """Override the save method."""
+        prev = None
+        if self.pk:
+            prev = OrderItem.objects.filter(pk=self.pk).values(
+                *self.TIME_STATS_FIELDS).first()
 
         # Ensure that items with times are at least in status 3
         times = (self.crop or self.sewing or self.iron)
@@ -781,6 +1011,15 @@ class OrderItem(models.Model):
             self.fit = False
 
         super().save(*args, **kwargs)
+        self.reference.update_totals()
+        self.update_time_stats(prev)
+
+        # Movements of new items were recorded before they had a pk
+        if getattr(self, '_stock_movements', None):
+            StockMovement.objects.filter(
+                pk__in=self._stock_movements, order_item__isnull=True).update(
+                order_item=self)
+            self._stock_movements = list()
 
     def delete(self, *args, **kwargs):
         """Override delete method.
@@ -788,15 +1027,40 @@ class OrderItem(models.Model):
         On delete, ensure the qty goes back to the store for the affected
         members.
         """
+        prev = self.time_stats_values()
         affected = (
             self.stock or self.element.foreing or
             self.reference.ref_name == 'Quick'
         )
         if affected:
-            self.element.stocked += self.qty
-            self.element.save()
+            StockMovement.objects.move(self.element, self.qty, 'D')
 
         super().delete(*args, **kwargs)
+        self.reference.update_totals()
+        ItemTimeStats.objects.track(prev['element'], removed=prev)
+
+    def time_stats_values(self):
+        """Get the values of the fields that feed the item time stats."""
+        values = {'element': self.element_id, 'qty': self.qty, }
+        for phase in ('crop', 'sewing', 'iron', ):
+            value = getattr(self, phase)
+            if not isinstance(value, timedelta):  # like strings or times
+                value = self._meta.get_field(phase).to_python(str(value))
+            values[phase] = value
+        return values
+
+    def update_time_stats(self, prev=None):
+        """Apply the changes of the times on the item time stats.
+
+        prev holds the values the item had on the db (if any).
+        """
+        cur = self.time_stats_values()
+        if prev == cur:
+            return
+        if prev and prev['element'] != cur['element']:
+            ItemTimeStats.objects.track(prev['element'], removed=prev)
+            prev = None
+        ItemTimeStats.objects.track(cur['element'], removed=prev, added=cur)
 
     def clean(self):
         """Define custom validators."""
@@ -840,6 +1104,7 @@ class OrderItem(models.Model):
             self.stock = False
 
         # Affected members should return their qty back to the store
+        deltas = defaultdict(int)
         try:
             prev = OrderItem.objects.get(pk=self.pk)
         except ObjectDoesNotExist:
@@ -850,7 +1115,7 @@ class OrderItem(models.Model):
                 self.reference.ref_name == 'Quick'
             )
             if affected:
-                self.element.stocked += prev.qty
+                deltas[prev.element_id] += prev.qty
 
         # Affected members recover their stock from the store
         affected = (
@@ -858,14 +1123,22 @@ class OrderItem(models.Model):
             self.reference.ref_name == 'Quick'
         )
         if affected:
-            self.element.stocked -= self.qty
-
-        if self.element.stocked < 0:
-            msg = (
-                'Estás intentando añadir más prendas de las que tienes.')
-            raise ValidationError({'qty': _(msg)})
-        else:
-            self.element.save()
+            deltas[self.element_id] -= self.qty
+
+        # Apply the movements (returns first) all or none
+        msg = 'Estás intentando añadir más prendas de las que tienes.'
+        self._stock_movements = list()
+        with transaction.atomic():
+            for item, qty in sorted(deltas.items(), key=lambda d: -d[1]):
+                if not qty:
+                    continue
+                if item == self.element_id:
+                    item = self.element
+                movement = StockMovement.objects.move(
+                    item, qty, 'S', order_item=self if self.pk else None)
+                if not movement:
+                    raise ValidationError({'qty': _(msg)})
+                self._stock_movements.append(movement.pk)
 
     @property
     def time_quality(self):
@@ -898,12 +1171,8 @@ class OrderItem(models.Model):
     @property
     def estimated_time(self):
         """Return the estimated time in seconds to produce the item."""
-        item = self.element
-        times = (
-            (item.avg_crop * self.qty).total_seconds(),
-            (item.avg_sewing * self.qty).total_seconds(),
-            (item.avg_iron * self.qty).total_seconds(), )
-        return times
+        return tuple(
+            (avg * self.qty).total_seconds() for avg in self.element.avg_times)
 
     @property
     def prettified_est(self):
@@ -927,6 +1196,69 @@ class OrderItem(models.Model):
         return ticket_str
 
 
+class StockMovement(models.Model):
+    """Record every change on the stock of the items.
+
+    Item.stocked is the sum of the movements of the item. Movements are
+    written with `StockMovement.objects.move()`, which updates both at once.
+    """
+
+    item = models.ForeignKey(
+        Item, on_delete=models.CASCADE, related_name='stock_movements')
+    qty = models.IntegerField('Cantidad')
+    reason = models.CharField(
+        'Motivo', max_length=1, choices=settings.STOCK_REASONS)
+    order_item = models.ForeignKey(
+        OrderItem, on_delete=models.SET_NULL, blank=True, null=True,
+        related_name='stock_movements')
+    created = models.DateTimeField(default=timezone.now)
+
+    objects = managers.StockMovementManager()
+
+    class Meta:
+        ordering = ('created', 'pk', )
+
+    def __str__(self):
+        """Object's representation."""
+        return '{} {:+d} ({})'.format(
+            self.item_id, self.qty, self.get_reason_display())
+
+
+class ItemTimeStats(models.Model):
+    """Keep the tracked times of each item so averaging them is quick.
+
+    For each phase, store the sum of the tracked times and the sum of the
+    quantities of the order items that tracked them. OrderItem writes keep
+    them current, and `ItemTimeStats.objects.rebuild()` recomputes them.
+    """
+
+    item = models.OneToOneField(
+        Item, on_delete=models.CASCADE, primary_key=True,
+        related_name='time_stats')
+    crop_total = models.DurationField(default=timedelta(0))
+    crop_qty = models.IntegerField(default=0)
+    sewing_total = models.DurationField(default=timedelta(0))
+    sewing_qty = models.IntegerField(default=0)
+    iron_total = models.DurationField(default=timedelta(0))
+    iron_qty = models.IntegerField(default=0)
+
+    objects = managers.ItemTimeStatsManager()
+
+    def __str__(self):
+        """Object's representation."""
+        return 'Time stats for {}'.format(self.item_id)
+
+    @property
+    def averages(self):
+        """Get the average times to crop, sew & iron the item."""
+        avgs = list()
+        for phase in ItemTimeStats.objects.PHASES:
+            total = getattr(self, phase + '_total')
+            qty = getattr(self, phase + '_qty')
+            avgs.append(total / qty if qty else timedelta(0))
+        return tuple(avgs)
+
+
 class Comment(models.Model):
     """Store the comments related to the orders."""
 
@@ -942,6 +1274,16 @@ class Comment(models.Model):
                 ', ' + str(self.user) + ' comentó en ' + str(self.reference))
         return name
 
+    def save(self, *args, **kwargs):
+        """Override save method."""
+        super().save(*args, **kwargs)
+        self.reference.bump_version()
+
+    def delete(self, *args, **kwargs):
+        """Override delete method."""
+        super().delete(*args, **kwargs)
+        self.reference.bump_version()
+
 
 class PQueue(models.Model):
     """Create a production queue."""
@@ -950,6 +1292,8 @@ class PQueue(models.Model):
                                 primary_key=True)
     score = models.IntegerField(unique=True, blank=True, null=True)
 
+    objects = managers.PQueueManager()
+
     class Meta:
         """Meta options."""
 
@@ -963,80 +1307,79 @@ class PQueue(models.Model):
 
     def save(self, *args, **kwargs):
         """Override the save method."""
-        # Set score if none
+        # Set score if none, to the bottom
         if self.score is None:
-            highest = PQueue.objects.last()
-            if not highest or highest.score < 0:
-                self.score = 1000
-            else:
-                self.score = highest.score + 1
+            highest = PQueue.objects.active().exclude(pk=self.pk).last()
+            highest = highest.score if highest else 0
+            self.score = highest + settings.PQUEUE_GAP
 
-        # Set score if 0
+        # Set score if 0, to the top
         elif self.score == 0:
-            score_1 = PQueue.objects.filter(score=1)
-            if score_1.exists():
-                for item in PQueue.objects.reverse():
-                    item.score = item.score + 1
-                    item.save()
-                self.score = 1
+            first = PQueue.objects.active().exclude(pk=self.pk).first()
+            if not first:
+                self.score = settings.PQUEUE_GAP
+            elif first.score == 1:
+                PQueue.objects.rebalance(settings.PQUEUE_GAP)
+                return self.save(*args, **kwargs)
             else:
-                self.score = 1
+                self.score = first.score // 2
         super().save(*args, **kwargs)
 
+    def _place(self, above, below):
+        """Set the score between the two given ones and save the element.
+
+        below=None means the bottom. When there's no room between them, the
+        queue is respaced and False is returned so the caller can look up the
+        neighbours again.
+        """
+        if below is None:
+            self.score = above + settings.PQUEUE_GAP
+        elif below - above > 1:
+            self.score = (above + below) // 2
+        else:
+            PQueue.objects.rebalance(settings.PQUEUE_GAP)
+            self.refresh_from_db(fields=['score'])
+            return False
+        self.clean()
+        self.save()
+        return True
+
     def top(self):
         """Raise the current item to the top."""
-        prev_elements = PQueue.objects.filter(score__gt=0)
-        prev_elements = prev_elements.filter(score__lt=self.score)
-        if not prev_elements:
+        prev_elements = PQueue.objects.active().filter(score__lt=self.score)
+        first = prev_elements.first()
+        if not first:
             return
-        else:
-            self.score = prev_elements.first().score - 1
-            self.clean()
-            self.save()
-            return True
+        return self._place(0, first.score) or self.top()
 
     def up(self):
         """Raise one position the element in the list."""
-        above_elements = PQueue.objects.filter(score__lt=self.score)
-        if not above_elements:
+        above_elements = PQueue.objects.active().filter(score__lt=self.score)
+        above = list(above_elements.reverse()[:2].values_list(
+            'score', flat=True))
+        if not above:
             return
-        elif above_elements.count() == 1:
-            return self.top()
-        else:
-            closest, next = above_elements.reverse()[:2]
-            if closest.score - next.score > 1:
-                self.score = closest.score - 1
-                self.clean()
-                self.save()
-                return True
-            else:
-                closest.score = -1
-                self.clean()
-                closest.save()
-                self.score = next.score + 1
-                self.save()
-                closest.score = next.score + 2
-                closest.save()
-                return True
+        above.append(0)
+        closest, next = above[:2]
+        return self._place(next, closest) or self.up()
 
     def down(self):
         """Lower one position the element in the list."""
-        next_elements = PQueue.objects.filter(score__gt=self.score)
-        if not next_elements:
+        next_elements = PQueue.objects.active().filter(score__gt=self.score)
+        below = list(next_elements[:2].values_list('score', flat=True))
+        if not below:
             return
-        else:
-            return next_elements[0].up()
+        below.append(None)
+        closest, after = below[:2]
+        return self._place(closest, after) or self.down()
 
     def bottom(self):
         """Lower to the bottom."""
-        next_elements = PQueue.objects.filter(score__gt=self.score)
-        if not next_elements:
+        next_elements = PQueue.objects.active().filter(score__gt=self.score)
+        last = next_elements.last()
+        if not last:
             return
-        else:
-            self.score = next_elements.last().score + 1
-            self.clean()
-            self.save()
-            return True
+        return self._place(last.score, None)
 
     def complete(self):
         """Complete an item."""
@@ -1051,8 +1394,8 @@ class PQueue(models.Model):
 
     def uncomplete(self):
         """Send the item again to list."""
-        if PQueue.objects.count() == 1:
-            self.score = 1000
+        if not PQueue.objects.active().exists():
+            self.score = settings.PQUEUE_GAP
             self.clean()
             self.save()
             return True
@@ -1066,7 +1409,8 @@ class Invoice(models.Model):
     reference = models.OneToOneField(
         Order, on_delete=models.CASCADE, primary_key=True)
     issued_on = models.DateTimeField(default=timezone.now)
-    invoice_no = models.IntegerField('Factura no.', unique=True)
+    fiscal_year = models.PositiveSmallIntegerField('Ejercicio', editable=False)
+    invoice_no = models.IntegerField('Factura no.')
     amount = models.DecimalField(
         'Importe con IVA', max_digits=7, decimal_places=2)
     pay_method = models.CharField(
@@ -1081,18 +1425,32 @@ class Invoice(models.Model):
 
         self.clean()  # first, run custom validators
 
-        """Ensure that the invoices are consecutive starting at 1 while keeping
-        their original value (if any)."""
-        if not self.invoice_no:
-            newest = Invoice.objects.first()
-            if not newest:
-                self.invoice_no = 1
-            else:
-                self.invoice_no = newest.invoice_no + 1
-
+        self.reference.refresh_totals()
         self.amount = self.reference.total  # Get the total
 
-        super().save(*args, **kwargs)
+        """Ensure that the invoices are consecutive starting at 1 each fiscal
+        year while keeping their original value (if any). The number is taken
+        in the transaction that writes the invoice, so concurrent invoices
+        wait for each other and failed ones don't leave gaps."""
+        with transaction.atomic():
+            if not self.invoice_no:
+                issued_on = self.issued_on
+                if timezone.is_aware(issued_on):
+                    issued_on = timezone.localtime(issued_on)
+                self.fiscal_year = issued_on.year
+                self.invoice_no = InvoiceCounter.objects.allocate(
+                    self.fiscal_year)
+                try:
+                    super().save(*args, **kwargs)
+                except Exception:
+                    self.invoice_no = None  # It's been given back
+                    raise
+            else:
+                super().save(*args, **kwargs)
+
+        # Invoiced items account for sales
+        Item.objects.refresh_health(
+            self.reference.items.values_list('element', flat=True))
 
     def clean(self):
         """Custom validators."""
@@ -1205,7 +1563,29 @@ class Invoice(models.Model):
     class Meta():
         """Meta options."""
 
-        ordering = ['-invoice_no']
+        ordering = ['-fiscal_year', '-invoice_no']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['fiscal_year', 'invoice_no'],
+                name='invoice_no_per_fiscal_year'),
+        ]
+
+
+class InvoiceCounter(models.Model):
+    """Keep the last invoice number issued on each fiscal year.
+
+    Numbers are taken with `InvoiceCounter.objects.allocate()`, which locks
+    the row of the year so invoices are numbered one after the other.
+    """
+
+    fiscal_year = models.PositiveSmallIntegerField(primary_key=True)
+    last_no = models.IntegerField(default=0)
+
+    objects = managers.InvoiceCounterManager()
+
+    def __str__(self):
+        """Object's representation."""
+        return '{}: {}'.format(self.fiscal_year, self.last_no)
 
 
 class ExpenseCategory(models.Model):
@@ -1315,16 +1695,21 @@ class CashFlowIO(models.Model):
         super().save(*args, **kwargs)
         if self.expense:
             self.expense.save()  # Update closed attr (if any)
+        if self.order:
+            self.order.update_totals()
 
     def delete(self, *args, **kwargs):
         """Ensure expenses are reopened after deleting one of their cashflows.
 
-        Notice that bulk delete in admin view skips this method.
+        Also refresh the paid amount of the order. Notice that bulk delete in
+        admin view skips this method.
         """
-        e = self.expense  # Fetch the element before deleting its cf
+        e, o = self.expense, self.order  # Fetch them before deleting the cf
         super().delete(*args, **kwargs)
         if e:
             e.save()  # updates the closed attr
+        if o:
+            o.update_totals()
 
     def clean(self):
         """Custom validation parameters."""
@@ -1413,6 +1798,8 @@ class StatusShift(models.Model):
     status = models.CharField(max_length=1, choices=Order.STATUS, default='1')
     notes = models.TextField(blank=True, null=True)
 
+    objects = managers.StatusShiftManager()
+
     def save(self, force_save=False, *args, **kwargs):
         """Override the save method.
 
@@ -1420,7 +1807,7 @@ class StatusShift(models.Model):
         constraint, so a force_save arg is provided.
         """
         # Direct save the first one
-        if not self.last or force_save:
+        if force_save or not self.last:
             return super().save(*args, **kwargs)
 
         # Before  opening a new statusShift close the last one (forces save).
@@ -1435,7 +1822,8 @@ class StatusShift(models.Model):
             self.date_out = timezone.now()
 
         # print('status changed', self.status)
-        return super().save(*args, **kwargs)
+        super().save(*args, **kwargs)
+        Order.objects.filter(pk=self.order_id).update(current_shift=self)
 
     def delete(self, clear_all=False, *args, **kwargs):
         """Override the delete method.
@@ -1462,6 +1850,7 @@ class StatusShift(models.Model):
         last = self.last
         last.date_out = None
         last.save(force_save=True)
+        Order.objects.filter(pk=self.order_id).update(current_shift=last)
 
     def clean(self):
         """Validate the model."""
@@ -4,6 +4,7 @@ from datetime import date, timedelta
 from orders.models import (
     Customer, Order, Item, CashFlowIO, Comment, Expense, Invoice,
     OrderItem, StatusShift, Timetable)
+from orders.services import recompute_item_health
 
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -148,7 +149,7 @@ def populate():
             i.save(kill=True)
 
         # Update Item health
-        [i.save() for i in Item.objects.all()]
+        recompute_item_health()
 
         # Expend some money somewhere
         providers = Customer.objects.filter(provider=True)
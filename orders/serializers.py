@@ -90,3 +90,49 @@ class TimetableSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Timetable
         fields = '__all__'
+
+
+class ReceivableSerializer(serializers.Serializer):
+    """Define the serializer for the pending amounts of orders."""
+
+    pk = serializers.IntegerField()
+    customer = serializers.CharField()
+    ref_name = serializers.CharField()
+    delivery = serializers.DateField()
+    pending = serializers.DecimalField(max_digits=12, decimal_places=2)
+
+
+class ReorderSuggestionSerializer(serializers.Serializer):
+    """Define the serializer for the suggested production of the items."""
+
+    pk = serializers.IntegerField(source='item.pk')
+    name = serializers.CharField(source='item.name')
+    item_type = serializers.CharField(source='item.get_item_type_display')
+    size = serializers.CharField(source='item.size')
+    stocked = serializers.IntegerField(source='item.stocked')
+    forecast = serializers.FloatField()
+    suggested = serializers.IntegerField()
+
+
+class LeadTimeSerializer(serializers.Serializer):
+    """Define the serializer for the time spent on each status."""
+
+    group = serializers.CharField()
+    status = serializers.CharField()
+    count = serializers.IntegerField()
+    p50 = serializers.DurationField()
+    p75 = serializers.DurationField()
+    p90 = serializers.DurationField()
+
+
+class PQueueETASerializer(serializers.Serializer):
+    """Define the serializer for the expected finish of the queue items."""
+
+    pk = serializers.IntegerField()
+    order = serializers.IntegerField()
+    customer = serializers.CharField()
+    item = serializers.CharField()
+    delivery = serializers.DateField()
+    estimated = serializers.FloatField()
+    eta = serializers.DateTimeField(allow_null=True)
+    late = serializers.BooleanField()
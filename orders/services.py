@@ -0,0 +1,423 @@
+"""Services that compute business figures over sets of objects at once.
+
+Model properties work on a single object, so looping them over querysets
+performs several queries per object. These services get the same figures for
+the whole set in a constant number of queries.
+"""
+
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from itertools import accumulate
+
+from django.db import models, transaction
+from django.utils import timezone
+
+from . import settings
+from .managers import DECIMAL
+from .models import (
+    Comment, Customer, Item, ItemTimeStats, Order, OrderItem, PQueue,
+    Timetable, )
+
+
+def receivables():
+    """Get the pending amount of the confirmed live orders.
+
+    Trapuzarrak orders are excluded as they are never charged. Returns a dict
+    with the orders that have something pending (pk, customer, ref_name,
+    delivery & pending) and the total amount, all from a single query.
+    """
+    pre_discount = models.F('cached_total')
+    pending = models.ExpressionWrapper(
+        pre_discount - pre_discount * models.F('discount') / 100 -
+        models.F('cached_paid'), output_field=DECIMAL)
+
+    orders = Order.live.exclude(customer__name__iexact='trapuzarrak')
+    orders = orders.filter(confirmed=True).annotate(pending=pending)
+    orders = orders.exclude(pending=0).order_by('delivery', 'pk')
+    orders = list(orders.values(
+        'pk', 'customer__name', 'ref_name', 'delivery', 'pending'))
+
+    for order in orders:
+        order['customer'] = order.pop('customer__name')
+        order['pending'] = round(order['pending'], 2)
+
+    return {'orders': orders, 'total': sum(o['pending'] for o in orders)}
+
+
+def recompute_item_health(items=None):
+    """Refresh the sales figures & the health of the items.
+
+    Items can be a queryset or a list of items or pks (all of them by
+    default). See ItemQuerySet.recompute_health(). Returns the number of items
+    updated.
+    """
+    if items is None:
+        items = Item.objects.all()
+    elif not isinstance(items, models.QuerySet):
+        items = Item.objects.filter(
+            pk__in=[getattr(item, 'pk', item) for item in items])
+    return items.recompute_health()
+
+
+STOCK_TABS = (
+    ('p1', models.Q(health=0)),
+    ('p2', models.Q(health__gt=0, health__lt=1)),
+    ('p3', models.Q(health__gte=1)),
+    ('zero', models.Q(health=-100)),
+    ('negative', models.Q(health__lt=0, health__gt=-100)),
+)
+
+
+def stock_tabs(items=None, after=None):
+    """Get a page of items for each of the stock manager tabs.
+
+    Items (all but the default one by default) are bucketed into the tabs by
+    their health and sorted by health & pk. After is a dict of tab name to
+    the (health, pk) cursor its page starts after. Returns a dict of tab name
+    to its elements, its count and the cursor of its next page (None on the
+    last one), all from a single UNION ALL query.
+    """
+    after = after or dict()
+    size = settings.STOCK_TAB_SIZE
+    if items is None:
+        items = Item.objects.all()
+    items = items.exclude(name='Predeterminado').order_by()
+    items = items.annotate(stock_tab=models.Case(
+        *[models.When(q, then=models.Value(name)) for name, q in STOCK_TABS],
+        output_field=models.CharField()))
+
+    pages = list()
+    for name, _ in STOCK_TABS:
+        tab = items.filter(stock_tab=name)
+        count = tab.values('stock_tab').annotate(
+            total=models.Count('pk')).values('total')
+        page = tab.annotate(tab_count=models.Subquery(
+            count, output_field=models.IntegerField()))
+        if name in after:
+            health, pk = after[name]
+            page = page.filter(models.Q(health__gt=health) | models.Q(
+                health=health, pk__gt=pk))
+        pages.append(page.order_by('health', 'pk')[:size + 1])
+
+    tabs = {name: {'elements': list(), 'count': 0, 'next': None}
+            for name, _ in STOCK_TABS}
+    rows = pages[0].union(*pages[1:], all=True)
+    for item in sorted(rows, key=lambda i: (i.health, i.pk)):
+        tabs[item.stock_tab]['elements'].append(item)
+        tabs[item.stock_tab]['count'] = item.tab_count
+
+    for tab in tabs.values():
+        if len(tab['elements']) > size:
+            tab['elements'] = tab['elements'][:size]
+            last = tab['elements'][-1]
+            tab['next'] = (last.health, last.pk)
+    return tabs
+
+
+KANBAN_COLUMNS = (
+    ('icebox', ('1', )),
+    ('queued', ('2', )),
+    ('in_progress', ('3', '4', '5', )),
+    ('waiting', ('6', )),
+    ('done', ('7', )),
+)
+
+
+def estimate_times(orders):
+    """Estimate the time in seconds to produce each of the given orders.
+
+    Returns a dict of order pk to (crop, sewing, iron) seconds, where orders
+    without items get (0, 0, 0). A single query joins the non-stock items of
+    the orders with their item time stats and groups them.
+    """
+    phases = ItemTimeStats.objects.PHASES
+    stats = ['element__time_stats__{}_{}'.format(phase, field)
+             for phase in phases for field in ('total', 'qty', )]
+    items = OrderItem.objects.filter(reference__in=orders, stock=False)
+    items = items.order_by().values('reference', *stats)
+    items = items.annotate(qtys=models.Sum('qty'))
+
+    estimations = defaultdict(lambda: (0, 0, 0))
+    for row in items:
+        times = list()
+        for phase in phases:
+            total = row['element__time_stats__{}_total'.format(phase)]
+            qty = row['element__time_stats__{}_qty'.format(phase)]
+            avg = total / qty if qty else timedelta(0)
+            times.append((avg * row['qtys']).total_seconds())
+        estimations[row['reference']] = tuple(
+            a + b for a, b in zip(estimations[row['reference']], times))
+    return estimations
+
+
+def kanban_columns(confirmed=True):
+    """Get the (lazy) querysets of the kanban columns.
+
+    Cards carry the kanban data and are sorted by delivery (and pk, so each
+    card has a stable position within its column).
+    """
+    orders = Order.objects.filter(confirmed=confirmed).with_kanban_data()
+    orders = orders.order_by('delivery', 'pk')
+    columns = dict()
+    for name, statuses in KANBAN_COLUMNS:
+        columns[name] = orders.filter(status__in=statuses)
+    # Neither trapuzarrak orders nor express tickets wait to be picked up
+    columns['done'] = columns['done'].exclude(
+        customer__name__iexact='trapuzarrak').exclude(
+        customer__name__iexact='express')
+    return columns
+
+
+def kanban_column(order):
+    """Get the kanban column where the order lives (if any)."""
+    for name, statuses in KANBAN_COLUMNS:
+        if order.status in statuses:
+            customer = order.customer.name.lower() if order.customer else ''
+            if name == 'done' and customer in ('trapuzarrak', 'express'):
+                return None
+            return name
+    return None
+
+
+def kanban_totals(confirmed=True):
+    """Get the header figures of the kanban columns.
+
+    Returns a dict of column name to its number of cards, its amount and its
+    already paid amount (both excluding trapuzarrak orders and, like the done
+    cards, express tickets) and, for icebox & queued, the estimated time in
+    seconds. Amounts & counts come from a single
+    GROUP BY status and times from estimate_times().
+    """
+    tz = models.Q(customer__name__iexact='trapuzarrak')
+    express = models.Q(customer__name__iexact='express')
+    off_board = models.Q(status='7') & (tz | express)
+    total = models.ExpressionWrapper(
+        models.F('cached_total') -
+        models.F('cached_total') * models.F('discount') / 100,
+        output_field=DECIMAL)
+    statuses = [s for _, column in KANBAN_COLUMNS for s in column]
+    rows = Order.objects.filter(confirmed=confirmed, status__in=statuses)
+    rows = rows.order_by().values('status').annotate(
+        count=models.Count('pk', filter=~off_board),
+        total=models.Sum(total, filter=~(tz | off_board)),
+        paid=models.Sum('cached_paid', filter=~(tz | off_board)))
+    rows = {row['status']: row for row in rows}
+
+    totals = dict()
+    for name, column in KANBAN_COLUMNS:
+        column = [rows[s] for s in column if s in rows]
+        totals[name] = {
+            'count': sum(r['count'] for r in column),
+            'amount': float(sum(r['total'] or 0 for r in column)),
+            'already_paid': float(sum(r['paid'] or 0 for r in column)),
+            'est_time': None, }
+
+    # Get times for icebox & queued orders
+    for name, statuses in KANBAN_COLUMNS[:2]:
+        orders = Order.objects.filter(confirmed=confirmed, status__in=statuses)
+        totals[name]['est_time'] = sum(
+            sum(times) for times in estimate_times(orders).values())
+
+    return totals
+
+
+def kanban_board(confirmed=True):
+    """Get the orders and column figures of the kanban view.
+
+    Each column is an evaluated queryset whose cards carry the kanban data,
+    and its comments prefetched, so rendering the board performs no queries.
+    Figures come from kanban_totals(), so the number of queries doesn't
+    depend on the board size.
+    """
+    board = kanban_columns(confirmed=confirmed)
+
+    # Evaluate the columns & fetch all the comments in one go
+    commented = [o for name, _ in KANBAN_COLUMNS for o in board[name]
+                 if o.commented]
+    models.prefetch_related_objects(commented, models.Prefetch(
+        'comment_set', queryset=Comment.objects.order_by('pk')))
+
+    totals = kanban_totals(confirmed=confirmed)
+    names = [name for name, _ in KANBAN_COLUMNS]
+    board.update({
+        'amounts': [totals[name]['amount'] for name in names],
+        'already_paid': [totals[name]['already_paid'] for name in names],
+        'est_times': [totals[name]['est_time'] for name in names[:2]],
+    })
+    return board
+
+
+def kanban_delta(pk):
+    """Get the changes to apply on the kanban board after a card moves.
+
+    Returns the order (with its kanban data), the column it now lives in (if
+    any) with its position there, and the figures of all the columns, all in
+    a constant number of queries.
+    """
+    order = Order.objects.with_kanban_data().get(pk=pk)
+    column, position = kanban_column(order), None
+    if column:
+        previous = models.Q(delivery__lt=order.delivery) | models.Q(
+            delivery=order.delivery, pk__lt=order.pk)
+        position = kanban_columns(order.confirmed)[column].filter(
+            previous).count()
+    return {'order': order,
+            'column': column,
+            'position': position,
+            'totals': kanban_totals(confirmed=order.confirmed), }
+
+
+def workshop_capacity():
+    """Get the worker seconds available per weekday & the ones spent today.
+
+    Capacity is the average of the hours recorded in the timetables of the
+    last ETA_HISTORY_WEEKS weeks, as a dict of python weekday (monday is 0) to
+    seconds. Takes two aggregate queries.
+    """
+    today = date.today()
+    since = today - timedelta(weeks=settings.ETA_HISTORY_WEEKS)
+    rows = Timetable.objects.filter(
+        start__date__gte=since, start__date__lt=today, hours__isnull=False)
+    rows = rows.annotate(weekday=models.functions.ExtractWeekDay('start'))
+    rows = rows.order_by().values('weekday').annotate(
+        total=models.Sum('hours'))
+
+    # ExtractWeekDay goes from sunday (1) to saturday (7)
+    capacity = dict.fromkeys(range(7), 0)
+    for row in rows:
+        capacity[(row['weekday'] + 5) % 7] = (
+            row['total'].total_seconds() / settings.ETA_HISTORY_WEEKS)
+
+    spent = Timetable.objects.filter(start__date=today).aggregate(
+        spent=models.Sum('hours'))['spent']
+    return capacity, spent.total_seconds() if spent else 0
+
+
+def pqueue_eta():
+    """Simulate the production of the active queue to get its finish times.
+
+    Entries are produced in score order, each taking the average times of its
+    item times its qty for the phases not tracked yet. The resulting workload
+    is spread over the workshop capacity from today on, within the workday
+    hours. Returns a list of dicts (pk, order, customer, item, delivery,
+    estimated seconds, eta & late) in a constant number of queries; eta is
+    None when there's no capacity recorded.
+    """
+    phases = ItemTimeStats.objects.PHASES
+    stats = ['item__element__time_stats__{}_{}'.format(phase, field)
+             for phase in phases for field in ('total', 'qty', )]
+    tracked = ['item__{}'.format(phase) for phase in phases]
+    queue = PQueue.objects.filter(score__gt=0).exclude(
+        item__reference__status__in=[7, 8, 9]).order_by('score')
+    queue = queue.values(
+        'pk', 'item__reference', 'item__reference__customer__name',
+        'item__element__name', 'item__reference__delivery', 'item__qty',
+        *tracked, *stats)
+
+    entries = list()
+    for row in queue:
+        estimated = timedelta(0)
+        for phase in phases:
+            if row['item__{}'.format(phase)]:
+                continue  # Already done
+            total = row['item__element__time_stats__{}_total'.format(phase)]
+            qty = row['item__element__time_stats__{}_qty'.format(phase)]
+            if qty:
+                estimated += total / qty * row['item__qty']
+        entries.append({
+            'pk': row['pk'],
+            'order': row['item__reference'],
+            'customer': row['item__reference__customer__name'],
+            'item': row['item__element__name'],
+            'delivery': row['item__reference__delivery'],
+            'estimated': estimated.total_seconds(),
+            'eta': None,
+            'late': False, })
+
+    capacity, spent = workshop_capacity()
+    if not entries or not any(capacity.values()):
+        return entries
+
+    # Walk the days consuming the cumulative workload of the queue
+    start, end = settings.ETA_WORKDAY
+    day, used = date.today(), 0
+    workload = accumulate(e['estimated'] for e in entries)
+    for entry, cumulative in zip(entries, workload):
+        cumulative += spent
+        while used + capacity[day.weekday()] < cumulative or (
+                not capacity[day.weekday()]):
+            used += capacity[day.weekday()]
+            day += timedelta(days=1)
+        share = (cumulative - used) / capacity[day.weekday()]
+        eta = datetime.combine(day, time(start)) + timedelta(
+            hours=(end - start) * share)
+        entry['eta'] = timezone.make_aware(eta)
+        entry['late'] = day > entry['delivery']
+    return entries
+
+
+def delete_orders(orders):
+    """Delete the orders giving back the stock their items took.
+
+    Orders can be a queryset or a list of orders or pks. Instead of deleting
+    each order & item (several queries per item), the stock is given back
+    per item at once and the rows are deleted in bulk (see
+    OrderQuerySet.release_items()) in a single transaction, so the number of
+    queries doesn't depend on the orders. Returns the number of orders
+    deleted.
+    """
+    if not isinstance(orders, models.QuerySet):
+        orders = Order.objects.filter(
+            pk__in=[getattr(order, 'pk', order) for order in orders])
+    with transaction.atomic():
+        pks = list(orders.order_by().values_list('pk', flat=True))
+        orders = Order.objects.filter(pk__in=pks)
+        orders.release_items()
+        orders.delete()
+    return len(pks)
+
+
+def delete_customers(customers):
+    """Delete the customers along with their orders.
+
+    Customers can be a queryset or a list of customers or pks. Their orders
+    are deleted with delete_orders(), so their stock is given back too.
+    Returns the number of customers deleted.
+    """
+    if not isinstance(customers, models.QuerySet):
+        customers = Customer.objects.filter(
+            pk__in=[getattr(customer, 'pk', customer)
+                    for customer in customers])
+    with transaction.atomic():
+        pks = list(customers.order_by().values_list('pk', flat=True))
+        delete_orders(Order.objects.filter(customer__in=pks))
+        Customer.objects.filter(pk__in=pks).delete()
+    return len(pks)
+
+
+def purge_quick_orders(before=None, batch_size=None):
+    """Delete the express orders abandoned before invoicing them.
+
+    Those are the 'quick' orders still delivered (status 7) that were opened
+    before `before` (QUICK_ORDER_TIMEOUT minutes ago by default). Orders are
+    deleted in batches with delete_orders(), each in its own transaction.
+    Returns the number of orders deleted.
+    """
+    if before is None:
+        before = timezone.now() - timedelta(
+            minutes=settings.QUICK_ORDER_TIMEOUT)
+    batch_size = batch_size or settings.QUICK_PURGE_BATCH
+    abandoned = Order.objects.filter(
+        status='7', ref_name__iexact='quick', inbox_date__lt=before)
+
+    purged = 0
+    while True:
+        with transaction.atomic():
+            pks = list(abandoned.order_by('pk').select_for_update(
+                skip_locked=True).values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+
+            delete_orders(Order.objects.filter(pk__in=pks))
+        purged += len(pks)
+    return purged
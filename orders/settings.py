@@ -40,6 +40,14 @@ PAYMENT_METHODS = (
     ('T', 'Transferencia')
 )
 
+# Reasons for the stock movements
+STOCK_REASONS = (
+    ('S', 'Venta'),  # Order items taking (or giving back) stock
+    ('D', 'Devolución'),  # Order items deleted
+    ('P', 'Producción'),  # Trapuzarrak orders delivered
+    ('A', 'Ajuste'),  # Manual edits
+)
+
 STATUS_ICONS = (
     'fa-inbox-in',  # IceBox
     'fa-list-ol',  # Queued
@@ -53,6 +61,36 @@ GOAL = round(89582 / 365, 0)  # ~245€
 
 WEEK_COLORS = dict(this='#28a745', next='#1dddff', in_two='#74f5de')
 
+# Items shown per page on each stock manager tab
+STOCK_TAB_SIZE = 50
+
+# Demand forecast: months of sales history and months ahead to produce for
+FORECAST_HISTORY = 24
+FORECAST_HORIZON = 2
+
+# Months of orders (by inbox date) the status lead times are measured on
+LEAD_TIME_HISTORY = 12
+
+# Distinct item labels (Item.html_string) kept rendered in memory
+ITEM_LABEL_CACHE_SIZE = 4096
+
+# Seconds rendered kanban cards are kept in cache
+KANBAN_CARD_TIMEOUT = 60 * 60 * 24
+
+# Production queue ETA: weeks of timetables averaged to get the workshop
+# capacity and the workday hours (start, end) that capacity is spread over
+ETA_HISTORY_WEEKS = 4
+ETA_WORKDAY = (10, 20)
+
+# Production queue: distance between consecutive scores so an element can be
+# moved writing just its own row (the queue is respaced once it runs out)
+PQUEUE_GAP = 1000
+
+# Express orders purge: minutes an express order can stay delivered but not
+# invoiced before it's taken as abandoned and the orders deleted per batch
+QUICK_ORDER_TIMEOUT = 60
+QUICK_PURGE_BATCH = 200
+
 RELAX_ICONS = ('curling', 'shuttlecock', 'table-tennis', 'coffee-togo',
                'umbrella-beach', 'clipboard-check', )
 
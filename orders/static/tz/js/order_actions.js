@@ -157,7 +157,9 @@ $(function () {
       type: 'post',
       dataType: 'json',
       success: function (data) {
-        if (data.form_is_valid) {
+        if (data.form_is_valid && data.columns) {
+          kanbanDelta(data)
+        } else if (data.form_is_valid) {
           $(data.html_id).html(data.html)
         } else {
           $('#js-errors').html(data.error)
@@ -166,6 +168,26 @@ $(function () {
     })
   }
 
+  var kanbanDelta = function (data) {
+    // Move the card to its new column & refresh the column headers in place
+    $(data.html_id).remove()
+    if (data.column) {
+      var column = $('#kanban-cards-' + data.column)
+      var cards = column.children('.js-kanban')
+      if (data.position < cards.length) {
+        cards.eq(data.position).before(data.html)
+      } else {
+        column.append(data.html)
+      }
+    }
+    $.each(data.columns, function (name, totals) {
+      $('#kanban-count-' + name).html(totals.count)
+      $('#kanban-totals-' + name).html(totals.totals)
+      $('#kanban-empty-' + name).toggleClass('d-none', totals.count > 0)
+    })
+    $('.js-kanban-jump').removeClass('d-none')
+  }
+
   var searchAction = function () {
     var form = $(this)
     $.ajax({
@@ -206,6 +228,38 @@ $(function () {
     })
   }
 
+  // Drag & drop the queue rows and send the whole new order at once
+  var queueDragged = null
+
+  var queueDragStart = function () {
+    queueDragged = this
+  }
+
+  var queueDrop = function (e) {
+    e.preventDefault()
+    if (!queueDragged || queueDragged === this) {
+      return
+    }
+    if ($(queueDragged).index() < $(this).index()) {
+      $(this).after(queueDragged)
+    } else {
+      $(this).before(queueDragged)
+    }
+    queueDragged = null
+    var pks = $('.js-queue-row').map(function () {
+      return $(this).attr('data-pk')
+    }).get()
+    $.ajax({
+      url: '/queue-reorder/',
+      data: $.param({ 'pks': pks }, true),
+      type: 'post',
+      dataType: 'json',
+      success: function (data) {
+        $(data.html_id).html(data.html)
+      }
+    })
+  }
+
   var itemSelector = function () {
     // Deal with item_selector view
     var itemType = $(this).attr('data-type')
@@ -314,4 +368,7 @@ $(function () {
 
   // Pqueue actions
   $('#root').on('click', '.js-queue', queueAction)
+  $('#root').on('dragstart', '.js-queue-row', queueDragStart)
+  $('#root').on('dragover', '.js-queue-row', function (e) { e.preventDefault() })
+  $('#root').on('drop', '.js-queue-row', queueDrop)
 })
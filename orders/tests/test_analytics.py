@@ -0,0 +1,109 @@
+"""Test the status lead times."""
+
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from orders.analytics import (
+    lead_times, percentile, shift_durations, status_tracker, )
+from orders.models import Customer, Item, Order, OrderItem, StatusShift
+
+
+class LeadTimesTests(TestCase):
+    """Test the shift durations and their percentiles."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        self.customer = Customer.objects.create(
+            name='Customer Test', phone=0, cp=48100)
+        self.start = timezone.now() - timedelta(days=20)
+
+    def track(self, stages, item_type='1', close_all=True):
+        """Create an order that went through the (status, hours) stages."""
+        order = Order.objects.create(
+            user=self.user, customer=self.customer, ref_name='test',
+            delivery=self.start.date())
+        item = Item.objects.create(name='test', fabrics=1, item_type=item_type)
+        OrderItem.objects.create(reference=order, element=item, price=10)
+        StatusShift.objects.filter(order=order).delete()
+        date_in, shifts = self.start, list()
+        for n, (status, hours) in enumerate(stages):
+            date_out = date_in + timedelta(hours=hours)
+            last = n == len(stages) - 1
+            shifts.append(StatusShift(
+                order=order, status=status, date_in=date_in,
+                date_out=None if last and not close_all else date_out))
+            date_in = date_out
+        StatusShift.objects.bulk_create(shifts)
+        return order
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 50))
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(percentile([1, 2, 3, 4], 100), 4)
+        self.assertEqual(percentile([7], 90), 7)
+
+    def test_missing_date_out_ends_with_the_next_shift(self):
+        order = self.track([('1', 5), ('2', 3), ('3', 1)], close_all=False)
+        StatusShift.objects.filter(order=order, status='2').update(
+            date_out=None)
+        with self.assertNumQueries(1):
+            rows = shift_durations()
+        self.assertEqual([r['status'] for r in rows], ['1', '2', '3'])
+        self.assertEqual(
+            [r['duration'] for r in rows],
+            [timedelta(hours=5), timedelta(hours=3), None])
+
+    def test_old_orders_are_left_out(self):
+        order = self.track([('1', 5)])
+        Order.objects.filter(pk=order.pk).update(
+            inbox_date=timezone.now() - timedelta(days=800))
+        self.assertEqual(shift_durations(), [])
+
+    def test_percentiles_by_month(self):
+        self.track([('1', 10), ('3', 4), ('7', 0)], close_all=False)
+        self.track([('1', 30), ('3', 8), ('7', 0)], close_all=False)
+        with self.assertNumQueries(1):
+            report = lead_times()
+        month = self.start.replace(day=1).date()
+        figures = {r['status']: r for r in report}
+        self.assertEqual({r['group'] for r in report}, {month})
+        self.assertEqual(set(figures), {'1', '3', 'lead', 'cycle'})
+        self.assertEqual(figures['1']['count'], 2)
+        self.assertEqual(figures['1']['p50'], timedelta(hours=20))
+        self.assertEqual(figures['1']['p90'], timedelta(hours=28))
+        self.assertEqual(figures['3']['p50'], timedelta(hours=6))
+        self.assertEqual(figures['lead']['p50'], timedelta(hours=26))
+        self.assertEqual(figures['cycle']['p75'], timedelta(hours=7))
+
+    def test_percentiles_by_type(self):
+        self.track([('1', 10), ('7', 0)], item_type='1', close_all=False)
+        self.track([('1', 30), ('7', 0)], item_type='2', close_all=False)
+        with self.assertNumQueries(2):
+            report = lead_times('type')
+        figures = {(r['group'], r['status']): r['p50'] for r in report}
+        self.assertEqual(figures, {
+            ('1', '1'): timedelta(hours=10),
+            ('1', 'lead'): timedelta(hours=10),
+            ('2', '1'): timedelta(hours=30),
+            ('2', 'lead'): timedelta(hours=30), })
+
+    def test_invoiced_shifts_are_not_measured(self):
+        self.track([('1', 10), ('7', 2), ('9', 0)])
+        statuses = {r['status'] for r in lead_times()}
+        self.assertEqual(statuses, {'1', '7', 'lead'})
+
+    def test_group_by_is_checked(self):
+        with self.assertRaises(ValueError):
+            lead_times('customer')
+
+    def test_status_tracker(self):
+        order = self.track([('1', 1), ('2', 1), ('1', 1), ('3', 1)])
+        shifts = StatusShift.objects.filter(order=order).order_by('pk')
+        with self.assertNumQueries(1):
+            tracker = status_tracker(order)
+        self.assertEqual(
+            tracker, [shifts[2], shifts[1], shifts[3], None, None, None])
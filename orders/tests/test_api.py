@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, timedelta
 
 from django.contrib.auth.models import User
 from django.urls import reverse
@@ -6,7 +6,7 @@ from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
 from orders.models import (BankMovement, Customer, Expense, Item,
-                           Order, OrderItem, Timetable)
+                           Order, OrderItem, PQueue, Timetable)
 
 
 class ReadOnlyTests(APITestCase):
@@ -162,6 +162,179 @@ class ReadOnlyTests(APITestCase):
             self.assertTrue(field in resp.data[0].keys())
 
 
+class ReceivablesAPITests(APITestCase):
+
+    def setUp(self):
+        su = User.objects.create_user(
+            username='su', password='test', is_staff=True)
+        token = Token.objects.create(user=su)
+        c = Customer.objects.create(name='Test Customer', phone=0, cp=0)
+        self.order = Order.objects.create(
+            customer=c, user=su, ref_name='Test order', delivery=date.today())
+        item = Item.objects.create(name='Test item', fabrics=0, price=10)
+        OrderItem.objects.create(
+            element=item, reference=self.order, qty=2, price=15)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_receivables_api(self):
+        """Test the correct content for receivables API."""
+        resp = self.client.get(reverse('receivables-api'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['total'], 30)
+        self.assertEqual(len(resp.data['orders']), 1)
+        self.assertEqual(resp.data['orders'][0]['pk'], self.order.pk)
+        self.assertEqual(resp.data['orders'][0]['pending'], '30.00')
+
+        # Finally ensure that all the fields are included
+        for field in ('pk', 'customer', 'ref_name', 'delivery', 'pending'):
+            self.assertTrue(field in resp.data['orders'][0].keys())
+
+    def test_receivables_api_needs_login(self):
+        """Ensure not allowed people can't get receivables."""
+        self.client.credentials()
+        resp = self.client.get(reverse('receivables-api'))
+        self.assertEqual(resp.status_code, 401)
+
+
+class PQueueETAAPITests(APITestCase):
+
+    def setUp(self):
+        su = User.objects.create_user(
+            username='su', password='test', is_staff=True)
+        token = Token.objects.create(user=su)
+        c = Customer.objects.create(name='Test Customer', phone=0, cp=0)
+        self.order = Order.objects.create(
+            customer=c, user=su, ref_name='Test order', delivery=date.today())
+        item = Item.objects.create(name='Test item', fabrics=0, price=10)
+        OrderItem.objects.create(
+            element=item, reference=self.order, qty=1, price=15,
+            crop=timedelta(hours=1))
+        self.queued = PQueue.objects.create(item=OrderItem.objects.create(
+            element=item, reference=self.order, qty=2, price=15))
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_pqueue_eta_api(self):
+        """Test the correct content for pqueue eta API."""
+        resp = self.client.get(reverse('pqueue-eta-api'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data), 1)
+        self.assertEqual(resp.data[0]['pk'], self.queued.pk)
+        self.assertEqual(resp.data[0]['order'], self.order.pk)
+        self.assertEqual(resp.data[0]['estimated'], 7200)
+        self.assertIsNone(resp.data[0]['eta'])
+
+        # Finally ensure that all the fields are included
+        for field in ('pk', 'order', 'customer', 'item', 'delivery',
+                      'estimated', 'eta', 'late'):
+            self.assertTrue(field in resp.data[0].keys())
+
+    def test_pqueue_eta_api_needs_login(self):
+        """Ensure not allowed people can't get the queue."""
+        self.client.credentials()
+        resp = self.client.get(reverse('pqueue-eta-api'))
+        self.assertEqual(resp.status_code, 401)
+
+
+class ReorderAPITests(APITestCase):
+
+    def setUp(self):
+        su = User.objects.create_user(
+            username='su', password='test', is_staff=True)
+        token = Token.objects.create(user=su)
+        c = Customer.objects.create(name='Test Customer', phone=0, cp=0)
+        self.item = Item.objects.create(
+            name='Test item', fabrics=0, price=10, size='m')
+        month = date.today().replace(day=1)
+        for _ in range(12):  # A sale in each of the last 12 months
+            month = (month - timedelta(days=1)).replace(day=1)
+            order = Order.objects.create(
+                customer=c, user=su, ref_name='Test order', delivery=month)
+            OrderItem.objects.create(
+                element=self.item, reference=order, qty=3, price=15)
+        Order.objects.update(status='9')
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_reorder_api(self):
+        """Test the correct content for reorder API."""
+        resp = self.client.get(reverse('reorder-api'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data), 1)
+        self.assertEqual(resp.data[0]['pk'], self.item.pk)
+        self.assertEqual(resp.data[0]['size'], 'M')
+        self.assertEqual(resp.data[0]['item_type'], 'No definido')
+        self.assertEqual(resp.data[0]['forecast'], 6)
+        self.assertEqual(resp.data[0]['suggested'], 6)
+
+        # Finally ensure that all the fields are included
+        for field in ('pk', 'name', 'item_type', 'size', 'stocked',
+                      'forecast', 'suggested'):
+            self.assertTrue(field in resp.data[0].keys())
+
+    def test_reorder_api_needs_login(self):
+        """Ensure not allowed people can't get the suggestions."""
+        self.client.credentials()
+        resp = self.client.get(reverse('reorder-api'))
+        self.assertEqual(resp.status_code, 401)
+
+
+class LeadTimesAPITests(APITestCase):
+
+    def setUp(self):
+        su = User.objects.create_user(
+            username='su', password='test', is_staff=True)
+        token = Token.objects.create(user=su)
+        c = Customer.objects.create(name='Test Customer', phone=0, cp=0)
+        order = Order.objects.create(
+            customer=c, user=su, ref_name='Test order',
+            delivery=date.today())
+        order.kanban_forward()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_lead_times_api(self):
+        """Test the correct content for lead times API."""
+        resp = self.client.get(reverse('lead-times-api'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.data), 1)
+        self.assertEqual(resp.data[0]['status'], '1')
+        self.assertEqual(resp.data[0]['count'], 1)
+        self.assertEqual(
+            resp.data[0]['group'], str(date.today().replace(day=1)))
+
+        # Finally ensure that all the fields are included
+        self.assertEqual(
+            set(resp.data[0]),
+            {'group', 'status', 'count', 'p50', 'p75', 'p90'})
+
+    def test_lead_times_api_by_type(self):
+        resp = self.client.get(reverse('lead-times-api'), {'by': 'type'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, [])  # The order has no items
+
+        resp = self.client.get(reverse('lead-times-api'), {'by': 'foo'})
+        self.assertEqual(resp.status_code, 400)
+
+
+class OrderSaveStatsAPITests(APITestCase):
+
+    def setUp(self):
+        su = User.objects.create_user(
+            username='su', password='test', is_staff=True)
+        token = Token.objects.create(user=su)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+
+    def test_order_save_stats_api(self):
+        """Test the correct content for order save stats API."""
+        Order.save_stats.clear()
+        c = Customer.objects.create(name='Test Customer', phone=0, cp=0)
+        order = Order.objects.create(
+            customer=c, user=User.objects.first(), ref_name='Test order',
+            delivery=date.today())
+        order = Order.objects.get(pk=order.pk)
+        order.save()
+        resp = self.client.get(reverse('order-save-stats-api'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data['write'], {'run': 1, 'skipped': 1})
+        self.assertEqual(resp.data['membership_check']['skipped'], 1)
 
 
 #
@@ -0,0 +1,142 @@
+"""Test the management commands."""
+
+from datetime import date
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+
+from orders.models import CashFlowIO, Customer, Item, Order, OrderItem
+
+
+class ReconcileOrderTotalsTests(TestCase):
+    """Test the reconcile_order_totals command."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        i = Item.objects.create(name='test', fabrics=10, price=30)
+        self.order = Order.objects.create(
+            user=u, customer=c, ref_name='test', delivery=date.today())
+        OrderItem.objects.create(
+            reference=self.order, element=i, qty=2, price=30)
+        CashFlowIO.objects.create(order=self.order, amount=20)
+
+        # Bulk updates skip the hooks
+        Order.objects.update(cached_total=5, cached_paid=0)
+
+    def test_reports_and_rebuilds_drift(self):
+        out = StringIO()
+        call_command('reconcile_order_totals', stdout=out)
+        self.assertIn('Order {}'.format(self.order.pk), out.getvalue())
+        self.assertIn('1 order(s) rebuilt.', out.getvalue())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.cached_total, 60)
+        self.assertEqual(self.order.cached_paid, 20)
+
+    def test_dry_run_does_not_rebuild(self):
+        out = StringIO()
+        call_command('reconcile_order_totals', '--dry-run', stdout=out)
+        self.assertIn('1 order(s) drifted.', out.getvalue())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.cached_total, 5)
+
+    def test_no_drift(self):
+        Order.objects.all().update_totals()
+        out = StringIO()
+        call_command('reconcile_order_totals', stdout=out)
+        self.assertIn('No drift found.', out.getvalue())
+
+
+class RecomputeItemHealthTests(TestCase):
+    """Test the recompute_item_health command."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        Item.objects.create(name='test', fabrics=10, price=30, stocked=3)
+
+        # Bulk updates skip the hooks
+        Item.objects.update(health=0)
+
+    def test_recomputes_health(self):
+        out = StringIO()
+        call_command('recompute_item_health', stdout=out)
+        self.assertIn('1 item(s) updated.', out.getvalue())
+        self.assertEqual(Item.objects.get(name='test').health, -3)
+
+    def test_benchmark(self):
+        out = StringIO()
+        call_command('recompute_item_health', '--benchmark', stdout=out)
+        self.assertIn('Item.save() loop:', out.getvalue())
+        self.assertIn('recompute_item_health():', out.getvalue())
+        self.assertIn('1 item(s) updated.', out.getvalue())
+
+
+class VerifyStockTests(TestCase):
+    """Test the verify_stock command."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.item = Item.objects.create(
+            name='test', fabrics=10, price=30, stocked=3)
+
+    def test_stock_matches(self):
+        out = StringIO()
+        call_command('verify_stock', stdout=out)
+        self.assertIn('Stock matches the ledger.', out.getvalue())
+
+    def test_reports_and_rebuilds_drift(self):
+        Item.objects.update(stocked=5)  # Bulk updates skip the ledger
+        out = StringIO()
+        call_command('verify_stock', stdout=out)
+        self.assertIn(
+            'Item {}: stocked 5 (ledger 3)'.format(self.item.pk),
+            out.getvalue())
+        self.assertIn('1 item(s) rebuilt.', out.getvalue())
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stocked, 3)
+
+    def test_dry_run_does_not_rebuild(self):
+        Item.objects.update(stocked=5)
+        out = StringIO()
+        call_command('verify_stock', '--dry-run', stdout=out)
+        self.assertIn('1 item(s) drifted.', out.getvalue())
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stocked, 5)
+
+
+class PurgeQuickOrdersTests(TestCase):
+    """Test the purge_quick_orders command."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='express', phone=0, cp=48100)
+        self.order = Order.objects.create(
+            user=u, customer=c, ref_name='Quick', delivery=date.today(),
+            status='7')
+
+    def test_purges_the_old_orders(self):
+        out = StringIO()
+        call_command('purge_quick_orders', stdout=out)
+        self.assertIn('0 express order(s) purged.', out.getvalue())
+
+        call_command('purge_quick_orders', '--older-than', '0', stdout=out)
+        self.assertIn('1 express order(s) purged.', out.getvalue())
+        self.assertFalse(Order.objects.filter(pk=self.order.pk).exists())
+
+
+class BenchmarkItemLabelsTests(TestCase):
+    """Test the benchmark_item_labels command."""
+
+    def test_times_both_pages(self):
+        Item.objects.create(name='test', fabrics=10, price=30, stocked=3)
+        out = StringIO()
+        call_command('benchmark_item_labels', '--repeat', '2', stdout=out)
+        self.assertRegex(
+            out.getvalue(), r'stock manager: [\d.]+ms cold, [\d.]+ms memoized')
+        self.assertRegex(
+            out.getvalue(),
+            r'production queue: [\d.]+ms cold, [\d.]+ms memoized')
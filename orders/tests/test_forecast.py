@@ -0,0 +1,105 @@
+"""Test the demand forecast."""
+
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from orders.forecast import (
+    add_months, monthly_sales, reorder_suggestions, seasonal_index, )
+from orders.models import Customer, Item, Order, OrderItem
+
+
+class ForecastTests(TestCase):
+    """Test the monthly series, the seasonal index and the suggestions."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        self.customer = Customer.objects.create(
+            name='Customer Test', phone=0, cp=48100)
+        self.month = date.today().replace(day=1)
+        self.item = Item.objects.create(
+            name='test', fabrics=1, price=10, stocked=5)
+
+    def sell(self, item, qty, months_ago, customer=None, invoiced=True):
+        """Sell the item the given months ago."""
+        order = Order.objects.create(
+            user=self.user, customer=customer or self.customer,
+            ref_name='test',
+            delivery=add_months(self.month, -months_ago))
+        OrderItem.objects.create(
+            reference=order, element=item, qty=qty, price=10)
+        if invoiced:
+            Order.objects.filter(pk=order.pk).update(status='9')
+
+    def test_add_months(self):
+        self.assertEqual(add_months(date(2020, 11, 15), 3), date(2021, 2, 1))
+        self.assertEqual(add_months(date(2020, 1, 1), -1), date(2019, 12, 1))
+        self.assertEqual(add_months(date(2020, 5, 31), 0), date(2020, 5, 1))
+
+    def test_monthly_sales(self):
+        self.sell(self.item, 2, 1)
+        self.sell(self.item, 3, 1)
+        self.sell(self.item, 4, 24)
+        self.sell(self.item, 7, 0)  # Current month
+        self.sell(self.item, 7, 25)  # Too old
+        self.sell(self.item, 7, 2, invoiced=False)
+        tz = Customer.objects.create(name='trapuzarrak', phone=0, cp=0)
+        self.sell(self.item, 7, 2, customer=tz)
+
+        with self.assertNumQueries(1):
+            start, series = monthly_sales()
+        self.assertEqual(start, add_months(self.month, -24))
+        self.assertEqual(series[self.item.pk], [4] + [0] * 22 + [5])
+
+    def test_seasonal_index(self):
+        start = date(2019, 1, 1)
+        self.assertEqual(seasonal_index(start, {}), [1] * 12)
+        index = seasonal_index(start, {1: [0, 0, 12] + [0] * 21})
+        self.assertEqual(index[2], 12)  # March takes all the sales
+        self.assertEqual(sum(index), 12)
+        index = seasonal_index(date(2019, 11, 1), {1: [0, 0, 12]})
+        self.assertEqual(index[0], 12)  # January
+
+    def test_reorder_suggestions(self):
+        for months_ago in range(1, 13):
+            self.sell(self.item, 6, months_ago)
+
+        # Flat sales average 6 a month, 12 for the next two months
+        with self.assertNumQueries(2):
+            suggestions = reorder_suggestions()
+        self.assertEqual(len(suggestions), 1)
+        self.assertEqual(suggestions[0]['item'], self.item)
+        self.assertEqual(suggestions[0]['forecast'], 12)
+        self.assertEqual(suggestions[0]['suggested'], 7)
+
+    def test_seasonal_suggestions(self):
+        # All the sales of the catalog happened 11 months ago, ie, on the
+        # calendar month that comes next
+        other = Item.objects.create(name='other', fabrics=1, price=10)
+        self.sell(other, 12, 11)
+        self.sell(self.item, 1, 11)
+        self.assertEqual(monthly_sales()[1][self.item.pk][-11], 1)
+
+        # Next month weights 12 times the average
+        suggestions = {s['item']: s for s in reorder_suggestions()}
+        self.assertEqual(suggestions[other]['forecast'], 12)
+        self.assertEqual(suggestions[other]['suggested'], 12)
+        self.assertNotIn(self.item, suggestions)  # 5 stocked cover 1
+
+    def test_stock_and_foreign_items_have_no_suggestions(self):
+        foreign = Item.objects.create(
+            name='foreign', fabrics=1, price=10, foreing=True)
+        for months_ago in range(1, 13):
+            self.sell(self.item, 1, months_ago)
+            self.sell(foreign, 6, months_ago)
+        self.assertEqual(reorder_suggestions(), [])
+
+    def test_given_items(self):
+        for months_ago in range(1, 13):
+            self.sell(self.item, 6, months_ago)
+        self.assertEqual(
+            reorder_suggestions(Item.objects.filter(name='other')), [])
+        self.assertEqual(len(reorder_suggestions(
+            Item.objects.filter(name='test'))), 1)
@@ -1,18 +1,26 @@
 """Test the app models."""
 from io import BytesIO
+from threading import Thread
+from unittest import mock
 
 from datetime import date, datetime, time, timedelta
 from decimal import Decimal, InvalidOperation
 
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
+from django.db import connection, transaction
+from django.db.models import Sum
 from django.db.utils import DataError, IntegrityError
-from django.test import TestCase, tag
+from django.test import TestCase, TransactionTestCase, tag
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
+from orders.forms import ItemTimesForm
+from orders.managers import ItemQuerySet
 from orders.models import (
-    BankMovement, Comment, Customer, Expense, Invoice, Item, Order, OrderItem,
-    PQueue, Timetable, CashFlowIO, StatusShift, ExpenseCategory, )
+    BankMovement, Comment, Customer, Expense, Invoice, InvoiceCounter, Item,
+    ItemTimeStats, Order, OrderItem, PQueue, Timetable, CashFlowIO,
+    StatusShift, StockMovement, ExpenseCategory, )
 
 from orders.settings import PAYMENT_METHODS, WEEK_COLORS, ITEM_TYPE
 
@@ -726,20 +734,18 @@ class TestOrders(TestCase):
         with self.assertRaisesMessage(ValidationError, msg):
             o.clean()
 
-    def test_obsolete_express_orders_are_removed(self):
-        """When a new order express is open old ones should be erased."""
+    def test_obsolete_express_orders_are_kept_on_save(self):
+        """Express orders are purged by purge_quick_orders, not on save."""
         u = User.objects.first()
-        c = Customer.objects.first()
         express = Customer.objects.create(name='express', phone=0, cp=0)
         obsolete = Order.objects.create(
             user=u, customer=express, ref_name='Quick', delivery=date.today(),
             status='7')
 
-        new = Order.objects.create(
+        Order.objects.create(
             user=u, customer=express, ref_name='Quick', delivery=date.today())
 
-        with self.assertRaises(ObjectDoesNotExist):
-            Order.objects.get(pk=obsolete.pk)
+        self.assertTrue(Order.objects.filter(pk=obsolete.pk).exists())
 
     def test_invoiced_orders_are_status_9(self):
         o = Order.objects.first()
@@ -830,6 +836,22 @@ class TestOrders(TestCase):
         order.kill()
         self.assertEqual(Invoice.objects.count(), 1)
 
+    def test_kill_reads_the_amounts_written_elsewhere(self):
+        """Items & payments written through other instances are seen."""
+        order = Order.objects.first()
+        other = Order.objects.get(pk=order.pk)
+        OrderItem.objects.create(
+            reference=other, element=Item.objects.last(), price=30, )
+        CashFlowIO.objects.create(order=other, amount=10)
+        self.assertEqual(order.pending, 0)  # Stale
+        with mock.patch.object(Order, 'archive'):
+            order.kill()
+        self.assertEqual(CashFlowIO.objects.filter(order=order).aggregate(
+            total=Sum('amount'))['total'], 30)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.invoice.amount, 30)  # Still cached
+        self.assertEqual(order.pending, 0)
+
     def test_kill_order_kills_pending_payments(self):
         order = Order.objects.first()
         OrderItem.objects.create(
@@ -1011,6 +1033,158 @@ class TestOrders(TestCase):
             CashFlowIO.objects.create(order=order, amount=10)
         self.assertEqual(order.pending, 130)
 
+    def test_with_financials_annotates_amounts(self):
+        order = Order.objects.first()
+        order.discount = 10
+        order.save()
+        for _ in range(5):
+            OrderItem.objects.create(
+                reference=order, element=Item.objects.last(), price=30, )
+        for _ in range(2):
+            CashFlowIO.objects.create(order=order, amount=10)
+
+        order = Order.objects.with_financials().get(pk=order.pk)
+        self.assertEqual(order.fin_total_pre_discount, 150)
+        self.assertEqual(order.fin_discount_amount, 15)
+        self.assertEqual(order.fin_already_paid, 20)
+        self.assertEqual(order.fin_pending, 115)
+
+    def test_with_financials_properties_avoid_queries(self):
+        order = Order.objects.first()
+        for _ in range(3):
+            OrderItem.objects.create(
+                reference=order, element=Item.objects.last(), price=30, )
+        CashFlowIO.objects.create(order=order, amount=10)
+
+        order = Order.objects.with_financials().get(pk=order.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(order.total_pre_discount, 90)
+            self.assertEqual(order.discount_amount, 0)
+            self.assertEqual(order.total, 90)
+            self.assertEqual(order.already_paid, 10)
+            self.assertEqual(order.pending, 80)
+            self.assertIsInstance(order.total, float)
+            self.assertIsInstance(order.already_paid, float)
+
+    def test_cached_totals_follow_items(self):
+        order = Order.objects.first()
+        item = OrderItem.objects.create(
+            reference=order, element=Item.objects.last(), price=30, qty=2)
+        self.assertEqual(order.cached_total, 60)
+        self.assertEqual(Order.objects.get(pk=order.pk).cached_total, 60)
+
+        item.qty = 3
+        item.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).cached_total, 90)
+
+        item.delete()
+        self.assertEqual(Order.objects.get(pk=order.pk).cached_total, 0)
+
+    def test_cached_totals_follow_cashflows(self):
+        order = Order.objects.first()
+        OrderItem.objects.create(
+            reference=order, element=Item.objects.last(), price=30, )
+        cf = CashFlowIO.objects.create(order=order, amount=10)
+        self.assertEqual(order.cached_paid, 10)
+        self.assertEqual(Order.objects.get(pk=order.pk).cached_paid, 10)
+
+        cf.delete()
+        self.assertEqual(Order.objects.get(pk=order.pk).cached_paid, 0)
+
+    def test_stale_orders_do_not_overwrite_cached_totals(self):
+        stale = Order.objects.first()
+        OrderItem.objects.create(reference=Order.objects.get(pk=stale.pk),
+                                 element=Item.objects.last(), price=30, )
+        stale.ref_name = 'updated'
+        stale.save()
+        order = Order.objects.get(pk=stale.pk)
+        self.assertEqual(order.ref_name, 'updated')
+        self.assertEqual(order.cached_total, 30)
+
+    def test_with_financials_orders_without_items(self):
+        order = Order.live.with_financials().get(pk=Order.objects.first().pk)
+        self.assertEqual(order.total, 0)
+        self.assertEqual(order.already_paid, 0)
+        self.assertEqual(order.pending, 0)
+
+    def test_kanban_version_bumps(self):
+        """Writes that change the kanban card bump the order version."""
+        o = Order.objects.first()
+        user, item = User.objects.first(), Item.objects.first()
+
+        def version():
+            o.refresh_from_db(fields=('kanban_version', ))
+            return o.kanban_version
+
+        self.assertEqual(version(), 0)
+        o.save()  # Nothing changed, nothing written
+        self.assertEqual(version(), 0)
+        o.ref_name = 'new name'
+        o.save()
+        self.assertEqual(version(), 1)
+        oi = OrderItem.objects.create(reference=o, element=item, price=10)
+        self.assertEqual(version(), 2)
+        c = Comment.objects.create(user=user, reference=o, comment='test')
+        self.assertEqual(version(), 3)
+        c.delete()
+        self.assertEqual(version(), 4)
+        cf = CashFlowIO.objects.create(order=o, amount=10)
+        self.assertEqual(version(), 5)
+        cf.delete()
+        self.assertEqual(version(), 6)
+        oi.delete()
+        self.assertEqual(version(), 7)
+        o.customer.save()
+        self.assertEqual(version(), 8)
+
+    def test_unchanged_orders_are_not_written(self):
+        """Saving an order loaded and left untouched takes no queries."""
+        o = Order.objects.first()
+        self.assertEqual(o.dirty_fields, set())
+        with self.assertNumQueries(0):
+            o.save()
+
+    def test_save_only_writes_the_changed_fields(self):
+        o = Order.objects.first()
+        o.ref_name, o.priority = 'new name', '1'
+        self.assertEqual(o.dirty_fields, {'ref_name', 'priority'})
+        with CaptureQueriesContext(connection) as ctx:
+            o.save()
+        update = [q['sql'] for q in ctx.captured_queries
+                  if q['sql'].startswith('UPDATE "orders_order"')][0]
+        self.assertIn('"ref_name"', update)
+        self.assertNotIn('"customer_id"', update)
+        self.assertNotIn('"status"', update)
+        self.assertEqual(o.dirty_fields, set())
+
+    def test_new_orders_have_all_their_fields_dirty(self):
+        o = Order(ref_name='new')
+        self.assertIn('ref_name', o.dirty_fields)
+        self.assertIn('customer', o.dirty_fields)
+        self.assertNotIn('current_shift', o.dirty_fields)
+
+    def test_save_counts_the_side_effects_run_and_skipped(self):
+        Order.save_stats.clear()
+        o = Order.objects.first()
+        o.save()
+        o.ref_name = 'new name'
+        o.save()
+        o.status = '2'
+        o.save()
+        self.assertEqual(Order.save_stats['write:skipped'], 1)
+        self.assertEqual(Order.save_stats['write:run'], 2)
+        self.assertEqual(Order.save_stats['status_shift:run'], 1)
+        self.assertEqual(Order.save_stats['status_shift:skipped'], 1)
+        self.assertEqual(Order.save_stats['customer_check:skipped'], 3)
+
+    def test_stale_orders_do_not_overwrite_kanban_version(self):
+        o = Order.objects.first()
+        Order.objects.filter(pk=o.pk).bump_version()
+        o.ref_name = 'new name'
+        o.save()
+        o.refresh_from_db()
+        self.assertEqual(o.kanban_version, 2)
+
     def test_closed(self):
         o = Order.objects.first()
         self.assertFalse(o.closed)
@@ -1865,6 +2039,43 @@ class TestObjectItems(TestCase):
         for i in Item.objects.filter(foreing=True):
             self.assertTrue(i in [a, b, c, d])
 
+    def test_consistent_foreign_only_updates_changed_siblings(self):
+        a, b, c = [Item.objects.create(
+            name='foo', item_type='2', fabrics=5, size=s) for s in 'abc']
+        Item.objects.filter(pk__in=[a.pk, b.pk]).update(foreing=True)
+
+        with self.assertNumQueries(3):  # Health refresh runs on commit
+            self.assertEqual(a.consistent_foreign(), [c.pk])
+        with self.assertNumQueries(1):
+            self.assertEqual(c.consistent_foreign(), [])
+
+    def test_consistent_foreign_bumps_the_kanban_version(self):
+        a, b = [Item.objects.create(
+            name='foo', item_type='2', fabrics=5, size=s) for s in 'ab']
+        Item.objects.filter(pk=a.pk).update(foreing=True)
+        user = User.objects.create_user(username='foreign')
+        customer = Customer.objects.create(name='Test', phone=0, cp=0)
+        holding, other = [Order.objects.create(
+            user=user, customer=customer, ref_name=ref,
+            delivery=date.today()) for ref in ('holding', 'other')]
+        OrderItem.objects.create(reference=holding, element=b, price=10)
+        versions = {o.pk: Order.objects.get(pk=o.pk).kanban_version
+                    for o in (holding, other)}
+        missing = Order.objects.get(pk=holding.pk).missing_times
+
+        a.consistent_foreign()
+        holding.refresh_from_db()
+        other.refresh_from_db()
+        self.assertNotEqual(holding.missing_times, missing)
+        self.assertEqual(holding.kanban_version, versions[holding.pk] + 1)
+        self.assertEqual(other.kanban_version, versions[other.pk])
+
+    def test_consistent_foreign_without_foreign_siblings(self):
+        a = Item.objects.create(name='foo', item_type='2', fabrics=5)
+        Item.objects.create(name='foo', item_type='2', fabrics=5, size='2')
+        self.assertEqual(a.consistent_foreign(), [])
+        self.assertFalse(Item.objects.filter(foreing=True).exists())
+
     def test_item_html_string(self):
         i = Item.objects.create(
             name='foo', item_type='2', item_class='M', size='xs', fabrics=5)
@@ -1940,6 +2151,370 @@ class TestObjectItems(TestCase):
         self.assertEqual(f.production, 0)
 
 
+class TestItemTimeStats(TestCase):
+    """Test the item time stats."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        self.order = Order.objects.create(
+            user=u, customer=c, ref_name='test', delivery=date.today())
+        self.item = Item.objects.create(name='a', fabrics=10, price=30)
+        self.other = Item.objects.create(name='b', fabrics=10, price=30)
+
+    def create(self, element=None, qty=1, **times):
+        """Create an order item with the given times (in seconds)."""
+        times = {k: timedelta(seconds=v) for k, v in times.items()}
+        return OrderItem.objects.create(
+            element=element or self.item, reference=self.order, qty=qty,
+            price=10, **times)
+
+    def assertStatsMatchOrderItems(self):
+        """Compare the incremental stats with a rebuild from scratch."""
+        expected = {
+            row.pop('element'): row
+            for row in ItemTimeStats.objects.tracked() if any(row.values())}
+        stats = {
+            s.item_id: {f.name: getattr(s, f.name)
+                        for f in s._meta.fields if f.name != 'item'}
+            for s in ItemTimeStats.objects.all() if s.crop_qty or
+            s.sewing_qty or s.iron_qty}
+        self.assertEqual(stats, expected)
+
+    def test_stats_follow_created_items(self):
+        self.create(qty=2, crop=10, sewing=20)
+        self.create(qty=3, crop=30)
+        self.create(qty=4)
+        stats = ItemTimeStats.objects.get(item=self.item)
+        self.assertEqual(stats.crop_total, timedelta(seconds=40))
+        self.assertEqual(stats.crop_qty, 5)
+        self.assertEqual(stats.sewing_total, timedelta(seconds=20))
+        self.assertEqual(stats.sewing_qty, 2)
+        self.assertEqual(stats.iron_qty, 0)
+        self.assertStatsMatchOrderItems()
+
+    def test_stats_follow_edited_items(self):
+        oi = self.create(qty=2, crop=10)
+        oi.qty, oi.crop, oi.iron = 5, timedelta(seconds=7), timedelta(1)
+        oi.save()
+        self.assertStatsMatchOrderItems()
+
+        oi.crop = timedelta(0)
+        oi.save()
+        self.assertStatsMatchOrderItems()
+
+    def test_stats_follow_items_times_form(self):
+        oi = self.create(qty=2)
+        form = ItemTimesForm(
+            {'crop': '0:10:00', 'sewing': '0:20:00', 'iron': '0:00:00'},
+            instance=oi)
+        form.save()
+        self.assertEqual(
+            self.item.avg_times,
+            (timedelta(minutes=5), timedelta(minutes=10), timedelta(0)))
+        self.assertStatsMatchOrderItems()
+
+    def test_stats_follow_element_changes(self):
+        oi = self.create(qty=2, crop=10)
+        oi.element = self.other
+        oi.save()
+        self.assertEqual(self.item.avg_crop, timedelta(0))
+        self.assertEqual(self.other.avg_crop, timedelta(seconds=5))
+        self.assertStatsMatchOrderItems()
+
+    def test_stats_follow_deleted_items(self):
+        self.create(qty=2, crop=10)
+        oi = self.create(qty=3, crop=30, iron=5)
+        oi.delete()
+        self.assertEqual(self.item.avg_times, (
+            timedelta(seconds=5), timedelta(0), timedelta(0)))
+        self.assertStatsMatchOrderItems()
+
+    def test_missing_stats_are_rebuilt(self):
+        self.create(qty=2, crop=10)
+        ItemTimeStats.objects.all().delete()
+        self.create(qty=2, crop=30)
+        self.assertEqual(self.item.avg_crop, timedelta(seconds=10))
+
+    def test_rebuild(self):
+        self.create(qty=2, crop=10, sewing=5)
+        self.create(element=self.other, qty=1, iron=3)
+        ItemTimeStats.objects.update(crop_total=timedelta(0), iron_qty=7)
+        ItemTimeStats.objects.rebuild()
+        self.assertStatsMatchOrderItems()
+
+    def test_items_without_stats_average_zero(self):
+        self.assertEqual(self.item.avg_times, (timedelta(0), ) * 3)
+
+    def test_averages_take_a_single_query(self):
+        self.create(qty=2, crop=10, sewing=20, iron=30)
+        with self.assertNumQueries(1):
+            self.item.pretty_avg
+        oi = OrderItem.objects.select_related('element').first()
+        with self.assertNumQueries(1):
+            oi.estimated_time
+
+
+class TestItemHealthRefresh(TransactionTestCase):
+    """Test the health refresh at commit time.
+
+    On commit callbacks don't run within TestCase transactions.
+    """
+
+    serialized_rollback = True
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        self.tz = Customer.objects.create(
+            name='trapuzarrak', phone=0, cp=48100)
+        self.order = Order.objects.create(
+            user=u, customer=c, ref_name='test', delivery=date.today())
+        self.items = [Item.objects.create(name=str(n), fabrics=1, price=10)
+                      for n in range(2)]
+        for item in self.items:
+            OrderItem.objects.create(
+                reference=self.order, element=item, qty=3, price=10)
+
+        # Bulk updates skip the hooks
+        Item.objects.update(health=0)
+
+    def health(self):
+        """Get the stored health of the items."""
+        return [Item.objects.get(pk=i.pk).health for i in self.items]
+
+    def test_refreshes_outside_transactions(self):
+        Item.objects.refresh_health(self.items[:1])
+        self.assertEqual(self.health(), [200, 0])
+
+    def test_batches_at_commit(self):
+        recompute = ItemQuerySet.recompute_health
+        with mock.patch.object(
+                ItemQuerySet, 'recompute_health', autospec=True,
+                side_effect=recompute) as patched:
+            with transaction.atomic():
+                Item.objects.refresh_health(self.items[:1])
+                Item.objects.refresh_health([self.items[1].pk])
+                self.assertEqual(self.health(), [0, 0])
+            self.assertEqual(patched.call_count, 1)
+        self.assertEqual(self.health(), [200, 200])
+
+    def test_rolled_back_items_dont_leak(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Item.objects.refresh_health(self.items[:1])
+                raise ValueError
+        recompute = ItemQuerySet.recompute_health
+        with mock.patch.object(
+                ItemQuerySet, 'recompute_health', autospec=True,
+                side_effect=recompute) as patched:
+            with transaction.atomic():
+                Item.objects.refresh_health(self.items[1:])
+            self.assertEqual(patched.call_count, 1)
+        self.assertEqual(self.health(), [0, 200])
+
+    def test_rolled_back_savepoint_keeps_the_transaction_items(self):
+        with transaction.atomic():
+            Item.objects.refresh_health(self.items[:1])
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    Item.objects.refresh_health(self.items[1:])
+                    raise ValueError
+        self.assertEqual(self.health()[0], 200)
+
+    def test_kill_refreshes_once(self):
+        recompute = ItemQuerySet.recompute_health
+        with mock.patch.object(
+                ItemQuerySet, 'recompute_health', autospec=True,
+                side_effect=recompute) as patched:
+            with mock.patch.object(Order, 'archive'):
+                self.order.kill()
+            self.assertEqual(patched.call_count, 1)
+        self.assertEqual(self.health(), [300, 300])  # Sales count
+
+    def test_deliver_refreshes_once(self):
+        self.order.customer = self.tz
+        self.order.save()
+        recompute = ItemQuerySet.recompute_health
+        with mock.patch.object(
+                ItemQuerySet, 'recompute_health', autospec=True,
+                side_effect=recompute) as patched:
+            self.order.deliver()
+            self.assertEqual(patched.call_count, 1)
+
+    def test_rolled_back_refresh(self):
+        with self.assertRaises(ValueError):
+            with transaction.atomic():
+                Item.objects.refresh_health(self.items)
+                raise ValueError
+        self.assertEqual(self.health(), [0, 0])
+
+    def test_invoice_refreshes_its_items(self):
+        Order.objects.filter(pk=self.order.pk).update(status='9')
+        order = Order.objects.get(pk=self.order.pk)
+        with transaction.atomic():
+            Invoice(reference=order, amount=0).save(kill=True)
+        for item in Item.objects.filter(pk__in=[i.pk for i in self.items]):
+            self.assertEqual(item.year_sales, 3)
+            self.assertEqual(item.health, Item.get_health(3, 0, True))
+
+    def test_tz_delivery_adds_stock_and_refreshes(self):
+        order = Order.objects.create(
+            user=self.order.user, customer=self.tz, ref_name='tz',
+            delivery=date.today())
+        for qty in (2, 4):  # Same item twice
+            OrderItem.objects.create(
+                reference=order, element=self.items[0], qty=qty, price=10)
+        Item.objects.update(health=0)
+        order.deliver()
+        item = Item.objects.get(pk=self.items[0].pk)
+        self.assertEqual(item.stocked, 6)
+        self.assertEqual(item.health, Item.get_health(0, 6, True))
+
+
+class TestStockMovements(TestCase):
+    """Test the stock ledger."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        self.order = Order.objects.create(
+            user=u, customer=c, ref_name='test', delivery=date.today())
+        self.item = Item.objects.create(
+            name='test', fabrics=1, price=10, stocked=10)
+
+    def movements(self):
+        """Get the qty & reason of the movements of the item."""
+        return list(self.item.stock_movements.values_list('qty', 'reason'))
+
+    def test_new_items_open_the_ledger(self):
+        self.assertEqual(self.movements(), [(10, 'A')])
+        Item.objects.create(name='empty', fabrics=1, price=10)
+        self.assertEqual(StockMovement.objects.count(), 1)
+
+    def test_edits_are_movements(self):
+        self.item.stocked = 7
+        self.item.save()
+        self.assertEqual(self.movements(), [(10, 'A'), (-3, 'A')])
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stocked, 7)
+
+    def test_stale_instances_dont_overwrite_the_stock(self):
+        stale = Item.objects.get(pk=self.item.pk)
+        StockMovement.objects.move(self.item, -4, 'S')
+        stale.name = 'renamed'
+        stale.save()
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stocked, 6)
+
+    def test_edits_that_no_longer_fit_raise(self):
+        item = Item.objects.get(pk=self.item.pk)
+        Item.objects.filter(pk=item.pk).update(stocked=0)  # Sold meanwhile
+        item.stocked, item.name = 1, 'renamed'
+        msg = 'El stock ha cambiado, ya no quedan tantas prendas.'
+        with self.assertRaisesMessage(ValidationError, msg):
+            item.save()
+        self.assertEqual(item._loaded_stocked, 10)
+        stored = Item.objects.get(pk=item.pk)
+        self.assertEqual((stored.stocked, stored.name), (0, 'test'))
+        self.assertEqual(self.movements(), [(10, 'A')])
+
+    def test_update_fields_write_the_stock_once(self):
+        self.item.stocked = 7
+        self.item.save(update_fields=['stocked', 'health'])
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stocked, 7)
+        self.assertEqual(self.movements(), [(10, 'A'), (-3, 'A')])
+
+    def test_move(self):
+        movement = StockMovement.objects.move(self.item, -4, 'S')
+        self.assertEqual(movement.qty, -4)
+        self.assertEqual(self.item.stocked, 6)  # Refreshed
+        self.assertIsNone(StockMovement.objects.move(self.item.pk, -7, 'S'))
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stocked, 6)
+        self.assertEqual(self.movements(), [(10, 'A'), (-4, 'S')])
+
+    def test_order_items_record_sales(self):
+        oi = OrderItem(reference=self.order, element=self.item, qty=3,
+                       price=10, stock=True)
+        oi.clean()
+        oi.save()
+        oi.qty = 2
+        oi.clean()
+        oi.save()
+        self.assertEqual(self.movements(), [(10, 'A'), (-3, 'S'), (1, 'S')])
+        self.assertEqual(
+            OrderItem.objects.get(pk=oi.pk).stock_movements.count(), 2)
+
+        oi.delete()
+        self.assertEqual(self.movements()[-1], (2, 'D'))
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stocked, 10)
+
+    def test_changing_element_moves_both_items(self):
+        other = Item.objects.create(
+            name='other', fabrics=1, price=10, stocked=5)
+        oi = OrderItem(reference=self.order, element=self.item, qty=3,
+                       price=10, stock=True)
+        oi.clean()
+        oi.save()
+        oi.element = other
+        oi.clean()
+        oi.save()
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stocked, 10)
+        self.assertEqual(Item.objects.get(pk=other.pk).stocked, 2)
+
+    def test_not_enough_stock_moves_nothing(self):
+        oi = OrderItem(reference=self.order, element=self.item, qty=11,
+                       price=10, stock=True)
+        with self.assertRaises(ValidationError):
+            oi.clean()
+        self.assertEqual(self.movements(), [(10, 'A')])
+        self.assertEqual(Item.objects.get(pk=self.item.pk).stocked, 10)
+
+    def test_tz_delivery_records_production(self):
+        tz = Customer.objects.create(name='trapuzarrak', phone=0, cp=48100)
+        order = Order.objects.create(
+            user=self.order.user, customer=tz, ref_name='tz',
+            delivery=date.today())
+        OrderItem.objects.create(
+            reference=order, element=self.item, qty=2, price=10)
+        order.deliver()
+        self.assertEqual(self.movements()[-1], (2, 'P'))
+
+    def test_stock_drift(self):
+        self.assertFalse(Item.objects.stock_drift().exists())
+        Item.objects.filter(pk=self.item.pk).update(stocked=3)
+        drift = Item.objects.stock_drift().get()
+        self.assertEqual((drift.stocked, drift.ledger_stock), (3, 10))
+
+
+class TestStockConcurrency(TransactionTestCase):
+    """Test concurrent movements on the same item."""
+
+    serialized_rollback = True
+
+    def test_concurrent_sales_dont_lose_updates(self):
+        item = Item.objects.create(
+            name='test', fabrics=1, price=10, stocked=20)
+
+        def sell():
+            try:
+                for _ in range(5):
+                    StockMovement.objects.move(item.pk, -1, 'S')
+            finally:
+                connection.close()
+
+        threads = [Thread(target=sell) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(Item.objects.get(pk=item.pk).stocked, 0)
+        self.assertEqual(item.stock_movements.count(), 21)
+        self.assertFalse(Item.objects.stock_drift().exists())
+
+
 class TestOrderItems(TestCase):
     """Test the orderItem model."""
 
@@ -2451,7 +3026,7 @@ class TestPQueue(TestCase):
                                      delivery=date.today(),
                                      budget=2000,
                                      prepaid=0)
-        for i in range(1, 3):
+        for i in range(1, 4):
             Item.objects.create(name='Test item%s' % i, fabrics=5)
 
         # Create orderitems
@@ -2484,7 +3059,7 @@ class TestPQueue(TestCase):
         """Two elements cannot share the same score."""
         item1, item2 = OrderItem.objects.all()[:2]
         PQueue.objects.create(item=item1)  # Score: 1000
-        pqueue = PQueue.objects.create(item=item2)  # To the bottom (1001)
+        pqueue = PQueue.objects.create(item=item2)  # To the bottom (2000)
         with self.assertRaises(IntegrityError):
             pqueue.score = 1000
             pqueue.save()
@@ -2493,17 +3068,17 @@ class TestPQueue(TestCase):
         """Objects are sorted by score."""
         item1, item2, item3 = OrderItem.objects.all()
         PQueue.objects.create(item=item1)  # Score: 1000
-        PQueue.objects.create(item=item2)  # To the bottom (1001)
-        pqueue = PQueue.objects.create(item=item3)  # To the bottom (1002)
+        PQueue.objects.create(item=item2)  # To the bottom (2000)
+        pqueue = PQueue.objects.create(item=item3)  # To the bottom (3000)
         queue = PQueue.objects.all()
         self.assertEqual((queue[0].score, queue[1].score, queue[2].score),
-                         (1000, 1001, 1002))
+                         (1000, 2000, 3000))
 
         pqueue.score = 100
         pqueue.save()
         queue = PQueue.objects.all()
         self.assertEqual((queue[0].score, queue[1].score, queue[2].score),
-                         (100, 1000, 1001))
+                         (100, 1000, 2000))
 
     def test_stock_items_cannot_be_added(self):
         """Stock items are already produced so can't be queued."""
@@ -2532,23 +3107,26 @@ class TestPQueue(TestCase):
         """On saving an object without score (new creation), send to bottom."""
         item1, item2 = OrderItem.objects.all()[:2]
         pqueue1 = PQueue.objects.create(item=item1)  # Score: 1000
-        pqueue2 = PQueue.objects.create(item=item2)  # To the bottom (1001)
+        pqueue2 = PQueue.objects.create(item=item2)  # To the bottom (2000)
         self.assertTrue(pqueue1.score < pqueue2.score)
-        self.assertEqual((pqueue1.score, pqueue2.score), (1000, 1001))
+        self.assertEqual((pqueue1.score, pqueue2.score), (1000, 2000))
 
-        pqueue2.score = None
-        pqueue2.save()
-        self.assertEqual(pqueue2.score, 1002)
+        pqueue1.score = None
+        pqueue1.save()
+        self.assertEqual(pqueue1.score, 3000)
 
-    def test_score_0_is_reserved(self):
-        """For swapping function."""
+    def test_score_0_sends_to_the_top(self):
+        """Score 0 is reserved to insert the element at the top."""
         PQueue.objects.create(item=OrderItem.objects.first(), score=0)
         self.assertEqual(PQueue.objects.count(), 1)
         queued_item = PQueue.objects.first()
-        self.assertEqual(queued_item.score, 1)
+        self.assertEqual(queued_item.score, 1000)
 
-    def test_queue_slides_when_one_is_already_taken(self):
-        """Queue should slide to avoid integrity error."""
+        PQueue.objects.create(item=OrderItem.objects.last(), score=0)
+        self.assertEqual(PQueue.objects.first().score, 500)
+
+    def test_score_0_rebalances_when_no_room_at_the_top(self):
+        """When the first element is 1 the queue is respaced."""
         order = Order.objects.first()
         item = Item.objects.first()
 
@@ -2562,6 +3140,7 @@ class TestPQueue(TestCase):
 
         self.assertEqual(PQueue.objects.count(), 13)
         self.assertEqual(PQueue.objects.first().score, 1)
+        former = list(PQueue.objects.values_list('pk', flat=True))
 
         # now, create a new pqueue entry
         item = OrderItem.objects.create(
@@ -2569,15 +3148,16 @@ class TestPQueue(TestCase):
         PQueue.objects.create(item=item, score=0)
         queue = PQueue.objects.all()
         self.assertEqual(queue.count(), 14)
-        score = 1
 
-        # finally, test sliding
-        for item in queue:
-            self.assertEqual(item.score, score)
-            score += 1
+        # new one first, the rest keep their order spaced by the gap
+        self.assertEqual(
+            list(queue.values_list('pk', flat=True)), [item.pk] + former)
+        scores = list(queue.values_list('score', flat=True))[1:]
+        for prev, score in zip(scores, scores[1:]):
+            self.assertEqual(score - prev, 1000)
 
     def test_top_sends_with_lowest_score(self):
-        """The score for the new element should be one below the lowest."""
+        """The score for the new element sits between 0 and the lowest."""
         order = Order.objects.first()
         item = Item.objects.first()
 
@@ -2592,22 +3172,22 @@ class TestPQueue(TestCase):
         self.assertEqual(last_item.score, 22)
         last_item.top()
         former_last = PQueue.objects.get(pk=last_item.pk)  # now first
-        self.assertEqual(former_last.score, 9)
+        self.assertEqual(former_last.score, 5)
 
-    def test_top_from_score_equal_to_two(self):
-        """Since 1 is reserved the list should slide."""
+    def test_top_from_score_equal_to_one(self):
+        """Since there's no room above 1 the queue should be respaced."""
         for item in OrderItem.objects.all():
             PQueue.objects.create(item=item)
         first, mid, last = PQueue.objects.all()
         first.score = 1
         first.save()
         last.top()
-        former_first = PQueue.objects.get(pk=first.pk)  # now second
-        former_last = PQueue.objects.get(pk=last.pk)  # now first
-        former_mid = PQueue.objects.get(pk=mid.pk)  # now last, slide by 1
-        self.assertEqual(former_last.score, 1)
-        self.assertEqual(former_first.score, 2)
-        self.assertEqual(former_mid.score, 1002)
+        self.assertEqual(
+            list(PQueue.objects.values_list('pk', flat=True)),
+            [last.pk, first.pk, mid.pk])
+        self.assertEqual(
+            list(PQueue.objects.values_list('score', flat=True)),
+            [2000, 4000, 5000])
 
     def test_up_raises_if_place(self):
         """Test up method when there is a place between two next numbers."""
@@ -2615,31 +3195,22 @@ class TestPQueue(TestCase):
             PQueue.objects.create(item=item)
         first, mid, last = PQueue.objects.all()
 
-        mid.score = 1020  # move far apart
-        mid.save()
-        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 1020)
-
-        mid.up()  # now raise
-        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 1001)
-
-        # try with a bigger hole
-        first.score = 20
-        last.score = 2000
-        first.save()
-        last.save()
-        queue = PQueue.objects.all()
-        self.assertEqual((queue[0].score, queue[1].score, queue[2].score),
-                         (20, 1001, 2000))
         last.up()
-        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 1000)
+        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 1500)
+
+        mid.up()
+        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 1250)
+        self.assertEqual(
+            list(PQueue.objects.values_list('pk', flat=True)),
+            [first.pk, mid.pk, last.pk])
 
     def test_up_if_second(self):
-        """When the element is second, should call top()."""
+        """When the element is second, should go to the top."""
         for item in OrderItem.objects.all()[:2]:
             PQueue.objects.create(item=item)
         first, last = PQueue.objects.all()
         last.up()
-        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 999)
+        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 500)
 
     def test_up_does_nothing_for_first_element(self):
         [PQueue.objects.create(item=item) for item in OrderItem.objects.all()]
@@ -2656,23 +3227,26 @@ class TestPQueue(TestCase):
         self.assertEqual(first.score, 1000)
 
     def test_up_no_place(self):
-        """When there's no place to fit in, scores should be swapped."""
-        for item in OrderItem.objects.all():
-            PQueue.objects.create(item=item)
+        """When there's no place to fit in, the queue should be respaced."""
+        for n, item in enumerate(OrderItem.objects.all(), start=1):
+            PQueue.objects.create(item=item, score=n)
         first, mid, last = PQueue.objects.all()
-        self.assertEqual((first.score, mid.score, last.score),
-                         (1000, 1001, 1002))
+        self.assertEqual((first.score, mid.score, last.score), (1, 2, 3))
         last.up()
-        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 1001)
-        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 1002)
+        self.assertEqual(
+            list(PQueue.objects.values_list('pk', flat=True)),
+            [first.pk, last.pk, mid.pk])
+        self.assertEqual(
+            list(PQueue.objects.values_list('score', flat=True)),
+            [1003, 1503, 2003])
 
     def test_down_does_nothing_if_last(self):
         """When the element is last, should warn and do nothing."""
         _, _, last = [
             PQueue.objects.create(item=i) for i in OrderItem.objects.all()]
-        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 1002)
+        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 3000)
         last.down()
-        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 1002)
+        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 3000)
 
     def test_down(self):
         """Lower the position of an element."""
@@ -2680,17 +3254,21 @@ class TestPQueue(TestCase):
             PQueue.objects.create(item=item)
         first, mid, last = PQueue.objects.all()
         first.down()
-        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 999)
-        self.assertEqual(PQueue.objects.get(pk=first.pk).score, 1000)
-        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 1002)
+        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 2000)
+        self.assertEqual(PQueue.objects.get(pk=first.pk).score, 2500)
+        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 3000)
+
+        # Down from the last but one goes to the bottom
+        first.down()
+        self.assertEqual(PQueue.objects.get(pk=first.pk).score, 4000)
 
     def test_bottom_does_nothig_if_last(self):
         """When the element is last, should warn and do nothing."""
         _, _, last = [
             PQueue.objects.create(item=i) for i in OrderItem.objects.all()]
-        self.assertEqual(last.score, 1002)
+        self.assertEqual(last.score, 3000)
         last.bottom()
-        self.assertEqual(last.score, 1002)
+        self.assertEqual(last.score, 3000)
 
     def test_bottom(self):
         """Lower the position of an element to the bottom."""
@@ -2698,9 +3276,87 @@ class TestPQueue(TestCase):
             PQueue.objects.create(item=item)
         first, mid, last = PQueue.objects.all()
         first.bottom()
-        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 1001)
-        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 1002)
-        self.assertEqual(PQueue.objects.get(pk=first.pk).score, 1003)
+        self.assertEqual(PQueue.objects.get(pk=mid.pk).score, 2000)
+        self.assertEqual(PQueue.objects.get(pk=last.pk).score, 3000)
+        self.assertEqual(PQueue.objects.get(pk=first.pk).score, 4000)
+
+    def test_moves_write_a_single_row(self):
+        """With room between the neighbours only the element is updated."""
+        for item in OrderItem.objects.all():
+            PQueue.objects.create(item=item)
+        first, mid, last = PQueue.objects.all()
+        for move in (last.up, last.top, first.down, mid.bottom, last.down):
+            with CaptureQueriesContext(connection) as ctx:
+                self.assertTrue(move())
+            updates = [q['sql'] for q in ctx.captured_queries
+                       if q['sql'].startswith('UPDATE')]
+            self.assertEqual(len(updates), 1)
+
+    def test_rebalance(self):
+        """Rebalance respaces the active elements in one query."""
+        for n, item in enumerate(OrderItem.objects.all(), start=1):
+            PQueue.objects.create(item=item, score=n)
+        completed = PQueue.objects.first()
+        completed.complete()
+        before = list(PQueue.objects.values_list('pk', flat=True))
+        with self.assertNumQueries(5):  # select, bounds, bulk update & sp
+            self.assertEqual(PQueue.objects.rebalance(1000), 2)
+        self.assertEqual(
+            list(PQueue.objects.values_list('pk', flat=True)), before)
+        self.assertEqual(
+            list(PQueue.objects.values_list('score', flat=True)),
+            [-2, 1003, 2003])
+
+        # Once spaced, the low range is used again
+        PQueue.objects.filter(pk=before[1]).update(score=5000)
+        PQueue.objects.rebalance(1000)
+        self.assertEqual(
+            list(PQueue.objects.values_list('score', flat=True)),
+            [-2, 1000, 2000])
+
+    def test_reorder(self):
+        """Reorder applies the whole new order in one update."""
+        for item in OrderItem.objects.all():
+            PQueue.objects.create(item=item)
+        first, mid, last = PQueue.objects.all()
+        pks = [last.pk, first.pk, mid.pk]
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                PQueue.objects.reorder(PQueue.objects.active(), pks, 1000), 3)
+        updates = [q['sql'] for q in ctx.captured_queries
+                   if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(
+            list(PQueue.objects.values_list('pk', flat=True)), pks)
+        self.assertEqual(
+            list(PQueue.objects.values_list('score', flat=True)),
+            [4000, 5000, 6000])
+
+    def test_reorder_only_locks_the_queue(self):
+        """Joined orders & items are not locked while reordering."""
+        for item in OrderItem.objects.all():
+            PQueue.objects.create(item=item)
+        pks = list(PQueue.objects.values_list('pk', flat=True))[::-1]
+        with CaptureQueriesContext(connection) as ctx:
+            PQueue.objects.reorder(PQueue.objects.live().active(), pks, 1000)
+        locks = [q['sql'] for q in ctx.captured_queries
+                 if 'FOR UPDATE' in q['sql']]
+        self.assertEqual(len(locks), 1)
+        self.assertIn('JOIN "orders_order"', locks[0])
+        self.assertTrue(locks[0].endswith('FOR UPDATE OF "orders_pqueue"'))
+
+    def test_reorder_must_match_the_queue(self):
+        """Missing, repeated or unknown elements are rejected."""
+        for item in OrderItem.objects.all():
+            PQueue.objects.create(item=item)
+        first, mid, last = PQueue.objects.all()
+        for pks in ([first.pk, mid.pk], [first.pk, mid.pk, mid.pk],
+                    [first.pk, mid.pk, last.pk, 2000]):
+            with self.assertRaises(ValueError):
+                PQueue.objects.reorder(PQueue.objects.active(), pks, 1000)
+        self.assertEqual(
+            list(PQueue.objects.values_list('score', flat=True)),
+            [1000, 2000, 3000])
 
     def test_complete(self):
         """Test complete method."""
@@ -2710,7 +3366,7 @@ class TestPQueue(TestCase):
             item.complete()
         first, mid, last = PQueue.objects.all()
         self.assertEqual((first.score, mid.score, last.score),
-                         (-3, -2, 1002))
+                         (-3, -2, 3000))
 
     def test_uncomplete(self):
         """Test ucomplete method."""
@@ -2724,7 +3380,7 @@ class TestPQueue(TestCase):
         PQueue.objects.create(item=OrderItem.objects.last())
         item.complete()
         item.uncomplete()
-        self.assertEqual(item.score, 1002)
+        self.assertEqual(item.score, 3000)
 
 
 class TestInvoice(TestCase):
@@ -2889,6 +3545,113 @@ class TestInvoice(TestCase):
             linestr, ('more than 25 characters', 'A very long string with'))
 
 
+class TestInvoiceNumbers(TestCase):
+    """Test the invoice numbers per fiscal year."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        self.customer = Customer.objects.create(
+            name='Customer Test', phone=0, cp=48100)
+        self.item = Item.objects.create(
+            name='Test item', fabrics=5, price=10, stocked=10)
+
+        # Killing orders archives their todoist project
+        patcher = mock.patch.object(Order, 'archive')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def invoice(self, issued_on=None, pay_method='C'):
+        """Issue the invoice of a new order."""
+        order = Order.objects.create(
+            user=self.user, customer=self.customer, ref_name='foo',
+            delivery=date.today())
+        OrderItem.objects.create(reference=order, element=self.item, price=10)
+        invoice = Invoice(reference=order, pay_method=pay_method)
+        if issued_on:
+            invoice.issued_on = issued_on
+        invoice.save(kill=True)
+        return invoice
+
+    def test_numbers_restart_each_fiscal_year(self):
+        last_year = timezone.now() - timedelta(days=366)
+        self.assertEqual(self.invoice(last_year).invoice_no, 1)
+        self.assertEqual(self.invoice(last_year).invoice_no, 2)
+        invoice = self.invoice()
+        self.assertEqual(invoice.invoice_no, 1)
+        self.assertEqual(invoice.fiscal_year, timezone.localdate().year)
+        self.assertEqual(self.invoice().invoice_no, 2)
+        self.assertEqual(
+            InvoiceCounter.objects.get(fiscal_year=last_year.year).last_no, 2)
+
+    def test_fiscal_year_is_local(self):
+        # New year's eve in Madrid is still the previous year in UTC
+        issued_on = datetime(2020, 12, 31, 23, 30, tzinfo=timezone.utc)
+        self.assertEqual(self.invoice(issued_on).fiscal_year, 2021)
+
+    def test_numbers_resume_from_the_counter(self):
+        InvoiceCounter.objects.create(
+            fiscal_year=timezone.localdate().year, last_no=41)
+        self.assertEqual(self.invoice().invoice_no, 42)
+
+    def test_failed_invoices_give_their_number_back(self):
+        with self.assertRaises(DataError):
+            self.invoice(pay_method='too long')
+        self.assertEqual(self.invoice().invoice_no, 1)
+
+    def test_several_saves_keep_the_number(self):
+        invoice = self.invoice()
+        invoice.pay_method = 'V'
+        invoice.save(kill=True)
+        self.assertEqual(invoice.invoice_no, 1)
+        self.assertEqual(self.invoice().invoice_no, 2)
+
+
+class TestInvoiceConcurrency(TransactionTestCase):
+    """Test invoicing many orders at once."""
+
+    serialized_rollback = True
+
+    def test_concurrent_kills_get_consecutive_numbers(self):
+        user = User.objects.create_user(username='user')
+        customer = Customer.objects.create(
+            name='Customer Test', phone=0, cp=48100)
+        item = Item.objects.create(
+            name='Test item', fabrics=5, price=10, stocked=10)
+        orders = list()
+        for _ in range(100):
+            order = Order.objects.create(
+                user=user, customer=customer, ref_name='foo',
+                delivery=date.today())
+            OrderItem.objects.create(reference=order, element=item, price=10)
+            orders.append(order.pk)
+
+        errors = list()
+
+        def kill(pks):
+            try:
+                for pk in pks:
+                    Order.objects.get(pk=pk).kill()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=kill, args=(orders[n::10], ))
+                   for n in range(10)]
+        with mock.patch.object(Order, 'archive'):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        numbers = Invoice.objects.order_by('invoice_no').values_list(
+            'invoice_no', flat=True)
+        self.assertEqual(list(numbers), list(range(1, 101)))
+        self.assertEqual(InvoiceCounter.objects.get().last_no, 100)
+
+
 class TestExpenseCategory(TestCase):
 
     def test_creation_is_a_date_time_field(self):
@@ -3606,6 +4369,57 @@ class TestStatusShift(TestCase):
         s1, _, s3 = StatusShift.objects.all()
         self.assertEqual(s1.last, s3)
 
+    def test_order_points_to_its_open_shift(self):
+        o = Order.objects.first()
+        self.assertEqual(o.current_shift, StatusShift.objects.get())
+        o.kanban_forward()
+        s1, s2 = StatusShift.objects.all()
+        self.assertEqual(o.current_shift, s2)
+        self.assertEqual(Order.objects.get().current_shift, s2)
+        self.assertEqual(s1.date_out, s2.date_in)
+
+        s2.delete()  # reopens the former
+        self.assertEqual(Order.objects.get().current_shift, s1)
+
+    def test_status_unchanged_touches_no_shift(self):
+        o = Order.objects.first()
+        o.ref_name = 'does not change status'
+        o.waist = 10
+        with CaptureQueriesContext(connection) as ctx:
+            o.save()
+        shift_queries = [q['sql'] for q in ctx.captured_queries
+                         if 'orders_statusshift' in q['sql']]
+        self.assertFalse(shift_queries)
+
+    def test_status_change_is_two_shift_writes(self):
+        o = Order.objects.first()
+        with CaptureQueriesContext(connection) as ctx:
+            o.kanban_forward()
+        shift_queries = [q['sql'].split()[0] for q in ctx.captured_queries
+                         if 'orders_statusshift' in q['sql']]
+        self.assertEqual(shift_queries, ['UPDATE', 'INSERT'])
+
+    def test_status_change_on_orders_not_loaded(self):
+        """Orders not read from the db compare with their open shift."""
+        o = Order.objects.first()
+        same = Order(**{f.attname: getattr(o, f.attname)
+                        for f in Order._meta.concrete_fields})
+        same._state.adding = False
+        same.save()
+        self.assertEqual(StatusShift.objects.count(), 1)
+        same.status = '2'
+        same.save()
+        self.assertEqual(StatusShift.objects.count(), 2)
+        self.assertEqual(Order.objects.get().current_shift.status, '2')
+
+    def test_invoiced_shift_is_closed_on_opening(self):
+        o = Order.objects.first()
+        o.status = '9'
+        o.save()
+        self.assertTrue(o.current_shift.date_out)
+        self.assertFalse(
+            StatusShift.objects.filter(date_out__isnull=True).exists())
+
 
 class TestTimetable(TestCase):
     """Test the timetable method."""
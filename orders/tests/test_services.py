@@ -0,0 +1,653 @@
+"""Test the services."""
+
+from datetime import date, datetime, time, timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import ProtectedError
+from django.template.loader import render_to_string
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from orders import settings
+from orders.models import (
+    CashFlowIO, Comment, Customer, Expense, Item, ItemTimeStats, Order,
+    OrderItem, PQueue, StockMovement, Timetable, )
+from orders.services import (
+    delete_customers, delete_orders, estimate_times, kanban_board,
+    kanban_delta, pqueue_eta, purge_quick_orders, receivables,
+    recompute_item_health, stock_tabs, )
+from orders.views import CommonContexts
+
+
+class ReceivablesTests(TestCase):
+    """Test the receivables service."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        self.customer = Customer.objects.create(
+            name='Customer Test', phone=0, cp=48100)
+        self.item = Item.objects.create(name='test', fabrics=10, price=30)
+
+    def create_order(self, price, **kwargs):
+        """Create an order with a single item of the given price."""
+        order = Order.objects.create(
+            user=self.user, customer=kwargs.pop('customer', self.customer),
+            ref_name='test', delivery=date.today(), **kwargs)
+        OrderItem.objects.create(
+            reference=order, element=self.item, price=price)
+        return order
+
+    def test_pending_amounts(self):
+        order = self.create_order(100, discount=10)
+        CashFlowIO.objects.create(order=order, amount=40)
+        pending = receivables()
+        self.assertEqual(len(pending['orders']), 1)
+        self.assertEqual(pending['orders'][0]['pk'], order.pk)
+        self.assertEqual(pending['orders'][0]['customer'], 'CUSTOMER TEST')
+        self.assertEqual(pending['orders'][0]['pending'], 50)
+        self.assertEqual(pending['total'], 50)
+
+    def test_matches_order_pending_property(self):
+        for price in (10, 33.3, 47.5):
+            self.create_order(price, discount=15)
+        expected = sum(o.pending for o in Order.live.all())
+        self.assertAlmostEqual(float(receivables()['total']), expected)
+
+    def test_excludes_unconfirmed_and_paid_orders(self):
+        self.create_order(100, confirmed=False)
+        order = self.create_order(100)
+        CashFlowIO.objects.create(order=order, amount=100)
+        self.assertEqual(receivables(), {'orders': [], 'total': 0})
+
+    def test_excludes_trapuzarrak(self):
+        tz = Customer.objects.create(name='Trapuzarrak', phone=0, cp=0)
+        self.create_order(100, customer=tz)
+        self.assertEqual(receivables()['total'], 0)
+
+    def test_excludes_non_live_orders(self):
+        self.create_order(100, status='9')
+        self.assertEqual(receivables()['total'], 0)
+
+    def test_constant_queries(self):
+        for _ in range(5):
+            self.create_order(100)
+        with self.assertNumQueries(1):
+            receivables()
+
+
+class KanbanBoardTests(TestCase):
+    """Test the kanban board builder."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        self.customer = Customer.objects.create(
+            name='Customer Test', phone=0, cp=48100)
+        self.item = Item.objects.create(name='test', fabrics=10, price=30)
+        self.foreign = Item.objects.create(
+            name='foreign', fabrics=0, price=10, foreing=True)
+        self.add_orders(5)
+
+    def add_orders(self, n):
+        """Spread n orders with items and comments across the columns."""
+        for idx in range(n):
+            order = Order.objects.create(
+                user=self.user, customer=self.customer, ref_name='test',
+                delivery=date.today())
+            OrderItem.objects.create(
+                reference=order, element=self.item, qty=2, price=30,
+                crop=timedelta(hours=1))
+            OrderItem.objects.create(
+                reference=order, element=self.foreign, price=10)
+            Comment.objects.create(
+                user=self.user, reference=order, comment='comment')
+
+            # Tracking times moves orders forward, so set the status last
+            Order.objects.filter(pk=order.pk).update(status=str(idx % 7 + 1))
+
+    def render_board(self):
+        """Build the board and render its columns."""
+        context = CommonContexts.kanban()
+        return render_to_string('includes/kanban_columns.html', context)
+
+    def test_query_budget(self):
+        with self.assertNumQueries(9):
+            self.render_board()
+
+    def test_queries_do_not_depend_on_board_size(self):
+        with CaptureQueriesContext(connection) as small:
+            self.render_board()
+        self.add_orders(30)
+        with CaptureQueriesContext(connection) as large:
+            self.render_board()
+        self.assertEqual(len(small), len(large))
+
+    def test_cards_match_order_properties(self):
+        Order.objects.create(
+            user=self.user, customer=self.customer, ref_name='empty',
+            delivery=date.today())
+        board = kanban_board()
+        for name in ('icebox', 'queued', 'in_progress', 'waiting', 'done'):
+            for card in board[name]:
+                order = Order.objects.get(pk=card.pk)
+                self.assertEqual(card.has_no_items, order.has_no_items)
+                self.assertEqual(card.missing_times, order.missing_times)
+                self.assertEqual(
+                    list(card.has_comments), list(order.has_comments))
+
+    def test_amounts_match_order_totals(self):
+        Order.objects.update(discount=10)
+        CashFlowIO.objects.create(order=Order.objects.first(), amount=15)
+        board = kanban_board()
+        columns = ('icebox', 'queued', 'in_progress', 'waiting', 'done')
+        for n, name in enumerate(columns):
+            self.assertAlmostEqual(
+                board['amounts'][n], sum(o.total for o in board[name]))
+            self.assertAlmostEqual(
+                board['already_paid'][n],
+                sum(o.already_paid for o in board[name]))
+
+    def test_done_leaves_express_tickets_out(self):
+        Order.objects.filter(status='5').update(status='7')
+        before = kanban_delta(Order.objects.first().pk)['totals']['done']
+        express = Customer.objects.create(name='EXPRESS', phone=0, cp=48100)
+        ticket = Order.objects.create(
+            user=self.user, customer=express, ref_name='Quick',
+            delivery=date.today(), status='7')
+        OrderItem.objects.create(
+            reference=ticket, element=self.item, price=10, stock=True)
+        CashFlowIO.objects.create(order=ticket, amount=5)
+
+        board = kanban_board()
+        self.assertEqual(
+            list(board['done']), list(Order.live.filter(status='7').exclude(
+                customer__name__iexact='trapuzarrak').order_by(
+                    'delivery', 'pk')))
+        self.assertEqual(board['done'].count(), 1)
+        self.assertEqual(
+            board['amounts'][-1], sum(o.total for o in board['done']))
+        delta = kanban_delta(ticket.pk)
+        self.assertIsNone(delta['column'])
+        self.assertEqual(delta['totals']['done'], before)
+
+    def test_estimated_times_match_order_estimations(self):
+        board = kanban_board()
+        for n, name in enumerate(('icebox', 'queued')):
+            expected = sum(sum(o.estimated_time) for o in board[name])
+            self.assertAlmostEqual(board['est_times'][n], expected)
+
+    def test_delta_queries_do_not_depend_on_board_size(self):
+        order = Order.objects.filter(status='2').first()
+        with CaptureQueriesContext(connection) as small:
+            kanban_delta(order.pk)
+        self.add_orders(30)
+        with CaptureQueriesContext(connection) as large:
+            kanban_delta(order.pk)
+        self.assertEqual(len(small), len(large))
+
+    def test_delta_totals_match_the_board(self):
+        order = Order.objects.filter(status='2').first()
+        delta, board = kanban_delta(order.pk), kanban_board()
+        self.assertEqual(delta['column'], 'queued')
+        self.assertEqual(delta['position'], 0)
+        names = ('icebox', 'queued', 'in_progress', 'waiting', 'done')
+        for n, name in enumerate(names):
+            totals = delta['totals'][name]
+            self.assertEqual(totals['count'], board[name].count())
+            self.assertEqual(totals['amount'], board['amounts'][n])
+            self.assertEqual(totals['already_paid'], board['already_paid'][n])
+
+
+class EstimateTimesTests(TestCase):
+    """Test the batch estimation of times."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        items = [Item.objects.create(name=str(n), fabrics=10, price=30)
+                 for n in range(3)]
+        self.orders = [Order.objects.create(
+            user=u, customer=c, ref_name='test', delivery=date.today())
+            for _ in range(3)]
+
+        # Track some times to get the averages
+        for n, item in enumerate(items):
+            OrderItem.objects.create(
+                reference=self.orders[0], element=item, qty=n + 1, price=10,
+                crop=timedelta(seconds=10 * n + 5),
+                sewing=timedelta(minutes=n), iron=timedelta(seconds=7))
+
+        # And some untracked ones to estimate
+        for n, item in enumerate(items):
+            OrderItem.objects.create(
+                reference=self.orders[1], element=item, qty=2 * n + 1,
+                price=10)
+        OrderItem.objects.create(
+            reference=self.orders[1], element=items[0], qty=3, price=10,
+            stock=True)
+
+    def test_matches_order_estimated_time(self):
+        estimations = estimate_times(Order.objects.all())
+        for order in Order.objects.all():
+            for est, expected in zip(
+                    estimations[order.pk], order.estimated_time):
+                self.assertAlmostEqual(est, expected, places=3)
+
+    def test_orders_without_items(self):
+        estimations = estimate_times(Order.objects.all())
+        self.assertEqual(estimations[self.orders[2].pk], (0, 0, 0))
+
+    def test_only_given_orders_are_estimated(self):
+        orders = Order.objects.filter(pk=self.orders[1].pk)
+        self.assertEqual(list(estimate_times(orders)), [self.orders[1].pk])
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            estimate_times(Order.objects.all())
+
+
+class PQueueETATests(TestCase):
+    """Test the simulation of the production queue."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        item = Item.objects.create(name='test', fabrics=10, price=30)
+
+        # Items take 1h to crop and 1h to sew
+        tracked = Order.objects.create(
+            user=self.user, customer=c, ref_name='test', delivery=date.today())
+        OrderItem.objects.create(
+            reference=tracked, element=item, qty=1, price=10,
+            crop=timedelta(hours=1), sewing=timedelta(hours=1))
+
+        # So, queued ones take 4h each
+        self.order = Order.objects.create(
+            user=self.user, customer=c, ref_name='test',
+            delivery=date.today())
+        self.queued = list()
+        for _ in range(3):
+            oi = OrderItem.objects.create(
+                reference=self.order, element=item, qty=2, price=10)
+            self.queued.append(PQueue.objects.create(item=oi))
+
+    def add_capacity(self, hours=8):
+        """Record the same hours every day of the history."""
+        for n in range(1, 29):
+            Timetable.objects.create(
+                user=self.user, start=timezone.now() - timedelta(days=n),
+                hours=timedelta(hours=hours))
+
+    def at(self, days, hour, minute=0):
+        """Get the aware datetime of the given hour days from today."""
+        day = date.today() + timedelta(days=days)
+        return timezone.make_aware(
+            datetime.combine(day, time(hour, minute)))
+
+    def test_follows_score_order(self):
+        self.queued[2].top()
+        self.assertEqual([e['pk'] for e in pqueue_eta()], [
+            self.queued[2].pk, self.queued[0].pk, self.queued[1].pk])
+
+    def test_estimates_untracked_phases(self):
+        self.assertEqual(
+            [e['estimated'] for e in pqueue_eta()], [4 * 3600] * 3)
+        OrderItem.objects.filter(pk=self.queued[0].pk).update(
+            crop=timedelta(minutes=5))
+        self.assertEqual(pqueue_eta()[0]['estimated'], 2 * 3600)
+
+    def test_no_capacity(self):
+        for entry in pqueue_eta():
+            self.assertIsNone(entry['eta'])
+            self.assertFalse(entry['late'])
+
+    def test_spreads_workload_over_capacity(self):
+        self.add_capacity()
+        eta = pqueue_eta()
+        self.assertEqual([e['eta'] for e in eta], [
+            self.at(0, 15), self.at(0, 20), self.at(1, 15)])
+        self.assertEqual([e['late'] for e in eta], [False, False, True])
+
+    def test_hours_spent_today(self):
+        self.add_capacity()
+        Timetable.objects.create(
+            user=self.user, start=timezone.now(), hours=timedelta(hours=4))
+        self.assertEqual(
+            [e['eta'] for e in pqueue_eta()],
+            [self.at(0, 20), self.at(1, 15), self.at(1, 20)])
+
+    def test_excludes_completed_and_delivered(self):
+        self.queued[0].complete()
+        Order.objects.filter(pk=self.order.pk).update(status='7')
+        self.assertEqual(pqueue_eta(), [])
+
+    def test_constant_queries(self):
+        self.add_capacity()
+        with self.assertNumQueries(3):
+            pqueue_eta()
+
+
+class RecomputeItemHealthTests(TestCase):
+    """Test the bulk recomputation of the item health."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        tz = Customer.objects.create(name='trapuzarrak', phone=0, cp=48100)
+        self.items = [Item.objects.create(
+            name=str(n), fabrics=10, price=30, stocked=n * 4)
+            for n in range(4)]
+
+        def sell(customer, ref_name, days, qtys):
+            order = Order.objects.create(
+                user=u, customer=customer, ref_name=ref_name,
+                delivery=date.today() - timedelta(days=days))
+            for item, qty in zip(self.items, qtys):
+                if qty:
+                    OrderItem.objects.create(
+                        reference=order, element=item, qty=qty, price=10)
+
+        sell(c, 'regular', 10, (1, 2, ))
+        sell(c, 'Quick', 400, (0, 3, 5, ))
+        sell(tz, 'Quick', 10, (0, 0, 7, 1))
+        sell(c, 'Quick', 10, (0, 0, 0, 2))
+        Order.objects.update(status='9')
+        sell(c, 'Quick', 10, (0, 0, 0, 9))  # Not invoiced yet
+
+        # Bulk updates skip the hooks
+        Item.objects.update(total_sales=0, year_sales=0, health=0)
+
+    def figures(self):
+        """Get the stored figures of the items."""
+        return list(Item.objects.order_by('pk').values_list(
+            'total_sales', 'year_sales', 'health'))
+
+    def test_matches_item_save(self):
+        recompute_item_health()
+        bulk = self.figures()
+        for item in Item.objects.all():
+            item.save()
+        self.assertEqual(bulk, self.figures())
+
+    def test_only_changed_items_are_written(self):
+        self.assertEqual(recompute_item_health(), Item.objects.count())
+        self.assertEqual(recompute_item_health(), 0)
+
+    def test_given_items(self):
+        self.assertEqual(recompute_item_health(self.items[1:3]), 2)
+        self.assertEqual(recompute_item_health(
+            Item.objects.filter(pk=self.items[3].pk)), 1)
+        self.assertEqual(Item.objects.get(pk=self.items[0].pk).health, 0)
+
+    def test_constant_queries(self):
+        with self.assertNumQueries(2):
+            recompute_item_health()
+        Item.objects.create(name='new', fabrics=10, price=30)
+        Item.objects.update(health=0)
+        with self.assertNumQueries(2):
+            recompute_item_health()
+
+
+class StockTabsTests(TestCase):
+    """Test the bucketed stock manager tabs."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        healths = {'p1': (0, 0, 0), 'p2': (0.5, 0.2), 'p3': (3, 1, 2, 300),
+                   'zero': (-100, ), 'negative': (-2, -5, )}
+        self.items = dict()
+        for tab, values in healths.items():
+            self.items[tab] = list()
+            for health in values:
+                item = Item.objects.create(name=tab, fabrics=1, price=10)
+                Item.objects.filter(pk=item.pk).update(health=health)
+                self.items[tab].append(Item.objects.get(pk=item.pk))
+            self.items[tab].sort(key=lambda i: (i.health, i.pk))
+
+    def test_buckets(self):
+        tabs = stock_tabs()
+        for tab, items in self.items.items():
+            self.assertEqual(tabs[tab]['elements'], items)
+            self.assertEqual(tabs[tab]['count'], len(items))
+            self.assertIsNone(tabs[tab]['next'])
+
+    def test_default_item_is_excluded(self):
+        tabs = stock_tabs()
+        for tab in tabs.values():
+            for item in tab['elements']:
+                self.assertNotEqual(item.name, 'Predeterminado')
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            stock_tabs()
+
+    def test_filtered_items(self):
+        tabs = stock_tabs(Item.objects.filter(name='p3'))
+        self.assertEqual(tabs['p3']['count'], 4)
+        self.assertEqual(tabs['p1']['elements'], [])
+        self.assertEqual(tabs['p1']['count'], 0)
+
+    def test_keyset_pages(self):
+        with mock.patch.object(settings, 'STOCK_TAB_SIZE', 3):
+            tabs = stock_tabs()
+            self.assertEqual(tabs['p3']['elements'], self.items['p3'][:3])
+            self.assertEqual(tabs['p3']['count'], 4)
+            self.assertIsNone(tabs['p1']['next'])
+
+            cursor = tabs['p3']['next']
+            self.assertEqual(cursor, (
+                self.items['p3'][2].health, self.items['p3'][2].pk))
+            tabs = stock_tabs(after={'p3': cursor})
+        self.assertEqual(tabs['p3']['elements'], self.items['p3'][3:])
+        self.assertEqual(tabs['p3']['count'], 4)
+        self.assertIsNone(tabs['p3']['next'])
+        self.assertEqual(tabs['p1']['elements'], self.items['p1'])
+
+    def test_keyset_pages_on_health_ties(self):
+        with mock.patch.object(settings, 'STOCK_TAB_SIZE', 2):
+            first = stock_tabs()['p1']
+            second = stock_tabs(after={'p1': first['next']})['p1']
+        self.assertEqual(
+            first['elements'] + second['elements'], self.items['p1'])
+
+
+class DeleteOrdersTests(TestCase):
+    """Test the bulk deletion of orders & customers."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        self.customer = Customer.objects.create(
+            name='Customer Test', phone=0, cp=48100)
+        self.item = Item.objects.create(
+            name='test', fabrics=10, price=30, stocked=20)
+        self.foreign = Item.objects.create(
+            name='foreign', fabrics=10, price=30, stocked=20, foreing=True)
+
+    def order(self, customer=None, qtys=(1, 1, 1)):
+        """Create an order with a stock, a foreign & a regular item."""
+        order = Order.objects.create(
+            user=self.user, customer=customer or self.customer,
+            ref_name='test', delivery=date.today())
+        stock, foreign, regular = qtys
+        for item, qty, in_stock in (
+                (self.item, stock, True), (self.foreign, foreign, False),
+                (self.item, regular, False)):
+            StockMovement.objects.move(item, -qty, 'S')
+            OrderItem.objects.create(
+                reference=order, element=item, qty=qty, price=10,
+                stock=in_stock, sewing=timedelta(hours=1))
+        return order
+
+    def stocked(self):
+        """Get the stock of both items."""
+        return list(Item.objects.filter(
+            pk__in=(self.item.pk, self.foreign.pk)).order_by('pk').values_list(
+                'stocked', flat=True))
+
+    def test_stock_is_given_back(self):
+        self.order(qtys=(2, 3, 4))
+        self.order(qtys=(1, 1, 1))
+        self.assertEqual(self.stocked(), [12, 16])
+
+        self.assertEqual(delete_orders(Order.objects.all()), 2)
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OrderItem.objects.exists())
+        # Regular items don't return their qty
+        self.assertEqual(self.stocked(), [15, 20])
+
+    def test_matches_order_delete(self):
+        bulk, single = self.order(qtys=(2, 3, 4)), self.order(qtys=(2, 3, 4))
+        delete_orders([bulk])
+        after_bulk = self.stocked()
+        single.delete()
+        self.assertEqual(
+            [s - b for s, b in zip(self.stocked(), after_bulk)], [2, 3])
+        self.assertFalse(Order.objects.exists())
+
+    def test_time_stats_are_rebuilt(self):
+        kept = self.order()
+        self.order()
+        delete_orders([o.pk for o in Order.objects.exclude(pk=kept.pk)])
+        stats = ItemTimeStats.objects.get(item=self.item)
+        self.assertEqual(stats.sewing_qty, 1)  # Stock items have no times
+
+    def test_constant_queries(self):
+        def count():
+            with CaptureQueriesContext(connection) as ctx:
+                delete_orders(Order.objects.all())
+            return len(ctx.captured_queries)
+
+        self.order()
+        single = count()
+        for _ in range(10):
+            self.order()
+        self.assertEqual(count(), single)
+
+    def test_delete_customers(self):
+        other = Customer.objects.create(name='Other', phone=0, cp=48100)
+        self.order()
+        kept = self.order(customer=other)
+        self.assertEqual(delete_customers([self.customer.pk]), 1)
+        self.assertFalse(Customer.objects.filter(
+            pk=self.customer.pk).exists())
+        self.assertEqual(list(Order.objects.all()), [kept])
+        self.assertEqual(self.stocked(), [17, 19])
+
+    def test_delete_customers_is_atomic(self):
+        self.customer.address, self.customer.city = 'address', 'city'
+        self.customer.CIF, self.customer.provider = '5555G', True
+        self.customer.save()
+        Expense.objects.create(
+            issuer=self.customer, invoice_no='Test', issued_on=date.today(),
+            concept='Concept', amount=100, )
+        self.order()
+        with self.assertRaises(ProtectedError):
+            delete_customers(Customer.objects.all())
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(self.stocked(), [18, 19])
+
+
+class PurgeQuickOrdersTests(TestCase):
+    """Test the purge of the abandoned express orders."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        self.user = User.objects.create_user(username='user')
+        self.express = Customer.objects.create(
+            name='express', phone=0, cp=48100)
+        self.item = Item.objects.create(
+            name='test', fabrics=10, price=30, stocked=10)
+        self.old = timezone.now() - timedelta(
+            minutes=settings.QUICK_ORDER_TIMEOUT + 1)
+
+    def order(self, ref_name='Quick', status='7', qty=0, stock=True,
+              old=True):
+        """Create an express order with an item taking qty from the stock."""
+        order = Order.objects.create(
+            user=self.user, customer=self.express, ref_name=ref_name,
+            delivery=date.today(), status=status)
+        if qty:
+            StockMovement.objects.move(self.item, -qty, 'S')
+            OrderItem.objects.create(
+                reference=order, element=self.item, qty=qty, price=10,
+                stock=stock, crop=timedelta(hours=1))
+        if old:
+            Order.objects.filter(pk=order.pk).update(inbox_date=self.old)
+        return order
+
+    def test_abandoned_orders_are_deleted(self):
+        abandoned = [self.order(), self.order(ref_name='quick')]
+        kept = [
+            self.order(old=False),  # Still open at the counter
+            self.order(status='9'),
+            self.order(ref_name='regular'),
+        ]
+        self.assertEqual(purge_quick_orders(), 2)
+        self.assertFalse(Order.objects.filter(
+            pk__in=[o.pk for o in abandoned]).exists())
+        self.assertEqual(Order.objects.filter(
+            pk__in=[o.pk for o in kept]).count(), 3)
+
+    def test_stock_is_given_back(self):
+        self.order(qty=2)
+        self.order(qty=3)
+        self.order(ref_name='quick', qty=4, stock=False)  # Not affected
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stocked, 1)
+
+        purge_quick_orders()
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stocked, 6)
+        movement = StockMovement.objects.last()
+        self.assertEqual(
+            (movement.item, movement.qty, movement.reason),
+            (self.item, 5, 'D'))
+
+    def test_time_stats_are_rebuilt(self):
+        self.order(qty=2, stock=False)
+        self.order(ref_name='regular', qty=1, stock=False)
+        stats = ItemTimeStats.objects.get(item=self.item)
+        self.assertEqual(stats.crop_qty, 3)
+
+        purge_quick_orders()
+        stats = ItemTimeStats.objects.get(item=self.item)
+        self.assertEqual(stats.crop_total, timedelta(hours=1))
+        self.assertEqual(stats.crop_qty, 1)
+
+    def test_deletes_in_batches(self):
+        for _ in range(3):
+            self.order(qty=1)
+        self.assertEqual(purge_quick_orders(batch_size=2), 3)
+        self.assertFalse(Order.objects.exists())
+        self.item.refresh_from_db()
+        self.assertEqual(self.item.stocked, 10)
+
+    def test_constant_queries(self):
+        self.order(qty=1)
+
+        def count():
+            with CaptureQueriesContext(connection) as ctx:
+                purge_quick_orders()
+            return len(ctx.captured_queries)
+
+        single = count()
+        for _ in range(10):
+            self.order(qty=1)
+        self.assertEqual(count(), single)
+
+    def test_order_save_does_not_purge(self):
+        abandoned = self.order()
+        order = Order.objects.create(
+            user=self.user, customer=self.express, ref_name='regular',
+            delivery=date.today())
+        order.status = '7'
+        order.save()
+        self.assertTrue(Order.objects.filter(pk=abandoned.pk).exists())
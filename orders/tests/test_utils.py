@@ -5,7 +5,8 @@ from datetime import date, timedelta
 from django.test import TestCase
 
 from orders import settings
-from orders.utils import WeekColor, prettify_times
+from orders.models import Item
+from orders.utils import WeekColor, item_label, prettify_times
 
 
 class WeekColorTest(TestCase):
@@ -66,3 +67,25 @@ class PrettifyTimesTest(TestCase):
     def test_seconds(self):
         s = prettify_times(50)
         self.assertEqual(s, '50s')
+
+
+class ItemLabelTest(TestCase):
+
+    def setUp(self):
+        item_label.cache_clear()
+
+    def test_renders_once_per_label(self):
+        first = item_label('Falda', 'Test', 'Standard', '12')
+        self.assertIn('Falda Test', first)
+        self.assertIn('T-12', first)
+        second = item_label('Falda', 'Test', 'Standard', '12')
+        self.assertIs(first, second)
+        self.assertEqual(item_label.cache_info().hits, 1)
+
+    def test_edited_items_get_their_new_label(self):
+        item = Item.objects.create(name='Before', fabrics=5)
+        self.assertIn('Before', item.html_string)
+        item.name = 'After'
+        item.save()
+        self.assertIn('After', Item.objects.get(pk=item.pk).html_string)
+        self.assertNotIn('Before', item.html_string)
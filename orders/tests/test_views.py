@@ -3,12 +3,16 @@
 import json
 from datetime import date, timedelta, datetime
 from random import randint
+from unittest import mock
 
 from django import forms
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.db import connection
 from django.http import JsonResponse, Http404, FileResponse
-from django.test import Client, TestCase, tag
+from django.test import Client, RequestFactory, TestCase, tag
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, NoReverseMatch
 from django.utils import timezone
 
@@ -335,7 +339,7 @@ class CommonContextKanbanTests(TestCase):
 
     def test_queued_amounts(self):
         """Test the aggregates for queued orders."""
-        for o in Order.objects.all()[1:4]:
+        for o in Order.objects.order_by('pk')[1:4]:
             o.status = '2'
             o.save()
 
@@ -355,7 +359,7 @@ class CommonContextKanbanTests(TestCase):
 
     def test_waiting_amounts(self):
         """Test the aggregates for queued orders."""
-        for o in Order.objects.all()[1:4]:
+        for o in Order.objects.order_by('pk')[1:4]:
             o.status = '6'
             o.save()
 
@@ -364,7 +368,7 @@ class CommonContextKanbanTests(TestCase):
 
     def test_done_amounts(self):
         """Test the aggregates for queued orders."""
-        for o in Order.objects.all()[1:4]:
+        for o in Order.objects.order_by('pk')[1:4]:
             o.status = '7'
             o.save()
 
@@ -422,6 +426,53 @@ class CommonContextKanbanTests(TestCase):
             CommonContexts.kanban()['est_times'][1], '{}h'.format(est))
 
 
+class CommonContextKanbanCardsTests(TestCase):
+    """Test the cached kanban cards."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        cache.clear()
+        u = User.objects.create_user(username='user')
+        c = Customer.objects.create(name='Customer Test', phone=0, cp=48100)
+        self.order = Order.objects.create(
+            user=u, customer=c, ref_name='first name', delivery=date.today())
+
+    def test_cards_are_rendered(self):
+        order = CommonContexts.kanban()['icebox'][0]
+        self.assertIn('first name', order.card)
+        self.assertIn('js-kanban', order.card)
+
+    def test_cards_are_reused_until_the_order_changes(self):
+        CommonContexts.kanban()
+
+        # Bulk updates skip the version bump so the cached card remains
+        Order.objects.update(ref_name='second name')
+        order = CommonContexts.kanban()['icebox'][0]
+        self.assertIn('first name', order.card)
+
+        self.order.ref_name = 'second name'
+        self.order.save()
+        order = CommonContexts.kanban()['icebox'][0]
+        self.assertIn('second name', order.card)
+
+    def test_cards_render_the_csrf_token_of_each_request(self):
+        CommonContexts.kanban()
+        order = CommonContexts.kanban()['icebox'][0]
+        self.assertIn('name="csrfmiddlewaretoken" value=""', order.card)
+
+        request = RequestFactory().get('/')
+        order = CommonContexts.kanban(request=request)['icebox'][0]
+        self.assertNotIn('KANBAN-CSRF-TOKEN', order.card)
+        self.assertNotIn('name="csrfmiddlewaretoken" value=""', order.card)
+        self.assertTrue(request.META['CSRF_COOKIE'])
+
+    def test_cached_cards_skip_rendering(self):
+        orders = CommonContexts.kanban()['icebox']
+        with mock.patch('orders.views.render_to_string') as render:
+            CommonContexts.kanban_cards(orders)
+        render.assert_not_called()
+
+
 class CommonContextOrderDetails(TestCase):
     """Test the common vars for both AJAX and regular views.
 
@@ -571,9 +622,10 @@ class CommonContextStockTabs(TestCase):
             k.save()
         o.kill()  # Sell something to change health
 
+        for i in items:
+            i.save()  # Update health
         cc = CommonContexts.stock_tabs()
         for name, i in zip(('p1', 'p2', 'p3', 'zero', 'negative'), items):
-            i.save()  # Update health
             self.assertEqual(cc['tab_elements'][name][0], i)
 
     def test_tab_item_types(self):
@@ -763,6 +815,38 @@ class CommonContextPqueue(TestCase):
             if context['i_relax'] not in settings.RELAX_ICONS:
                 raise ValueError('Not in list')
 
+    def test_item_labels_are_precomputed(self):
+        """Every row carries the rendered label of its item."""
+        first, last = OrderItem.objects.all()[:2]
+        PQueue.objects.create(item=first)
+        context = CommonContexts.pqueue()
+        self.assertEqual(context['available'][0].element.label,
+                         last.element.html_string)
+        self.assertEqual(context['active'][0].item.element.label,
+                         first.element.html_string)
+
+    def test_constant_queries(self):
+        """Neither building nor walking the context depends on its size."""
+        PQueue.objects.create(item=OrderItem.objects.first())
+        with CaptureQueriesContext(connection) as small:
+            context = CommonContexts.pqueue()
+            for q in context['active']:
+                q.item.reference.customer.name
+
+        order, element = Order.objects.first(), Item.objects.first()
+        OrderItem.objects.bulk_create(
+            OrderItem(reference=order, element=element, price=30)
+            for _ in range(500))
+        PQueue.objects.bulk_create(
+            PQueue(item=item, score=1000 * n) for n, item in enumerate(
+                OrderItem.objects.filter(pqueue__isnull=True), start=2))
+        with CaptureQueriesContext(connection) as large:
+            context = CommonContexts.pqueue()
+            for q in context['active']:
+                q.item.reference.customer.name
+        self.assertEqual(len(context['active']), 502)
+        self.assertEqual(len(large), len(small))
+
 
 class PrintableTicketTests(TestCase):
     """Test the printable ticket view."""
@@ -784,9 +868,9 @@ class PrintableTicketTests(TestCase):
 
     def test_printable_ticket_requires_login(self):
         self.client = Client()
-        login_url = '/accounts/login/?next=/ticket_print%26invoice_no%253D1'
+        login_url = '/accounts/login/?next=/ticket_print%26invoice%253D1'
         resp = self.client.get(
-            reverse('ticket_print', kwargs={'invoice_no': 1}))
+            reverse('ticket_print', kwargs={'pk': 1}))
         self.assertEqual(resp.status_code, 302)
         self.assertRedirects(resp, login_url)
 
@@ -795,12 +879,12 @@ class PrintableTicketTests(TestCase):
             self.client.get(reverse('ticket_print'))
         with self.assertRaises(NoReverseMatch):
             self.client.get(reverse('ticket_print',
-                                    kwargs={'invoice_no': 1e5}))
+                                    kwargs={'pk': 1e5}))
 
     def test_printable_ticket_outputs_a_file(self):
         invoice = Invoice.objects.last()
         resp = self.client.get(
-            reverse('ticket_print', kwargs={'invoice_no': invoice.invoice_no}))
+            reverse('ticket_print', kwargs={'pk': invoice.pk}))
         self.assertIsInstance(resp, FileResponse)
 
 
@@ -2654,6 +2738,22 @@ class StockManagerTests(TestCase):
         i = Item.objects.filter(item_type='2')
         self.assertEqual(resp.context['tab_elements']['negative'][0], i[0])
 
+    def test_stock_manager_pages_tabs(self):
+        last = Item.objects.get(item_type='2')
+        cursor = '{}_{}'.format(last.health, last.pk)
+        resp = self.client.get(reverse('stock_manager'), {'negative': cursor})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['active_tab'], 'negative')
+        self.assertEqual(
+            resp.context['tab_elements']['negative'],
+            [Item.objects.get(item_type='3')])
+
+    def test_stock_manager_ignores_invalid_cursors(self):
+        resp = self.client.get(reverse('stock_manager'), {'negative': 'a_b'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.context['active_tab'], 'p1')
+        self.assertEqual(len(resp.context['tab_elements']['negative']), 2)
+
 
 @tag('todoist')
 class OrderViewTests(TestCase):
@@ -2691,6 +2791,21 @@ class OrderViewTests(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertFalse(Timetable.objects.filter(user=su))
 
+    def test_status_tracker(self):
+        """The tracker pairs the icons with the last shift on each status."""
+        order = Order.objects.first()
+        order.kanban_forward()
+        order.kanban_backward()
+        request = RequestFactory().get(reverse('order_view', args=[order.pk]))
+        request.user = User.objects.first()
+        shifts = order.status_shift.order_by('pk')
+        tracker = CommonContexts.order_details(
+            request, order.pk)['status_tracker']
+        self.assertEqual(len(tracker), 6)
+        self.assertEqual(tracker[0], (settings.STATUS_ICONS[0], shifts[2]))
+        self.assertEqual(tracker[1], (settings.STATUS_ICONS[1], shifts[1]))
+        self.assertIsNone(tracker[2][1])
+
     def test_timetable_required_creates_timetable(self):
         """When no working session is open a timetable should be created."""
         self.assertFalse(Timetable.objects.all())
@@ -2945,6 +3060,43 @@ class OrderViewTests(TestCase):
                          (order.pk, order.customer.name, order.ref_name))
 
 
+class LeadTimesDashboardTests(TestCase):
+    """Test the lead times dashboard."""
+
+    def setUp(self):
+        """Create the elements at once."""
+        user = User.objects.create_user(username='regular', password='test')
+        customer = Customer.objects.create(
+            name='Test', city='Bilbao', phone=0, cp=48003)
+        order = Order.objects.create(
+            customer=customer, user=user, ref_name='Test',
+            delivery=date.today(), budget=100, prepaid=0, )
+        item = Item.objects.create(name='Test', fabrics=5, item_type='1')
+        OrderItem.objects.create(reference=order, element=item, price=10)
+        order.kanban_forward()
+        self.client.login(username='regular', password='test')
+
+    def test_by_month(self):
+        resp = self.client.get(reverse('lead_times'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertTemplateUsed(resp, 'tz/lead_times.html')
+        self.assertEqual(resp.context['by'], 'month')
+        row, = resp.context['rows']
+        self.assertEqual(row['group'], date.today().strftime('%m/%Y'))
+        self.assertEqual(row['status'], 'Icebox')
+        self.assertEqual(row['count'], 1)
+        self.assertEqual(len(row['percentiles']), 3)
+
+    def test_by_type(self):
+        resp = self.client.get(reverse('lead_times'), {'by': 'type'})
+        self.assertEqual(resp.context['by'], 'type')
+        self.assertEqual(resp.context['rows'][0]['group'], 'Falda')
+
+    def test_unknown_grouping_falls_back_to_month(self):
+        resp = self.client.get(reverse('lead_times'), {'by': 'foo'})
+        self.assertEqual(resp.context['by'], 'month')
+
+
 class OrderExpressTests(TestCase):
     """Test the order express view."""
 
@@ -3537,6 +3689,31 @@ class PQueueTabletTests(TestCase):
 
         self.client.login(username='regular', password='test')
 
+    def test_constant_queries(self):
+        """A 500 items queue takes the same queries than a short one."""
+        order = Order.objects.first()
+        order.confirmed = True
+        order.save()
+        for item in OrderItem.objects.all():
+            PQueue.objects.create(item=item)
+        self.client.get(reverse('pqueue_tablet'))  # open the timetable
+        with CaptureQueriesContext(connection) as small:
+            resp = self.client.get(reverse('pqueue_tablet'))
+        self.assertEqual(resp.status_code, 200)
+
+        elements = Item.objects.all()
+        OrderItem.objects.bulk_create(
+            OrderItem(reference=order, element=elements[n % 2], price=30)
+            for n in range(500))
+        PQueue.objects.bulk_create(
+            PQueue(item=item, score=1000 * n) for n, item in enumerate(
+                OrderItem.objects.filter(pqueue__isnull=True), start=3))
+        with CaptureQueriesContext(connection) as large:
+            resp = self.client.get(reverse('pqueue_tablet'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(resp.context['active']), 502)
+        self.assertEqual(len(large), len(small))
+
     def test_timetable_required_skips_superusers_or_voyeur(self):
         """Superusers & voyeur don't track times."""
         voyeur = config('VOYEUR_USER')
@@ -4968,21 +5145,84 @@ class OrdersCRUDTests(TestCase):
                                  'action': 'kanban-jump',
                                  'test': True,
                                  })
-        common_vars = ('icebox', 'queued', 'in_progress', 'waiting', 'done',
-                       'update_date', 'amounts')
-        for var in common_vars:
+        for var in ('order', 'update_date', ):
             self.assertTrue(var in resp.context)
-        self.assertTemplateUsed(resp, 'includes/kanban_columns.html')
+        self.assertTemplateUsed(resp, 'includes/kanban_element.html')
 
     def test_post_kanban_jump_origin_kanban_view_json_response(self):
+        order = Order.objects.first()
         resp = self.client.post(reverse('orders-CRUD'),
                                 {'origin': 'kanban-shiftFwd',
-                                 'pk': Order.objects.first().pk,
+                                 'pk': order.pk,
                                  'action': 'kanban-jump',
                                  })
         data = json.loads(str(resp.content, 'utf-8'))
-        self.assertEqual(data['html_id'], '#kanban-columns')
+        self.assertEqual(data['html_id'], '#kanban-card-{}'.format(order.pk))
         self.assertTrue(data['form_is_valid'])
+        self.assertIn('id="kanban-card-{}"'.format(order.pk), data['html'])
+
+    def test_post_kanban_jump_delta_moves_the_card(self):
+        order = Order.objects.first()
+        resp = self.client.post(reverse('orders-CRUD'),
+                                {'origin': 'kanban-shiftFwd',
+                                 'pk': order.pk,
+                                 'action': 'kanban-jump',
+                                 })
+        data = json.loads(str(resp.content, 'utf-8'))
+        order.refresh_from_db()
+        column = {'2': 'queued', '3': 'in_progress'}[order.status]
+        self.assertEqual(data['column'], column)
+        self.assertEqual(data['position'], 0)
+
+    def test_post_kanban_jump_delta_updates_column_totals(self):
+        order = Order.objects.first()
+        resp = self.client.post(reverse('orders-CRUD'),
+                                {'origin': 'kanban-shiftFwd',
+                                 'pk': order.pk,
+                                 'action': 'kanban-jump',
+                                 })
+        data = json.loads(str(resp.content, 'utf-8'))
+        board = CommonContexts.kanban()
+        columns = ('icebox', 'queued', 'in_progress', 'waiting', 'done', )
+        self.assertEqual(set(data['columns']), set(columns))
+        for n, name in enumerate(columns):
+            self.assertEqual(
+                data['columns'][name]['count'], board[name].count())
+            self.assertIn('{}€'.format(board['amounts'][n]),
+                          data['columns'][name]['totals'])
+
+    def test_post_kanban_jump_delta_position(self):
+        order = Order.objects.first()
+        order.status = '2'
+        order.delivery = date.today() + timedelta(days=10)
+        order.save()
+        for delay in (5, 15):
+            Order.objects.create(
+                user=order.user, customer=order.customer, ref_name='test',
+                delivery=date.today() + timedelta(days=delay), status='3')
+        resp = self.client.post(reverse('orders-CRUD'),
+                                {'origin': 'kanban-shiftFwd',
+                                 'pk': order.pk,
+                                 'action': 'kanban-jump',
+                                 })
+        data = json.loads(str(resp.content, 'utf-8'))
+        self.assertEqual(data['column'], 'in_progress')
+        self.assertEqual(data['position'], 1)
+
+    def test_post_kanban_jump_delta_card_leaving_the_board(self):
+        order = Order.objects.first()
+        order.customer = Customer.objects.create(
+            name='Trapuzarrak', phone=0, cp=0)
+        order.status = '6'
+        order.save()
+        resp = self.client.post(reverse('orders-CRUD'),
+                                {'origin': 'kanban-shiftFwd',
+                                 'pk': order.pk,
+                                 'action': 'kanban-jump',
+                                 })
+        data = json.loads(str(resp.content, 'utf-8'))
+        self.assertIsNone(data['column'])
+        self.assertIsNone(data['position'])
 
     def test_post_unknown_action_raises_500(self):
         """Action should exist."""
@@ -5850,6 +6090,7 @@ class CashFlowIOCRUDTests(TestCase):
         data = json.loads(str(resp.content, 'utf-8'))
         self.assertTrue(data['form_is_valid'])
         self.assertTrue(data['reload'])
+        o.refresh_from_db()
         self.assertEqual(o.already_paid, 100)
         self.assertEqual(o.pending, 200)
 
@@ -6203,6 +6444,80 @@ class PQueueActionsTests(TestCase):
         self.assertEqual(PQueue.objects.filter(score__lt=0).count(), 0)
 
 
+class PQueueReorderTests(TestCase):
+    """Test the drag & drop reordering of the queue."""
+
+    def setUp(self):
+        """Create the necessary items on database at once."""
+        user = User.objects.create_user(username='regular', password='test')
+        customer = Customer.objects.create(
+            name='Customer Test', address='This computer', city='No city',
+            phone='666666666', CIF='5555G', cp='48100')
+        order = Order.objects.create(
+            user=user, customer=customer, ref_name='Test order',
+            delivery=date.today(), confirmed=True, budget=2000, prepaid=0)
+        item = Item.objects.create(name='Test item', fabrics=5, stocked=30)
+        for i in range(3):
+            PQueue.objects.create(item=OrderItem.objects.create(
+                reference=order, element=item, price=30))
+        self.client.login(username='regular', password='test')
+
+    def test_valid_method(self):
+        """Only post method is accepted."""
+        resp = self.client.get(reverse('queue-reorder'))
+        self.assertEqual(resp.status_code, 500)
+
+    def test_poor_data(self):
+        """A list of pks is needed."""
+        for data in ({}, {'pks': ['a', 'b']}):
+            resp = self.client.post(reverse('queue-reorder'), data)
+            self.assertEqual(resp.status_code, 500)
+            self.assertEqual(resp.content.decode('utf-8'),
+                             'POST data was poor')
+
+    def test_ordering_must_match_the_queue(self):
+        """Every element of the queue should be sent once."""
+        first, mid, last = PQueue.objects.all()
+        resp = self.client.post(
+            reverse('queue-reorder'), {'pks': [last.pk, first.pk]})
+        self.assertEqual(resp.status_code, 500)
+        self.assertEqual(resp.content.decode('utf-8'),
+                         'The ordering doesn\'t match the queue')
+        self.assertEqual(
+            list(PQueue.objects.values_list('pk', flat=True)),
+            [first.pk, mid.pk, last.pk])
+
+    def test_reorder(self):
+        """The new order is stored and the list rendered again."""
+        first, mid, last = PQueue.objects.all()
+        pks = [last.pk, first.pk, mid.pk]
+        resp = self.client.post(reverse('queue-reorder'), {'pks': pks})
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(str(resp.content, 'utf-8'))
+        self.assertTrue(data['is_valid'])
+        self.assertEqual(data['html_id'], '#pqueue-list')
+        self.assertIn('js-queue-row', data['html'])
+        self.assertEqual(
+            list(PQueue.objects.values_list('pk', flat=True)), pks)
+
+    def test_delivered_orders_are_not_part_of_the_queue(self):
+        """Hidden elements don't need to be sent and keep their score."""
+        first, mid, last = PQueue.objects.all()
+        order = Order.objects.create(
+            user=User.objects.first(), customer=Customer.objects.first(),
+            ref_name='Delivered', delivery=date.today(), status=7,
+            budget=0, prepaid=0)
+        hidden = PQueue.objects.create(item=OrderItem.objects.create(
+            reference=order, element=Item.objects.last(), price=30))
+        pks = [mid.pk, last.pk, first.pk]
+        resp = self.client.post(reverse('queue-reorder'), {'pks': pks})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(PQueue.objects.get(pk=hidden.pk).score, 4000)
+        self.assertEqual(
+            list(PQueue.objects.exclude(pk=hidden.pk).values_list(
+                'pk', flat=True)), pks)
+
+
 class ItemSelectorTests(TestCase):
     """Test the item selector AJAX view."""
 
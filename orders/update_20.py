@@ -3,13 +3,14 @@
 from django.db.models import Q
 
 from .models import (
-    Customer, Invoice, CashFlowIO, Order, StatusShift, Item, ExpenseCategory,
+    Customer, Invoice, CashFlowIO, Order, StatusShift, ExpenseCategory,
     Expense, )
+from .services import recompute_item_health
 from datetime import date, timedelta
 
 # Update items health
 print('Updating item health')
-[i.save() for i in Item.objects.all()]
+recompute_item_health()
 
 # Update the group info
 print('Updating group info')
@@ -39,6 +39,7 @@ urlpatterns = [
          views.pqueue_tablet, name='pqueue_tablet'),
     path('invoices', views.invoiceslist, name='invoiceslist'),
     path('stock_manager', views.stock_manager, name='stock_manager'),
+    path('lead_times', views.lead_times_dashboard, name='lead_times'),
 
     # Object related urls
     re_path(r'^order/view/(?P<pk>[0-9]+)$',
@@ -49,7 +50,7 @@ urlpatterns = [
             views.customer_view, name='customer_view'),
 
     # Printer view
-    re_path(r'^ticket_print&invoice_no=(?P<invoice_no>[0-9]+)$',
+    re_path(r'^ticket_print&invoice=(?P<pk>[0-9]+)$',
             views.printable_ticket, name='ticket_print'),
 
     # Generic views
@@ -67,6 +68,7 @@ urlpatterns = [
     path('changelog/', views.changelog, name='changelog'),
     path('item-selector/', views.item_selector, name='item-selector'),
     path('queue-actions/', views.pqueue_actions, name='queue-actions'),
+    path('queue-reorder/', views.pqueue_reorder, name='queue-reorder'),
 
     # AJAX Hints
     path('customer-hints/', views.customer_hints, name='customer-hints'),
@@ -78,6 +80,12 @@ urlpatterns = [
     path('add-hours', views.add_hours, name='add_hours'),
 
     # The API url
+    path('API/receivables', views.receivables_api, name='receivables-api'),
+    path('API/pqueue-eta', views.pqueue_eta_api, name='pqueue-eta-api'),
+    path('API/reorder', views.reorder_api, name='reorder-api'),
+    path('API/lead-times', views.lead_times_api, name='lead-times-api'),
+    path('API/order-save-stats', views.order_save_stats_api,
+         name='order-save-stats-api'),
     path('API/', include(router.urls)),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
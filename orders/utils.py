@@ -1,5 +1,8 @@
 """Some utilities to use in the app."""
 from datetime import date
+from functools import lru_cache
+
+from django.template.loader import render_to_string
 
 from . import settings
 
@@ -48,3 +51,17 @@ def prettify_times(duration):
     else:
         t_string = '{}s'.format(int(duration))
     return t_string
+
+
+@lru_cache(maxsize=settings.ITEM_LABEL_CACHE_SIZE)
+def item_label(item_type, name, item_class, size):
+    """Render the item string once per distinct label.
+
+    The memo is keyed by every value the label shows, so editing an item
+    leaves its former label unreachable instead of stale.
+    """
+    context = {'type': item_type,
+               'name': name,
+               'class': item_class,
+               'size': size, }
+    return render_to_string('includes/item_string.html', context)
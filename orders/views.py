@@ -1,27 +1,39 @@
 """Define all the views for the app."""
 
 from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from itertools import chain
 from random import randint
 
 import markdown2
 from django.contrib.auth import logout
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.db.models import Count, DecimalField, FloatField, F, Q, Sum
 from django.http import (
     Http404, HttpResponseServerError, JsonResponse, FileResponse, )
+from django.middleware.csrf import get_token
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.decorators import method_decorator
+from django.utils.safestring import mark_safe
 from django.views import View
 from django.views.decorators.http import require_GET
 from django.views.generic import ListView
 from rest_framework import viewsets
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
 
 from . import serializers, settings
+from .analytics import lead_times, status_tracker
+from .forecast import reorder_suggestions
+from .services import (
+    KANBAN_COLUMNS, STOCK_TABS, delete_customers, estimate_times,
+    kanban_board, kanban_delta, pqueue_eta, receivables, stock_tabs, )
 from .utils import prettify_times
 from .forms import (
     CommentForm, CustomerForm, EditDateForm, InvoiceForm, ItemForm, OrderForm,
@@ -44,49 +56,48 @@ class CommonContexts:
     """
 
     @staticmethod
-    def kanban(confirmed=True):
-        """Get a dict with all the needed vars for the view."""
-        icebox = Order.objects.filter(
-            status='1').filter(confirmed=confirmed).order_by('delivery')
-        queued = Order.objects.filter(
-            status='2').filter(confirmed=confirmed).order_by('delivery')
-        in_progress = Order.objects.filter(status__in=['3', '4', '5', ])
-        in_progress = in_progress.filter(
-            confirmed=confirmed).order_by('delivery')
-        waiting = Order.objects.filter(
-            status='6').filter(confirmed=confirmed).order_by('delivery')
-        done = Order.live.filter(status='7').filter(confirmed=confirmed)
-        done = done.exclude(customer__name__iexact='trapuzarrak')
-        done = done.order_by('delivery')
-
-        # Get the amounts for each column
-        cols = (icebox, queued, in_progress, waiting, done, )
-        cols = [c.exclude(customer__name__iexact='Trapuzarrak') for c in cols]
-        amounts = [sum([order.total for order in col]) for col in cols]
-        already_paid = [
-            sum([order.already_paid for order in col]) for col in cols]
-
-        # Get times for icebox & queued orders. Recall that
-        # order.estimated_time returns 3 times
-        cols = (icebox, queued, )
-        est_times = [
-            sum([sum(order.estimated_time) for order in col]) for col in cols]
-
-        est_times = [prettify_times(d) for d in est_times]
-
-        vars = {'icebox': icebox,
-                'queued': queued,
-                'in_progress': in_progress,
-                'waiting': waiting,
-                'done': done,
-                'confirmed': confirmed,
-                'update_date': EditDateForm(),
-                'amounts': amounts,
-                'already_paid': already_paid,
-                'est_times': est_times,
-                }
+    def kanban(confirmed=True, request=None):
+        """Get a dict with all the needed vars for the view.
+
+        Cards come already rendered in `order.card`.
+        """
+        vars = kanban_board(confirmed=confirmed)
+        vars['est_times'] = [prettify_times(d) for d in vars['est_times']]
+        vars['confirmed'] = confirmed
+        vars['update_date'] = EditDateForm()
+
+        orders = [o for name, _ in KANBAN_COLUMNS for o in vars[name]]
+        csrf_token = get_token(request) if request else ''
+        cards = CommonContexts.kanban_cards(orders, csrf_token)
+        for order in orders:
+            order.card = cards[order.pk]
         return vars
 
+    @staticmethod
+    def kanban_cards(orders, csrf_token=''):
+        """Render the kanban cards of the orders reusing the cached ones.
+
+        Cards are cached under the order version and the day (colors depend
+        on it) with a placeholder for the csrf token, which is per user.
+        """
+        placeholder = 'KANBAN-CSRF-TOKEN'
+        keys = {'kanban-card-{}-{}-{}'.format(
+            o.pk, o.kanban_version, date.today()): o for o in orders}
+        cards = cache.get_many(keys)
+        missing = dict()
+        for key, order in keys.items():
+            if key not in cards:
+                context = {'order': order, 'update_date': EditDateForm(),
+                           'csrf_token': placeholder, }
+                missing[key] = render_to_string(
+                    'includes/kanban_element.html', context)
+        cache.set_many(missing, settings.KANBAN_CARD_TIMEOUT)
+        cards.update(missing)
+
+        return {
+            order.pk: mark_safe(cards[key].replace(placeholder, csrf_token))
+            for key, order in keys.items()}
+
     @staticmethod
     def order_details(request, pk):
         """Get a dict with all the reused vars in the view."""
@@ -104,21 +115,18 @@ class CommonContexts:
             session = None
 
         # Display max status dates without overrun the next stages
-        ss = order.status_shift.all()
-        sts = ('1', '2', '3', '6', '7', '9', )
         sis = settings.STATUS_ICONS
-        status_tracker = [
-            (sis[n], ss.filter(status=s).last()) for n, s in enumerate(sts)
-        ]
+        tracker = list(zip(sis, status_tracker(order)))
 
         # Display estimated times
-        order_est = [prettify_times(d) for d in order.estimated_time]
-        order_est_total = prettify_times(sum(order.estimated_time))
+        est = estimate_times(Order.objects.filter(pk=order.pk))[order.pk]
+        order_est = [prettify_times(d) for d in est]
+        order_est_total = prettify_times(sum(est))
 
         title = (order.pk, order.customer.name, order.ref_name)
         vars = {'order': order,
                 'items': items,
-                'status_tracker': status_tracker,
+                'status_tracker': tracker,
                 'order_est': order_est,
                 'order_est_total': order_est_total,
                 'update_times': ItemTimesForm(),
@@ -134,39 +142,52 @@ class CommonContexts:
         return vars
 
     @staticmethod
-    def stock_tabs(items=None):
-        """Get the common variables for stock manager."""
-        if not items:
-            items = Item.objects.all().order_by('health')  # Default value
-
-        items = items.exclude(name='Predeterminado')
-        tab_elements = {
-            'p1': items.filter(health=0),
-            'p2': items.filter(health__gt=0).filter(health__lt=1),
-            'p3': items.filter(health__gte=1)[:50],
-            'zero': items.filter(health=-100)[:50],
-            'negative': items.filter(
-                health__lt=0).filter(health__gt=-100)[:50],
-        }
+    def stock_tabs(items=None, after=None):
+        """Get the common variables for stock manager.
+
+        After is a dict of tab name to the (health, pk) cursor of its page.
+        """
+        tabs = stock_tabs(items, after=after)
+        for tab in tabs.values():
+            if tab['next']:
+                tab['next'] = '{}_{}'.format(*tab['next'])
 
         return {
-            'tab_elements': tab_elements, 'item_types': settings.ITEM_TYPE[1:]
+            'tabs': tabs,
+            'tab_elements': {
+                name: tab['elements'] for name, tab in tabs.items()},
+            'active_tab': next(iter(after)) if after else 'p1',
+            'reorder': reorder_suggestions(items),
+            'item_types': settings.ITEM_TYPE[1:]
         }
 
     @staticmethod
     def pqueue():
-        """Get common context var for pqueue."""
+        """Get common context var for pqueue.
+
+        Rows come with their relations joined and the item labels rendered
+        once per item, so the queue costs the same queries whatever its size.
+        """
         available = OrderItem.objects.exclude(reference__status__in=[7, 8, 9])
         available = available.filter(reference__confirmed=True)
         available = available.exclude(element__name__iexact='Descuento')
         available = available.exclude(stock=True).filter(pqueue__isnull=True)
         available = available.exclude(element__foreing=True)
+        available = available.select_related('reference__customer', 'element')
         available = available.order_by('reference__delivery',
                                        'reference__ref_name')
-        pqueue = PQueue.objects.select_related('item__reference')
-        pqueue = pqueue.exclude(item__reference__status__in=[7, 8, 9])
+        pqueue = PQueue.objects.live().select_related(
+            'item__reference__customer', 'item__element')
         pqueue_completed = pqueue.filter(score__lt=0)
         pqueue_active = pqueue.filter(score__gt=0)
+
+        labels = dict()
+        queued = [q.item for q in chain(pqueue_active, pqueue_completed)]
+        for order_item in chain(available, queued):
+            element = order_item.element
+            if element.pk not in labels:
+                labels[element.pk] = element.html_string
+            element.label = labels[element.pk]
         i_relax = settings.RELAX_ICONS[
             randint(0, len(settings.RELAX_ICONS) - 1)]
 
@@ -217,13 +238,17 @@ def timetable_required(function):
 
 
 @login_required
-def printable_ticket(request, invoice_no):
-    """Download an invoiced order."""
+def printable_ticket(request, pk):
+    """Download an invoiced order.
+
+    Invoice numbers restart each fiscal year, so invoices are found by pk.
+    """
     # fetch the gift status
     gift = request.GET.get('gift', False)
-    invoice = Invoice.objects.get(invoice_no=invoice_no)
+    invoice = get_object_or_404(Invoice, pk=pk)
     pdf = invoice.printable_ticket(gift=gift)
-    filename = 'ticket-{}.pdf'.format(invoice.invoice_no)
+    filename = 'ticket-{}-{}.pdf'.format(
+        invoice.fiscal_year, invoice.invoice_no)
     return FileResponse(pdf, as_attachment=True, filename=filename, )
 
 
@@ -384,8 +409,7 @@ def main(request):
     # Pending box
     relevant = Order.live.exclude(customer__name__iexact='Trapuzarrak')
     relevant = relevant.filter(confirmed=True)
-    pending = [o.pending for o in relevant if o.pending]
-    pending_amount = int(sum(pending))
+    pending_amount = int(receivables()['total'])
     pending_msg = '{}€ tenemos aún<br>por cobrar'.format(pending_amount)
     if pending_amount == 0:
         pending_msg = 'Genial, tenemos todo cobrado!'
@@ -618,6 +642,42 @@ def itemslist(request):
     return render(request, 'tz/list_view.html', view_settings)
 
 
+@login_required
+@timetable_required
+def lead_times_dashboard(request):
+    """Display how long the orders stay on each status."""
+    by = request.GET.get('by', 'month')
+    if by not in ('month', 'type'):
+        by = 'month'
+    labels = dict(Order.STATUS)
+    labels.update(lead='Plazo total', cycle='Plazo de producción')
+    groups = dict(settings.ITEM_TYPE)
+    rows = list()
+    for entry in lead_times(by):
+        group = entry['group']
+        rows.append({
+            'group': group.strftime('%m/%Y') if by == 'month' else
+            groups.get(group, group),
+            'status': labels.get(entry['status'], entry['status']),
+            'count': entry['count'],
+            'percentiles': [
+                prettify_times(entry[p].total_seconds())
+                for p in ('p50', 'p75', 'p90')],
+            })
+
+    try:
+        session = Timetable.active.get(user=request.user)
+    except ObjectDoesNotExist:  # pragma: no cover
+        session = None
+    context = {'rows': rows,
+               'by': by,
+               'user': request.user,
+               'session': session,
+               'version': settings.VERSION,
+               'title': 'TrapuZarrak · Plazos de los pedidos', }
+    return render(request, 'tz/lead_times.html', context)
+
+
 @login_required
 @timetable_required
 def invoiceslist(request):
@@ -716,9 +776,9 @@ def invoiceslist(request):
 def kanban(request):
     """Display a kanban view for orders."""
     if request.GET.get('unconfirmed', None):
-        context = CommonContexts.kanban(confirmed=False)
+        context = CommonContexts.kanban(confirmed=False, request=request)
     else:
-        context = CommonContexts.kanban()
+        context = CommonContexts.kanban(request=request)
 
     try:
         session = Timetable.active.get(user=request.user)
@@ -738,12 +798,22 @@ def kanban(request):
 @timetable_required
 def stock_manager(request):
     """View and edit items' stock."""
-    items = Item.objects.all().order_by('health')
+    items = Item.objects.all()
     filter_type = request.GET.get('filter_type', None)
     if filter_type:
         items = items.filter(item_type=filter_type)
 
-    context = CommonContexts.stock_tabs(items)
+    # Tabs paged with a health_pk cursor
+    after = dict()
+    for name, _ in STOCK_TABS:
+        try:
+            health, pk = request.GET[name].split('_')
+            after[name] = (Decimal(health), int(pk))
+        except (KeyError, ValueError, InvalidOperation):
+            pass
+
+    context = CommonContexts.stock_tabs(items, after=after)
+    context['filter_type'] = filter_type
 
     return render(request, 'tz/stock_manager.html', context)
 
@@ -926,6 +996,7 @@ def pqueue_manager(request):
     context = CommonContexts.pqueue()
     context['cur_user'] = request.user
     context['session'] = session
+    context['eta'] = pqueue_eta()
     return render(request, 'tz/pqueue_manager.html', context)
 
 
@@ -1344,7 +1415,7 @@ class Actions(View):
         # Delete customer (POST)
         elif action == 'customer-delete':
             customer = get_object_or_404(Customer, pk=pk)
-            customer.delete()
+            delete_customers([customer])
             data['redirect'] = (reverse('customerlist'))
             data['form_is_valid'] = True
 
@@ -1444,7 +1515,7 @@ class OrdersCRUD(View):
                 data['form_is_valid'] = True
                 data['html_id'] = '#kanban-columns'
                 template = 'includes/kanban_columns.html'
-                context = CommonContexts.kanban()
+                context = CommonContexts.kanban(request=request)
             else:
                 data['form_is_valid'] = False
                 data['error'] = form.errors
@@ -1470,9 +1541,23 @@ class OrdersCRUD(View):
                 data['html_id'] = '#order-status'
                 context = CommonContexts.order_details(request, pk)
             else:
-                template = 'includes/kanban_columns.html'
-                data['html_id'] = '#kanban-columns'
-                context = CommonContexts.kanban()
+                # Send only the moved card & the column headers
+                delta = kanban_delta(pk)
+                template = 'includes/kanban_element.html'
+                data['html_id'] = '#kanban-card-{}'.format(pk)
+                context = {'order': delta['order'],
+                           'update_date': EditDateForm(), }
+                data['column'] = delta['column']
+                data['position'] = delta['position']
+                data['columns'] = dict()
+                for name, totals in delta['totals'].items():
+                    if totals['est_time'] is not None:
+                        totals['est_time'] = prettify_times(
+                            totals['est_time'])
+                    data['columns'][name] = {
+                        'count': totals['count'],
+                        'totals': render_to_string(
+                            'includes/kanban_totals.html', totals), }
 
             data['form_is_valid'] = True
 
@@ -1653,11 +1738,11 @@ class OrderItemsCRUD(View):
         if action == 'main':  # Create & update
             base_item = Item.objects.get(pk=request.POST.get('element', None))
             order = Order.objects.get(pk=request.POST.get('reference', None))
-            order_est_total = prettify_times(sum(order.estimated_time))
 
             if form.is_valid():
                 # perfrom db actions
                 item = form.save()
+                order = item.reference  # holds the updated amounts
                 if request.POST.get('set-default-price', None):
                     base_item.price = request.POST.get('set-default-price')
                     base_item.notes = (
@@ -1680,6 +1765,8 @@ class OrderItemsCRUD(View):
                 data['form_is_valid'] = False
                 template = 'includes/custom_forms/order_item.html'
 
+            est = estimate_times(Order.objects.filter(pk=order.pk))[order.pk]
+            order_est_total = prettify_times(sum(est))
             context = {'form': form,
                        'invoice_form': InvoiceForm(),
                        'base_item': base_item,
@@ -1694,13 +1781,15 @@ class OrderItemsCRUD(View):
             # can be refactored with the main action one
             if not order_item_pk:
                 return HttpResponseServerError('No item pk was provided.')
-            order = Order.objects.get(pk=request.POST.get('reference', None))
-
             # perfrom db actions
             order_item.delete()
             data['form_is_valid'] = True
 
-            order_est_total = prettify_times(sum(order.estimated_time))
+            # Fetch the order afterwards so it holds the updated amounts
+            order = Order.objects.get(pk=request.POST.get('reference', None))
+
+            est = estimate_times(Order.objects.filter(pk=order.pk))[order.pk]
+            order_est_total = prettify_times(sum(est))
 
             # Render the view depending the order type
             if order.ref_name == 'Quick':
@@ -1803,7 +1892,7 @@ class CommentsCRUD(View):
                 data['error'] = form.errors
 
             template = 'includes/kanban_columns.html'
-            context = CommonContexts.kanban()
+            context = CommonContexts.kanban(request=request)
         else:
             return HttpResponseServerError('The action was not found.')
 
@@ -1889,8 +1978,6 @@ def pqueue_actions(request):
             'error': False, }
     template = 'includes/pqueue_list.html'
 
-    context = CommonContexts.pqueue()
-
     if action == 'send':
         item = get_object_or_404(OrderItem, pk=pk)
         to_queue = PQueue(item=item)
@@ -1937,10 +2024,14 @@ def pqueue_actions(request):
         item.uncomplete()
         data['is_valid'] = True
 
+    context = CommonContexts.pqueue()
+
     # Tablet view id
     if action == 'tb-complete' or action == 'tb-uncomplete':
         data['html_id'] = '#pqueue-list-tablet'
         template = 'includes/pqueue_tablet.html'
+    else:
+        context['eta'] = pqueue_eta()
 
     """
     Test stuff. Since it's not very straightforward extract this data
@@ -1958,6 +2049,37 @@ def pqueue_actions(request):
     return JsonResponse(data)
 
 
+def pqueue_reorder(request):
+    """Apply the whole new order of the queue sent by drag & drop."""
+    if request.method != 'POST':
+        return HttpResponseServerError('The request should go in a post ' +
+                                       'method')
+
+    try:
+        pks = [int(pk) for pk in request.POST.getlist('pks')]
+    except ValueError:
+        pks = None
+    if not pks:
+        return HttpResponseServerError('POST data was poor')
+
+    queue = PQueue.objects.live().active()
+    try:
+        PQueue.objects.reorder(queue, pks, settings.PQUEUE_GAP)
+    except ValueError:
+        return HttpResponseServerError('The ordering doesn\'t match the ' +
+                                       'queue')
+    context = CommonContexts.pqueue()
+    context['eta'] = pqueue_eta()
+
+    data = {'html_id': '#pqueue-list',
+            'reload': False,
+            'is_valid': True,
+            'error': False,
+            'html': render_to_string(
+                'includes/pqueue_list.html', context, request=request), }
+    return JsonResponse(data)
+
+
 def item_selector(request):
     """Select and add new items."""
     # Set initial search filters as unknown
@@ -2162,6 +2284,52 @@ class TimetableAPIList(viewsets.ReadOnlyModelViewSet):
     """API view for timetabñes."""
     queryset = Timetable.objects.all()
     serializer_class = serializers.TimetableSerializer
+
+
+@api_view(['GET'])
+def receivables_api(request):
+    """API view for the pending amounts of live orders."""
+    pending = receivables()
+    return Response({
+        'total': pending['total'],
+        'orders': serializers.ReceivableSerializer(
+            pending['orders'], many=True).data, })
+
+
+@api_view(['GET'])
+def reorder_api(request):
+    """API view for the suggested production of the items."""
+    return Response(serializers.ReorderSuggestionSerializer(
+        reorder_suggestions(), many=True).data)
+
+
+@api_view(['GET'])
+def lead_times_api(request):
+    """API view for the percentiles of the time spent on each status."""
+    by = request.GET.get('by', 'month')
+    if by not in ('month', 'type'):
+        return Response({'by': 'Group by month or type.'}, status=400)
+    return Response(serializers.LeadTimeSerializer(
+        lead_times(by), many=True).data)
+
+
+@api_view(['GET'])
+def order_save_stats_api(request):
+    """API view for the order save side effects run & skipped."""
+    stats = dict()
+    for key, count in Order.save_stats.items():
+        effect, outcome = key.split(':')
+        stats.setdefault(effect, {'run': 0, 'skipped': 0})[outcome] = count
+    return Response(stats)
+
+
+@api_view(['GET'])
+def pqueue_eta_api(request):
+    """API view for the expected finish times of the production queue."""
+    return Response(serializers.PQueueETASerializer(
+        pqueue_eta(), many=True).data)
+
+
 #
 #
 #